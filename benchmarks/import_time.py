@@ -0,0 +1,112 @@
+"""
+Check that importing the q2-humann3 plugin stays within a time budget.
+
+QIIME 2 imports ``q2_humann3.plugin_setup`` for every ``qiime`` command,
+so the plugin should only load what registering its actions needs. Every
+measurement runs in a fresh interpreter that has already imported the
+QIIME 2 framework and q2-types, which every plugin pays for anyway; the
+fastest of ``--repeats`` runs is compared with ``--budget``. Fails too
+when the plugin loads an implementation module, or asyncio or scipy.
+
+Run from a QIIME 2 environment with q2-humann3 installed::
+
+    python benchmarks/import_time.py --budget 0.2
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# imported by QIIME 2 and q2-types before any plugin is loaded, biom and
+# pandas are needed by the signatures of the actions anyway
+FRAMEWORK = (
+    "biom",
+    "pandas",
+    "qiime2.plugin",
+    "q2_types.feature_table",
+    "q2_types.per_sample_sequences",
+    "q2_types.sample_data",
+)
+
+# loaded when an action runs, never by registering the plugin
+IMPLEMENTATION = (
+    "q2_humann3._alignments",
+    "q2_humann3._merge",
+    "q2_humann3._metrics",
+    "q2_humann3._reads",
+    "q2_humann3._regroup",
+    "q2_humann3._rename",
+    "q2_humann3._renorm",
+    "q2_humann3._scheduler",
+    "q2_humann3._shard",
+    "q2_humann3._split",
+    "q2_humann3._staging",
+)
+
+# seconds the plugin import may take on top of the framework
+BUDGET = 0.2
+
+# libraries only the implementation uses; biom loads scipy with the
+# framework, the plugin must not be what loads them
+LIBRARIES = ("asyncio", "scipy")
+
+_MEASURE = """
+import importlib, json, sys, time
+for name in %r:
+    importlib.import_module(name)
+framework = set(sys.modules)
+start = time.perf_counter()
+import q2_humann3.plugin_setup
+elapsed = time.perf_counter() - start
+print(json.dumps({"import_time": elapsed,
+                  "modules": sorted(set(sys.modules) - framework)}))
+"""
+
+
+def _measure():
+    """
+    Import time of the plugin and the modules it loads on top of the
+    framework, in a fresh interpreter
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", _MEASURE % (FRAMEWORK,)],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _loaded(modules):
+    """The implementation modules and libraries among ``modules``"""
+    return sorted(
+        name for name in modules
+        if name in IMPLEMENTATION or name.split(".")[0] in LIBRARIES
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--budget", type=float, default=BUDGET,
+                        help="seconds the plugin import may take")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    measurements = [_measure() for _ in range(args.repeats)]
+    import_time = min(m["import_time"] for m in measurements)
+    loaded = _loaded(measurements[0]["modules"])
+    print("import_time\t%.3f" % import_time)
+    print("budget\t%.3f" % args.budget)
+
+    failed = False
+    if loaded:
+        print("implementation modules loaded by the plugin: %s" % ", ".join(loaded))
+        failed = True
+    if import_time > args.budget:
+        print("the plugin import takes longer than its budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Benchmark the q2-humann3 orchestration, merge, renormalization and rename
+paths on synthetic data, without humann3 or its databases.
+
+humann3 is replaced by the stand-in in ``bin/``, which writes realistic
+synthetic outputs. Every measurement runs in a fresh
+interpreter so its peak RSS is not inflated by earlier cases; fixtures are
+generated beforehand and are not part of the measurement.
+
+Run from a QIIME 2 environment with q2-humann3 installed::
+
+    python benchmarks/run_benchmarks.py --samples 10 100 --features 10000 100000
+
+``--samples 10 100 2000 --features 10000 200000 2000000`` covers the full
+range but needs tens of GB of disk for the fixtures.
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ("run", "merge", "renorm", "rename")
+
+
+def _fixture(root, n_samples, n_features):
+    """Per-sample humann3 outputs, merged table and rename reference"""
+    sys.path.insert(0, HERE)
+    from synthetic import write_reference_mapping, write_sample_outputs
+
+    path = os.path.join(root, "fixture-%d-%d" % (n_samples, n_features))
+    if os.path.isdir(path):
+        return path
+
+    samples = os.path.join(path, "samples")
+    for i in range(n_samples):
+        name = "sample%d_%d_L001_R1_001" % (i, i)
+        write_sample_outputs(os.path.join(samples, name), name, n_features)
+    write_reference_mapping(os.path.join(path, "reference"), n_features)
+
+    from biom.util import biom_open
+
+    from q2_humann3._merge import _SampleAggregator
+
+    aggregator = _SampleAggregator()
+    for name in sorted(os.listdir(samples)):
+        aggregator.add(os.path.join(samples, name))
+    with biom_open(os.path.join(path, "genefamilies.biom"), "w") as fh:
+        aggregator.tables()["genefamilies"].to_hdf5(fh, "benchmark")
+    return path
+
+
+def _bench_run(fixture, root, n_samples, n_features):
+    sys.path.insert(0, HERE)
+    from q2_types.per_sample_sequences import SingleLanePerSampleSingleEndFastqDirFmt
+    from synthetic import write_databases, write_demultiplexed_seqs
+
+    from q2_humann3 import run
+    from q2_humann3._format import (Bowtie2IndexDirFmt2, HumannDbDirFormat,
+                                    HumannDBSingleFileDirFormat)
+
+    seqs = os.path.join(root, "seqs")
+    write_demultiplexed_seqs(seqs, n_samples)
+    databases = write_databases(os.path.join(root, "databases"))
+    formats = {
+        "nucleotide_database": HumannDbDirFormat,
+        "protein_database": HumannDbDirFormat,
+        "pathway_database": HumannDBSingleFileDirFormat,
+        "pathway_mapping": HumannDBSingleFileDirFormat,
+        "bowtie_database": Bowtie2IndexDirFmt2,
+    }
+    inputs = {name: fmt(databases[name], mode="r") for name, fmt in formats.items()}
+    demultiplexed_seqs = SingleLanePerSampleSingleEndFastqDirFmt(seqs, mode="r")
+
+    os.environ["PATH"] = os.path.join(HERE, "bin") + os.pathsep + os.environ["PATH"]
+    os.environ["Q2_HUMANN3_BENCH_FEATURES"] = str(n_features)
+    return lambda: run(demultiplexed_seqs, n_parallel_samples=os.cpu_count(), **inputs)
+
+
+def _bench_merge(fixture, root, n_samples, n_features):
+    from q2_humann3._merge import _SampleAggregator
+
+    samples = os.path.join(fixture, "samples")
+
+    def merge():
+        aggregator = _SampleAggregator()
+        for name in sorted(os.listdir(samples)):
+            aggregator.add(os.path.join(samples, name))
+        return aggregator.tables()
+
+    return merge
+
+
+def _bench_renorm(fixture, root, n_samples, n_features):
+    import biom
+
+    from q2_humann3._renorm import _renorm_table
+
+    table = biom.load_table(os.path.join(fixture, "genefamilies.biom"))
+    return lambda: _renorm_table(table, "relab")
+
+
+def _bench_rename(fixture, root, n_samples, n_features):
+    import biom
+
+    from q2_humann3._rename import _rename_table
+
+    table = biom.load_table(os.path.join(fixture, "genefamilies.biom"))
+    reference = os.path.join(fixture, "reference")
+    return lambda: _rename_table(table, reference_mapping=reference)
+
+
+def _measure(benchmark, fixture, n_samples, n_features):
+    """Run one benchmark in this interpreter and print its measurements"""
+    with tempfile.TemporaryDirectory() as root:
+        func = globals()["_bench_" + benchmark](fixture, root, n_samples, n_features)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        func()
+        wall_time = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(
+        json.dumps(
+            {
+                "wall_time": wall_time,
+                "peak_rss": usage.ru_maxrss * 1024,
+                "setup_rss": baseline * 1024,
+                "children_peak_rss": children.ru_maxrss * 1024,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--samples", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--features", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--workdir", help="where fixtures are kept between runs")
+    parser.add_argument("--output", help="also write the results as TSV")
+    parser.add_argument("--measure", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        benchmark, fixture, n_samples, n_features = args.measure
+        _measure(benchmark, fixture, int(n_samples), int(n_features))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="q2-humann3-bench-")
+    columns = ["benchmark", "samples", "features", "wall_time", "peak_rss", "setup_rss",
+               "children_peak_rss"]
+    rows = []
+    print("\t".join(columns))
+    for n_samples, n_features in itertools.product(args.samples, args.features):
+        fixture = _fixture(workdir, n_samples, n_features)
+        for benchmark in args.benchmarks:
+            result = subprocess.run(
+                [sys.executable, __file__, "--measure", benchmark, fixture,
+                 str(n_samples), str(n_features)],
+                check=True,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            measured = json.loads(result.stdout.strip().splitlines()[-1])
+            row = [benchmark, n_samples, n_features] + [measured[c] for c in columns[3:]]
+            rows.append(row)
+            print("\t".join("%.3f" % v if isinstance(v, float) else str(v) for v in row))
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write("\t".join(columns) + "\n")
+            for row in rows:
+                fh.write("\t".join(str(v) for v in row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Synthetic inputs and humann3 outputs for the benchmarks.
+
+Feature universes are deterministic, so every sample of a benchmark draws
+from the same gene families, pathways and clades; each sample only reports
+a random subset of them, like real per-sample humann3 outputs do.
+"""
+import bz2
+import gzip
+import os
+import zlib
+
+import biom
+import numpy as np
+from biom.util import biom_open
+
+# species every gene family and pathway may be stratified by
+N_SPECIES = 50
+# fraction of the feature universe present in a single sample
+SAMPLE_DENSITY = 0.2
+# share of rows that are FEATURE|taxon stratifications rather than totals
+STRATA_PER_FEATURE = 4
+
+
+def _species(n=N_SPECIES):
+    return ["g__Genus%d.s__Genus%d_species" % (i, i) for i in range(n)] + [
+        "unclassified"
+    ]
+
+
+def feature_universe(prefix: str, n_features: int) -> list:
+    """``n_features`` rows: community totals each followed by their strata"""
+    species = _species()
+    n_totals = max(1, n_features // (STRATA_PER_FEATURE + 1))
+    features = []
+    for i in range(n_totals):
+        feature = "%s%08d" % (prefix, i)
+        features.append(feature)
+        for k in range(STRATA_PER_FEATURE):
+            features.append(feature + "|" + species[(i + k) % len(species)])
+    return features[:n_features]
+
+
+def _rng(sample_name: str, salt: str) -> np.random.Generator:
+    return np.random.default_rng(zlib.crc32((sample_name + salt).encode()))
+
+
+def _write_table(path, sample_name, features, rng, special):
+    chosen = np.flatnonzero(rng.random(len(features)) < SAMPLE_DENSITY)
+    ids = special + [features[i] for i in chosen]
+    values = rng.lognormal(mean=2.0, sigma=1.5, size=(len(ids), 1)).round(3)
+    with biom_open(path, "w") as fh:
+        biom.Table(values, ids, [sample_name]).to_hdf5(fh, "synthetic")
+
+
+def write_metaphlan_profile(path: str, sample_name: str, n_clades: int = 200) -> None:
+    rng = _rng(sample_name, "taxonomy")
+    clades = []
+    for i in range(n_clades):
+        clade = "k__Bacteria|p__Phylum%d|c__Class%d|g__Genus%d|s__Genus%d_species" % (
+            i % 7,
+            i % 13,
+            i,
+            i,
+        )
+        if rng.random() < SAMPLE_DENSITY:
+            clades.append(clade)
+    abundances = rng.dirichlet(np.ones(len(clades) + 1)) * 100
+    with open(path, "w") as fh:
+        fh.write("#mpa_vJan21_CHOCOPhlAnSGB_202103\n")
+        fh.write("#clade_name\tNCBI_tax_id\trelative_abundance\tadditional_species\n")
+        fh.write("UNCLASSIFIED\t-1\t%.5f\t\n" % abundances[0])
+        for clade, abundance in zip(clades, abundances[1:]):
+            fh.write("%s\t2|%d\t%.5f\t\n" % (clade, len(clade), abundance))
+
+
+def write_sample_outputs(output: str, sample_name: str, n_features: int) -> None:
+    """Write what ``humann3 -o output`` writes for one sample"""
+    os.makedirs(os.path.join(output, sample_name + "_humann_temp"), exist_ok=True)
+    n_pathways = max(10, n_features // 100)
+    tables = [
+        ("genefamilies", feature_universe("UniRef90_", n_features), ["UNMAPPED"]),
+        ("pathabundance", feature_universe("PWY-", n_pathways), ["UNMAPPED", "UNINTEGRATED"]),
+        ("pathcoverage", feature_universe("PWY-", n_pathways), ["UNMAPPED", "UNINTEGRATED"]),
+    ]
+    for name, features, special in tables:
+        _write_table(
+            os.path.join(output, "%s_%s.biom" % (sample_name, name)),
+            sample_name,
+            features,
+            _rng(sample_name, name),
+            special,
+        )
+    write_metaphlan_profile(
+        os.path.join(
+            output,
+            sample_name + "_humann_temp",
+            sample_name + "_metaphlan_bugs_list.tsv",
+        ),
+        sample_name,
+    )
+
+
+def write_fastq(path: str, n_reads: int = 1000) -> None:
+    with gzip.open(path, "wt") as fh:
+        for i in range(n_reads):
+            fh.write("@read%d\nACGTACGTACGTACGTACGT\n+\nIIIIIIIIIIIIIIIIIIII\n" % i)
+
+
+def write_demultiplexed_seqs(path: str, n_samples: int) -> None:
+    """A SingleLanePerSampleSingleEndFastqDirFmt directory"""
+    os.makedirs(path, exist_ok=True)
+    manifest = ["sample-id,filename,direction"]
+    for i in range(n_samples):
+        filename = "sample%d_%d_L001_R1_001.fastq.gz" % (i, i)
+        # vary sizes so the scheduler has something to order
+        write_fastq(os.path.join(path, filename), 200 * (1 + i % 10))
+        manifest.append("sample%d,%s,forward" % (i, filename))
+    with open(os.path.join(path, "MANIFEST"), "w") as fh:
+        fh.write("\n".join(manifest) + "\n")
+    with open(os.path.join(path, "metadata.yml"), "w") as fh:
+        fh.write("phred-offset: 33\n")
+
+
+def write_databases(path: str) -> dict:
+    """Placeholder database directories, the stub humann3 never reads them"""
+    layout = {
+        "nucleotide_database": ["g__Genus0.s__Genus0_species.centroids.v201901b.ffn.gz"],
+        "protein_database": ["uniref90_201901b_full.dmnd"],
+        "pathway_database": ["mapping.gz"],
+        "pathway_mapping": ["mapping.gz"],
+        "bowtie_database": [
+            "mpa.1.bt2l",
+            "mpa.2.bt2l",
+            "mpa.3.bt2l",
+            "mpa.4.bt2l",
+            "mpa.rev.1.bt2l",
+            "mpa.rev.2.bt2l",
+            "mpa.pkl",
+        ],
+    }
+    paths = {}
+    for name, files in layout.items():
+        paths[name] = os.path.join(path, name)
+        os.makedirs(paths[name], exist_ok=True)
+        for filename in files:
+            with open(os.path.join(paths[name], filename), "wb") as fh:
+                fh.write(b"\0" * 1024)
+    return paths
+
+
+def write_reference_mapping(path: str, n_features: int) -> None:
+    """A HumannDBSingleReferenceFileDirFormat directory naming every family"""
+    os.makedirs(path, exist_ok=True)
+    with bz2.open(os.path.join(path, "reference.txt.bz2"), "wt") as fh:
+        for feature in feature_universe("UniRef90_", n_features):
+            if "|" not in feature:
+                fh.write("%s\tprotein %s\n" % (feature, feature[-8:]))
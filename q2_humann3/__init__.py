@@ -1,5 +1,25 @@
-from ._humann import rename_gene_families, rename_pathways, run
+import importlib
 
 __version__ = "0.0.2"
 
-__all__ = ["run", "rename_pathways", "rename_gene_families"]
+__all__ = ["run", "renorm_table", "rename_pathways", "rename_gene_families",
+           "rename_tables", "regroup_gene_families",
+           "split_stratified", "profile_shard", "finalize",
+           "resume_from_alignments", "import_database"]
+
+# the module of every public name, imported on first access so that
+# loading the plugin does not load the implementation
+_MODULES = {name: "._humann" for name in __all__}
+_MODULES["import_database"] = "._staging"
+
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(_MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,105 @@
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Optional
+
+from q2_humann3._merge import METAPHLAN_PROFILE_SUFFIX, _sample_outputs
+from q2_humann3._reads import _decompress
+
+# the files humann3 --resume skips a stage for, after the sample name: the
+# custom ChocoPhlAn database and its bowtie2 index, the nucleotide and the
+# translated alignments
+NUCLEOTIDE_INTERMEDIATES = (
+    "_custom_chocophlan_database.ffn",
+    "_bowtie2_index",
+    "_bowtie2_aligned.sam",
+)
+TRANSLATED_INTERMEDIATES = ("_diamond_aligned.tsv",)
+
+# humann3 stages a resumed run can recompute
+STAGES = ("translated", "pathways")
+
+
+def _compress(path: str, target: str, threads: int = 1) -> None:
+    """Gzip ``path`` into ``target``, with pigz when it is installed"""
+    pigz = shutil.which("pigz")
+    with open(target, "wb") as out:
+        if pigz:
+            subprocess.run([pigz, "-c", "-p", str(threads), path], stdout=out, check=True)
+            return
+        with open(path, "rb") as fh, gzip.open(out, "wb", compresslevel=6) as gz:
+            shutil.copyfileobj(fh, gz, 16 * 1024**2)
+
+
+def _keep_alignments(
+    sample_name: str, sample_output: str, alignments: str, threads: int = 1
+) -> None:
+    """
+    Compress the alignment intermediates and MetaPhlAn profile of one sample
+    into ``alignments``, before its humann3 temporary directory is removed.
+
+    The files are compressed next to ``alignments`` and renamed into place,
+    replacing what an earlier attempt of a retried sample kept.
+    """
+    target = os.path.join(alignments, sample_name)
+    shutil.rmtree(target, ignore_errors=True)
+    partial = tempfile.mkdtemp(prefix=".%s-" % sample_name, dir=alignments)
+    try:
+        profile = _sample_outputs(sample_output)["taxonomy"]
+        _compress(
+            profile,
+            os.path.join(partial, sample_name + METAPHLAN_PROFILE_SUFFIX + ".gz"),
+            threads,
+        )
+
+        temp = os.path.join(sample_output, sample_name + "_humann_temp")
+        for name in sorted(os.listdir(temp)):
+            if name[len(sample_name):].startswith(
+                NUCLEOTIDE_INTERMEDIATES + TRANSLATED_INTERMEDIATES
+            ):
+                _compress(os.path.join(temp, name), os.path.join(partial, name + ".gz"), threads)
+        os.chmod(partial, 0o755)
+        os.rename(partial, target)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+
+def _restore_alignments(
+    sample_name: str,
+    alignments: str,
+    sample_output: str,
+    stage: str = "pathways",
+    threads: int = 1,
+) -> Optional[str]:
+    """
+    Decompress the kept intermediates of one sample where humann3 --resume
+    looks for them.
+
+    The translated alignments are left out when the translated search is
+    to run again. Returns the MetaPhlAn profile, or None when no
+    intermediates were kept for the sample.
+    """
+    if stage not in STAGES:
+        raise ValueError("stage must be one of %s, not %r" % (STAGES, stage))
+    source = os.path.join(alignments, sample_name)
+    if not os.path.isdir(source):
+        return None
+
+    temp = os.path.join(sample_output, sample_name + "_humann_temp")
+    os.makedirs(temp, exist_ok=True)
+    profile = None
+    for name in sorted(os.listdir(source)):
+        original = name[: -len(".gz")]
+        if original.endswith(METAPHLAN_PROFILE_SUFFIX):
+            profile = os.path.join(sample_output, original)
+            _decompress([os.path.join(source, name)], profile)
+        elif stage == "translated" and original[len(sample_name):].startswith(
+            TRANSLATED_INTERMEDIATES
+        ):
+            continue
+        else:
+            _decompress([os.path.join(source, name)], os.path.join(temp, original), threads)
+    return profile
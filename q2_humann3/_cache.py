@@ -0,0 +1,218 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from typing import Iterable, List, Optional, Tuple
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Files written by humann3 for a single sample that the merge steps consume
+_CACHED_OUTPUTS = (
+    "_genefamilies.biom",
+    "_pathabundance.biom",
+    "_pathcoverage.biom",
+    "_metaphlan_bugs_list.tsv",
+)
+
+# QIIME 2 extracts artifacts into directories named after their UUID
+_UUID_PATTERN = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+)
+
+# Thread counts do not change the profile, so they are left out of the key
+_NPROC_PATTERN = re.compile(r"\s*--nproc\s+\d+")
+
+
+def _hash_file(path: str) -> str:
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fingerprint_directory(path: str) -> str:
+    """
+    Cheap fingerprint of a (possibly very large) database directory, or of
+    a single database file.
+
+    Hashing a full ChocoPhlAn or UniRef database would take longer than
+    many of the samples it is used for, so only the relative path, size and
+    the first and last chunk of every file are hashed.
+    """
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+    else:
+        walk = os.walk(path)
+    for root, dirs, files in walk:
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            size = os.path.getsize(file_path)
+            digest.update(os.path.relpath(file_path, path).encode())
+            digest.update(str(size).encode())
+            with open(file_path, "rb") as fh:
+                digest.update(fh.read(_CHUNK_SIZE))
+                if size > _CHUNK_SIZE:
+                    fh.seek(max(size - _CHUNK_SIZE, _CHUNK_SIZE))
+                    digest.update(fh.read(_CHUNK_SIZE))
+    return digest.hexdigest()
+
+
+def _database_identity(path: str) -> str:
+    """
+    Identify a database artifact by its UUID, falling back to a fingerprint
+    of its contents when the path does not come from a QIIME 2 archive.
+    """
+    uuids = _UUID_PATTERN.findall(os.path.abspath(path))
+    if uuids:
+        return uuids[-1]
+    return _fingerprint_directory(path)
+
+
+def _run_context(
+    database_paths: Iterable[str],
+    bowtie_database_path: str,
+    memory_use: str,
+    metaphlan_options: str,
+) -> str:
+    """
+    Combine every run-wide input that influences a sample's profile.
+
+    Artifact paths change between invocations, so they are replaced by the
+    identity of the artifact they point at.
+    """
+    bowtie_identity, metaphlan_options = _metaphlan_identity(
+        bowtie_database_path, metaphlan_options
+    )
+    parts = [_database_identity(p) for p in database_paths]
+    parts += [bowtie_identity, memory_use, metaphlan_options]
+    return "\n".join(parts)
+
+
+def _metaphlan_identity(
+    bowtie_database_path: str, metaphlan_options: str
+) -> Tuple[str, str]:
+    """The identity of the MetaPhlAn database and the options it runs with"""
+    bowtie_identity = _database_identity(bowtie_database_path)
+    metaphlan_options = metaphlan_options.replace(bowtie_database_path, bowtie_identity)
+    return bowtie_identity, _NPROC_PATTERN.sub("", metaphlan_options)
+
+
+def _taxonomy_context(bowtie_database_path: str, metaphlan_options: str) -> str:
+    """
+    Combine every run-wide input that influences a sample's MetaPhlAn
+    profile, which is unaffected by the humann3 databases and memory use.
+    """
+    return "\n".join(
+        ("metaphlan",) + _metaphlan_identity(bowtie_database_path, metaphlan_options)
+    )
+
+
+def _hash_reads(sequence_sample_paths: List[str]) -> List[str]:
+    """The sha256 hex digest of every FASTQ file of a sample."""
+    return [_hash_file(path) for path in sequence_sample_paths]
+
+
+def _sample_cache_key(read_digests: List[str], sample_name: str, context: str) -> str:
+    """
+    Return the cache key of one sample profiled under ``context``, from the
+    digests ``_hash_reads`` gives for its reads, so that the keys of several
+    contexts are derived from a single pass over the reads.
+    """
+    digest = hashlib.sha256()
+    digest.update(context.encode())
+    digest.update(sample_name.encode())
+    for read_digest in read_digests:
+        digest.update(read_digest.encode())
+    return digest.hexdigest()
+
+
+class _SampleCache:
+    """
+    Content-addressed store of per-sample humann3 outputs.
+
+    Every entry is a directory named after the sample's cache key holding the
+    per-sample tables under the same relative paths humann3 wrote them to.
+    Entries are written to a temporary directory first and renamed into
+    place, so an interrupted run never leaves a partial entry behind.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache entries, created if missing
+    max_size : float, optional
+        Size in GB above which the least recently used entries are evicted
+    """
+
+    def __init__(self, cache_dir: str, max_size: Optional[float] = None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key: str, output: str) -> bool:
+        """Copy a cached entry into ``output``, returning whether it existed."""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        shutil.copytree(entry, output, dirs_exist_ok=True)
+        # mark as recently used for eviction
+        os.utime(entry)
+        return True
+
+    def store(
+        self, key: str, output: str, suffixes: Tuple[str, ...] = _CACHED_OUTPUTS
+    ) -> None:
+        """Store the per-sample outputs found under ``output``."""
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+
+        staging = tempfile.mkdtemp(prefix=".%s-" % key, dir=self.cache_dir)
+        try:
+            for root, _, files in os.walk(output):
+                for name in files:
+                    if not name.endswith(suffixes):
+                        continue
+                    source = os.path.join(root, name)
+                    target = os.path.join(staging, os.path.relpath(source, output))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copy2(source, target)
+            os.rename(staging, entry)
+        except OSError:
+            # another process stored the same sample first
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+
+    def evict(self) -> None:
+        """Remove least recently used entries until under ``max_size``."""
+        if self.max_size is None:
+            return
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = self._entry(name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(root, f))
+                for root, _, files in os.walk(entry)
+                for f in files
+            )
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        budget = self.max_size * 1024**3
+        for _, size, entry in sorted(entries):
+            if total <= budget:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -1,13 +1,20 @@
 import itertools
+import re
 
 from q2_types.bowtie2 import Bowtie2IndexFileFormat
 from q2_types.per_sample_sequences import FastqGzFormat
-from qiime2.plugin import model
+from qiime2.plugin import ValidationError, model
+
+from q2_humann3._validation import (CHECKSUMS, _check_bowtie2_index,
+                                    _check_database, _check_header)
 
 
 class HumannDbFileFormat(model.BinaryFileFormat):
     def _validate_(self, *args):
-        pass
+        try:
+            _check_header(str(self))
+        except ValueError as error:
+            raise ValidationError(str(error))
 
 
 class HumannDbDirFormat(model.DirectoryFormat):
@@ -18,6 +25,14 @@ class HumannDbDirFormat(model.DirectoryFormat):
 
         return file
 
+    def _validate_(self, level):
+        # every file is read in full, so only on a thorough validation
+        if level == "max":
+            try:
+                _check_database(str(self))
+            except ValueError as error:
+                raise ValidationError(str(error))
+
 
 HumannDBSingleFileDirFormat = model.SingleFileDirectoryFormat(
     "HumannDBSingleFileDirFormat", "mapping.gz", HumannDbFileFormat
@@ -30,6 +45,68 @@ HumannDBSingleReferenceFileDirFormat = model.SingleFileDirectoryFormat(
 # TODO: make this generic for single file humann3
 
 
+class HumannProfileFileFormat(model.BinaryFileFormat):
+    def _validate_(self, *args):
+        pass
+
+
+class HumannProfilesDirFormat(model.DirectoryFormat):
+    """
+    Per-sample humann3 tables and MetaPhlAn profile, one directory each.
+    Empty for a shard no sample is hashed to.
+    """
+
+    profiles = model.FileCollection(
+        r".+/.+_(genefamilies|pathabundance|pathcoverage)\.biom"
+        r"|.+/.+_metaphlan_bugs_list\.tsv",
+        format=HumannProfileFileFormat,
+        optional=True,
+    )
+
+    @profiles.set_path_maker
+    def profiles_path_maker(self, sample_id, name):
+        return "%s/%s" % (sample_id, name)
+
+
+class HumannAlignmentFileFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        with self.open() as fh:
+            if fh.read(2) != b"\x1f\x8b":
+                raise ValidationError("%s is not gzip compressed" % self.path.name)
+
+
+class HumannAlignmentsDirFormat(model.DirectoryFormat):
+    """
+    Per-sample gzipped humann3 alignment intermediates and MetaPhlAn
+    profile, one directory each
+    """
+
+    alignments = model.FileCollection(
+        r".+/.+\.gz", format=HumannAlignmentFileFormat, optional=True
+    )
+
+    @alignments.set_path_maker
+    def alignments_path_maker(self, sample_id, name):
+        return "%s/%s" % (sample_id, name)
+
+
+class HumannReportFormat(model.TextFileFormat):
+    """Tab separated report with one row per id"""
+
+    def _validate_(self, level):
+        with self.open() as fh:
+            header = fh.readline().rstrip("\n").split("\t")
+        if header[0] != "id":
+            raise ValidationError(
+                "The first column of a report must be named 'id', found %r" % header[0]
+            )
+
+
+HumannReportDirFormat = model.SingleFileDirectoryFormat(
+    "HumannReportDirFormat", "report.tsv", HumannReportFormat
+)
+
+
 class Bowtie2IndexDirFmt2(model.DirectoryFormat):
     idx1 = model.File(r".+(?<!\.rev)\.1\.bt2l", format=Bowtie2IndexFileFormat)
     idx2 = model.File(r".+(?<!\.rev)\.2\.bt2l", format=Bowtie2IndexFileFormat)
@@ -37,10 +114,23 @@ class Bowtie2IndexDirFmt2(model.DirectoryFormat):
     ref4 = model.File(r".+\.4\.bt2l", format=Bowtie2IndexFileFormat)
     rev1 = model.File(r".+\.rev\.1\.bt2l", format=Bowtie2IndexFileFormat)
     rev2 = model.File(r".+\.rev\.2\.bt2l", format=Bowtie2IndexFileFormat)
-    pkl = model.File(r".+\.pkl?", format=Bowtie2IndexFileFormat)
+    pkl = model.File(r".+\.pkl?", format=HumannDbFileFormat)
+    checksums = model.File(
+        re.escape(CHECKSUMS), format=HumannDbFileFormat, optional=True
+    )
+
+    def _validate_(self, level):
+        try:
+            _check_bowtie2_index(str(self))
+            if level == "max":
+                _check_database(str(self))
+        except ValueError as error:
+            raise ValidationError(str(error))
 
     def get_basename(self):
-        paths = [str(x.relative_to(self.path)) for x in self.path.iterdir()]
+        paths = [
+            str(x.relative_to(self.path)) for x in self.path.iterdir() if x.name != CHECKSUMS
+        ]
         prefix = _get_prefix(paths)
         return prefix[:-1]  # trim trailing '.'
 
@@ -1,22 +1,43 @@
+import contextlib
 import os
+import resource
+import shutil
+import signal
 import subprocess
 import tempfile
+import time
 from functools import partial
-from glob import glob
-from multiprocessing import Pool
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
 import biom
-from q2_types.feature_table import BIOMV210Format
-from q2_types.per_sample_sequences import (
-    FastqGzFormat, SingleLanePerSampleSingleEndFastqDirFmt)
+import pandas as pd
+from q2_types.per_sample_sequences import SingleLanePerSamplePairedEndFastqDirFmt
 
 from q2_humann3._format import (Bowtie2IndexDirFmt2, HumannDbDirFormat,
+                                HumannAlignmentsDirFormat,
                                 HumannDBSingleFileDirFormat,
-                                HumannDBSingleReferenceFileDirFormat)
+                                HumannDBSingleReferenceFileDirFormat,
+                                HumannProfilesDirFormat)
 
+# QIIME 2 imports this module to register the actions of every plugin,
+# even for commands that never run them, so only what the signatures need
+# is imported here and the implementation when an action runs
+if TYPE_CHECKING:
+    from q2_humann3._cache import _SampleCache
+    from q2_humann3._merge import _SampleAggregator
+    from q2_humann3._metrics import _RunMetrics
 
-def _single_sample(
+
+def _mapping_file(path: str) -> str:
+    """The file of a single file database artifact, or the file itself"""
+    if os.path.isfile(path):
+        return path
+    return os.path.join(path, "mapping.gz")
+
+
+async def _single_sample(
     sequence_sample_path: str,
+    sample_name: str,
     nucleotide_database_path: str,
     protein_database_path: str,
     pathway_database_path: str,
@@ -25,13 +46,28 @@ def _single_sample(
     memory_use: str,
     metaphlan_options: str,
     output: str,
-) -> None:
+    timeout: Optional[float] = None,
+    taxonomic_profile: Optional[str] = None,
+    resume: bool = False,
+    on_output: Optional[Callable[[str], None]] = None,
+) -> resource.struct_rusage:
+    """
+    Run humann3 on one sample, passing every line it prints to
+    ``on_output``, and return its resource usage.
+    """
+    import asyncio
+
+    from q2_humann3._metrics import _wait_with_usage
+    from q2_humann3._progress import _stream_lines
+
     cmd = [
         "humann3",
         "-i",
         sequence_sample_path,
         "-o",
         output,
+        "--output-basename",
+        sample_name,
         "--threads",
         str(threads),
         "--memory-use",
@@ -46,62 +82,176 @@ def _single_sample(
         protein_database_path,
         "--pathways-database",
         "{},{}".format(
-            os.path.join(pathway_mapping_path, "mapping.gz"),
-            os.path.join(pathway_database_path, "mapping.gz"),
+            _mapping_file(pathway_mapping_path),
+            _mapping_file(pathway_database_path),
         ),
         "--metaphlan-options",
         metaphlan_options,
     ]
-    subprocess.run(cmd, check=True)
+    if taxonomic_profile:
+        # humann3 skips its MetaPhlAn prescreen for a given profile
+        cmd.extend(["--taxonomic-profile", taxonomic_profile])
+    if resume:
+        # skip the stages whose outputs are already in the temporary directory
+        cmd.append("--resume")
+    # humann3 runs bowtie2 and diamond as children, so give it its own
+    # process group that can be killed as a whole on timeout or cancellation
+    process = subprocess.Popen(
+        cmd, start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output = asyncio.ensure_future(_stream_lines(process.stdout, on_output or print))
+    try:
+        returncode, usage = await _wait_with_usage(process, timeout)
+        await output
+    except BaseException:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        output.cancel()
+        raise
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return usage
 
 
-def _join_taxa_tables(input_dir_path: str, output_path: str):
-    # I was not able to get custom output names to work from metaphlan
-    # so we're looking for the default names
-    taxa_tables = glob(f"{input_dir_path}/**/*metaphlan_bugs*", recursive=True)
-    cmd = ["merge_metaphlan_tables.py"] + taxa_tables
-    with open(output_path, "w") as outfile:
-        subprocess.run(cmd, stdout=outfile)
-        subprocess.run(cmd, check=True)
+async def _profile_sample(
+    sample_name: str,
+    sequence_sample_paths: List[str],
+    output: str,
+    threads: int,
+    cache: Optional["_SampleCache"] = None,
+    cache_context: str = "",
+    taxonomy: Optional[biom.Table] = None,
+    taxonomy_context: str = "",
+    database_version: str = "",
+    reuse_outputs: bool = True,
+    resume_from: Optional[str] = None,
+    stage: str = "pathways",
+    **kwargs,
+) -> Optional[resource.struct_rusage]:
+    """
+    Run a single sample into its own directory under ``output``, reusing its
+    cached outputs when the same sample was profiled before, unless
+    ``reuse_outputs`` is false.
 
+    The MetaPhlAn profile is taken from ``taxonomy`` when the sample is in
+    it, or from the cache when the sample was profiled with the same
+    MetaPhlAn database and options before, so humann3 does not run its
+    prescreen again.
 
-def _join_tables(table: str, output: str, name: str) -> None:
-    """Merge multiple sample output into single tables"""
-    tmp_output = output + "-actual"
-    cmd = [
-        "humann_join_tables",
-        "-i",
-        table,
-        "-o",
-        tmp_output,
-        "--file_name",
-        "%s" % name,
-    ]
+    With ``resume_from``, the alignment intermediates kept for the sample
+    are restored and humann3 resumes from them, recomputing only ``stage``
+    and what follows it.
 
-    subprocess.run(cmd, check=True)
+    Returns the resource usage of humann3, or None for a cached sample.
+    """
+    from q2_humann3._alignments import _restore_alignments
+    from q2_humann3._cache import _hash_file, _hash_reads, _sample_cache_key
+    from q2_humann3._merge import (METAPHLAN_PROFILE_SUFFIX, _table_profile,
+                                   _write_metaphlan_profile)
+    from q2_humann3._reads import _sample_reads
+    from q2_humann3._scheduler import _in_thread
 
-    # doing convert manually as we need to filter out the leading comment as
-    # humann2_renorm_table cannot handle comment lines
-    for_convert = biom.load_table(tmp_output)
-    lines = for_convert.to_tsv().splitlines()
-    lines = lines[1:]  # drop leading comment
-    with open(output, "w") as fp:
-        fp.write("\n".join(lines))
-        fp.write("\n")
+    sample_output = os.path.join(output, sample_name)
+    os.makedirs(sample_output, exist_ok=True)
 
+    profile = os.path.join(sample_output, sample_name + METAPHLAN_PROFILE_SUFFIX)
+    supplied = taxonomy is not None and taxonomy.exists(sample_name)
+    if supplied:
+        _write_metaphlan_profile(
+            profile, database_version, *_table_profile(taxonomy, sample_name)
+        )
+    elif resume_from is not None:
+        supplied = (
+            await _in_thread(
+                _restore_alignments, sample_name, resume_from, sample_output, stage, threads
+            )
+            is not None
+        )
 
-def _renorm(table: str, method: str, output: str) -> None:
-    """Renormalize a table"""
-    cmd = [
-        "humann_renorm_table",
-        "-i",
-        "%s" % table,
-        "-o",
-        "%s" % output,
-        "-u",
-        "%s" % method,
-    ]
-    subprocess.run(cmd, check=True)
+    if cache is not None:
+        if supplied:
+            # the outputs depend on the profile given instead of the reads
+            cache_context += "\n" + await _in_thread(_hash_file, profile)
+        # hashing the reads takes minutes for large samples, off the loop
+        read_digests = await _in_thread(_hash_reads, sequence_sample_paths)
+        key = _sample_cache_key(read_digests, sample_name, cache_context)
+        if reuse_outputs and await _in_thread(cache.fetch, key, sample_output):
+            return None
+        taxonomy_key = _sample_cache_key(read_digests, sample_name, taxonomy_context)
+
+    if not supplied and (
+        cache is None or not await _in_thread(cache.fetch, taxonomy_key, sample_output)
+    ):
+        profile = None
+
+    try:
+        reads = await _in_thread(
+            _sample_reads, sequence_sample_paths, sample_output, sample_name, threads
+        )
+        usage = await _single_sample(
+            reads,
+            sample_name,
+            output=sample_output,
+            threads=threads,
+            taxonomic_profile=profile,
+            resume=resume_from is not None,
+            **kwargs,
+        )
+    except BaseException:
+        # leave nothing behind for the joins or a retry to pick up
+        shutil.rmtree(sample_output, ignore_errors=True)
+        raise
+    if reads not in sequence_sample_paths:
+        os.remove(reads)
+
+    if cache is not None:
+        await _in_thread(cache.store, key, sample_output)
+        if profile is None:
+            await _in_thread(
+                cache.store,
+                taxonomy_key,
+                os.path.join(sample_output, sample_name + "_humann_temp"),
+                (METAPHLAN_PROFILE_SUFFIX,),
+            )
+    return usage
+
+
+def _temporary_directory(working_dir: Optional[str] = None) -> tempfile.TemporaryDirectory:
+    """A temporary directory under ``working_dir``, which is created if needed"""
+    if working_dir:
+        os.makedirs(working_dir, exist_ok=True)
+    return tempfile.TemporaryDirectory(dir=working_dir)
+
+
+def _remove_humann_temp(sample_name: str, sample_output: str) -> None:
+    """
+    Remove the humann3 temporary directory of a sample, which holds its
+    alignments, keeping only the MetaPhlAn profile that is folded next.
+    """
+    from q2_humann3._merge import METAPHLAN_PROFILE_SUFFIX
+
+    temp = os.path.join(sample_output, sample_name + "_humann_temp")
+    profile = os.path.join(temp, sample_name + METAPHLAN_PROFILE_SUFFIX)
+    if os.path.exists(profile):
+        os.replace(profile, os.path.join(sample_output, os.path.basename(profile)))
+    shutil.rmtree(temp, ignore_errors=True)
+
+
+def _bowtie_index_name(bowtie2db: str) -> str:
+    """Name of the MetaPhlAn bowtie2 index, which is its database version"""
+    from q2_humann3._validation import CHECKSUMS
+
+    index_name = {e.split(".")[0] for e in os.listdir(bowtie2db) if e != CHECKSUMS}
+    if len(index_name) != 1:
+        raise ValueError(
+            "The index files in the Bowtie database are not named in a"
+            " consistent fashion. Check that all files in the bowtie"
+            " database have the same base name."
+        )
+
+    (index_name,) = index_name
+    return index_name
 
 
 def _metaphlan_options(bowtie2db: str, stat_q: float, humann3_threads: int = 1) -> str:
@@ -115,127 +265,681 @@ def _metaphlan_options(bowtie2db: str, stat_q: float, humann3_threads: int = 1)
         directory containing the bowtie2 executable
     stat_q : float
         Quantile value for the robust average
+    humann3_threads : int
+        Threads of the sample, which MetaPhlAn uses too
     """
     # TODO: The index needs to be set programmatically
-    index_name = {e.split(".")[0] for e in os.listdir(bowtie2db)}
-    if len(index_name) != 1:
-        raise ValueError(
-            "The index files in the Bowtie database are not named in a"
-            " consistent fashion. Check that all files in the bowtie"
-            " database have the same base name."
-        )
-
-    (index_name,) = index_name
+    index_name = _bowtie_index_name(bowtie2db)
     metaphlan_string = f"--offline --bowtie2db {bowtie2db} --index {index_name} --stat_q {stat_q} --add_viruses --unclassified_estimation"
-    # Humann3 defaults to 4 threads, when 1 thread is specified, so we're forcing it to 1 here
-    # Otherwise is should not be specified
-    if humann3_threads == 1:
-        metaphlan_string += " --nproc 1"
+    # MetaPhlAn defaults to 4 processes and humann3 only passes its own
+    # --threads on above 1, so always match the sample's threads
+    metaphlan_string += f" --nproc {humann3_threads}"
     return metaphlan_string
 
 
+def _profile_samples(
+    samples: Dict[str, List[str]],
+    on_profiled: Callable[[str, str], None],
+    metrics: "_RunMetrics",
+    nucleotide_database: HumannDbDirFormat,
+    protein_database: HumannDbDirFormat,
+    pathway_database: HumannDBSingleFileDirFormat,
+    pathway_mapping: HumannDBSingleFileDirFormat,
+    bowtie_database: Bowtie2IndexDirFmt2,
+    taxonomic_profiles: biom.Table = None,
+    n_parallel_samples: int = 1,
+    humann3_threads: int = 1,
+    memory_use: str = "minimum",
+    metaphlan_stat_q: float = 0.2,
+    cache_dir: str = None,
+    cache_max_size: float = None,
+    max_memory: float = None,
+    max_cpus: int = None,
+    adaptive_threads: bool = False,
+    retries: int = 0,
+    sample_timeout: float = None,
+    skip_failed: bool = False,
+    staging_dir: str = None,
+    prewarm_databases: bool = False,
+    working_dir: str = None,
+    alignments: str = None,
+    resume_from: str = None,
+    stage: str = "pathways",
+) -> pd.DataFrame:
+    """
+    Run every sample through humann3 under the given budget.
+
+    ``samples`` maps each sample ID to its FASTQ files, the forward and
+    reverse reads of paired-end samples are profiled together.
+    ``on_profiled(sample_name, sample_output)`` is called from a worker
+    thread for each sample that succeeds, before its output directory is
+    removed. Every humann3 process is supervised from one event loop,
+    which reports the progress of the samples. The alignment intermediates
+    of every sample are kept in the directory ``alignments`` when it is
+    given, and restored from ``resume_from`` to recompute only ``stage``
+    onwards. The other parameters are those of ``run``.
+
+    Returns
+    -------
+    pd.DataFrame
+        The samples that failed, with their attempts and last error
+    """
+    from q2_humann3._alignments import _keep_alignments
+    from q2_humann3._cache import _run_context, _SampleCache, _taxonomy_context
+    from q2_humann3._progress import _Progress
+    from q2_humann3._scheduler import (_in_thread, _run_scheduled,
+                                       _SampleScheduler)
+    from q2_humann3._staging import _stage_database
+
+    nucleotide_database_path = str(nucleotide_database)
+    protein_database_path = str(protein_database)
+    bowtie_database_path = str(bowtie_database)
+    if staging_dir:
+        nucleotide_database_path, protein_database_path, bowtie_database_path = (
+            _stage_database(path, staging_dir, prewarm_databases)
+            for path in (
+                nucleotide_database_path,
+                protein_database_path,
+                bowtie_database_path,
+            )
+        )
+
+    with _temporary_directory(working_dir) as tmp:
+
+        metaphlan_options = _metaphlan_options(
+            bowtie_database_path,
+            metaphlan_stat_q,
+            humann3_threads,
+        )
+
+        cache = None
+        cache_context = ""
+        taxonomy_context = ""
+        if cache_dir:
+            cache = _SampleCache(cache_dir, cache_max_size)
+            cache_context = _run_context(
+                [
+                    nucleotide_database_path,
+                    protein_database_path,
+                    str(pathway_database),
+                    str(pathway_mapping),
+                ],
+                bowtie_database_path,
+                memory_use,
+                metaphlan_options,
+            )
+            taxonomy_context = _taxonomy_context(bowtie_database_path, metaphlan_options)
+
+        profile_sample = partial(
+            _profile_sample,
+            cache=cache,
+            cache_context=cache_context,
+            taxonomy=taxonomic_profiles,
+            taxonomy_context=taxonomy_context,
+            database_version=_bowtie_index_name(bowtie_database_path),
+            # cached samples have no alignments left to keep
+            reuse_outputs=alignments is None,
+            resume_from=resume_from,
+            stage=stage,
+            protein_database_path=protein_database_path,
+            nucleotide_database_path=nucleotide_database_path,
+            pathway_database_path=str(pathway_database),
+            pathway_mapping_path=str(pathway_mapping),
+            memory_use=memory_use,
+            output=tmp,
+            timeout=None if sample_timeout is None else sample_timeout * 3600,
+        )
+
+        progress = _Progress(
+            {
+                sample_name: sum(os.path.getsize(path) for path in paths)
+                for sample_name, paths in samples.items()
+            }
+        )
+
+        def finish_sample(sample_name: str, sample_output: str, threads: int, usage) -> None:
+            if usage is not None:
+                metrics.record_humann_log(
+                    sample_name,
+                    os.path.join(
+                        sample_output, sample_name + "_humann_temp", sample_name + ".log"
+                    ),
+                )
+                if alignments is not None:
+                    with metrics.measure(sample_name, "keep alignments"):
+                        _keep_alignments(sample_name, sample_output, alignments, threads)
+                _remove_humann_temp(sample_name, sample_output)
+
+            on_profiled(sample_name, sample_output)
+            shutil.rmtree(sample_output)
+
+        async def scheduled_single_sample(sample_name: str, threads: int) -> None:
+            sample_output = os.path.join(tmp, sample_name)
+
+            start = time.perf_counter()
+            progress.start(sample_name)
+            try:
+                usage = await profile_sample(
+                    sample_name,
+                    samples[sample_name],
+                    threads=threads,
+                    metaphlan_options=_metaphlan_options(
+                        bowtie_database_path, metaphlan_stat_q, threads
+                    ),
+                    on_output=partial(progress.output, sample_name),
+                )
+                if usage is None:
+                    metrics.record(
+                        sample_name, "cached", wall_time=time.perf_counter() - start
+                    )
+                else:
+                    metrics.record_process(
+                        sample_name, "humann3", time.perf_counter() - start, usage
+                    )
+                await _in_thread(finish_sample, sample_name, sample_output, threads, usage)
+            except BaseException:
+                progress.finish(sample_name, succeeded=False)
+                raise
+            progress.finish(sample_name)
+
+        max_threads = None
+        if max_memory is None and max_cpus is None and not adaptive_threads:
+            # without a budget keep the fixed samples x threads layout, even
+            # when fewer samples than n_parallel_samples are left to run
+            max_cpus = n_parallel_samples * humann3_threads
+            max_threads = humann3_threads
+        elif max_cpus is None:
+            max_cpus = os.cpu_count()
+
+        scheduler = _SampleScheduler(
+            samples, memory_use, max_memory, max_cpus, humann3_threads, adaptive_threads,
+            max_threads,
+        )
+        failed = _run_scheduled(scheduler, scheduled_single_sample, retries)
+        failures = pd.DataFrame(
+            [(",".join(f.paths), f.attempts, f.error) for f in failed],
+            index=pd.Index([f.sample for f in failed], name="id"),
+            columns=["path", "attempts", "error"],
+        )
+        if failed and (len(failed) == len(samples) or not skip_failed):
+            raise RuntimeError(
+                "%d of %d samples failed:\n%s"
+                % (len(failed), len(samples), failures.to_string())
+            )
+
+        if cache is not None:
+            cache.evict()
+
+    return failures
+
+
+def _final_table(
+    aggregator: "_SampleAggregator", name: str, metrics: "_RunMetrics"
+) -> biom.Table:
+    """Merge one table of every profiled sample, renormalized and pruned as folded"""
+    with metrics.measure("", "merge %s" % name):
+        return aggregator.table(name)
+
+
+def _final_tables(
+    aggregator: "_SampleAggregator", metrics: "_RunMetrics"
+) -> Tuple[biom.Table, biom.Table, biom.Table, biom.Table]:
+    """Merge the tables of every profiled sample"""
+    return tuple(
+        _final_table(aggregator, name, metrics)
+        for name in ("genefamilies", "pathcoverage", "pathabundance", "taxonomy")
+    )
+
+
 def run(
-    demultiplexed_seqs: SingleLanePerSampleSingleEndFastqDirFmt,
+    demultiplexed_seqs: SingleLanePerSamplePairedEndFastqDirFmt,
     nucleotide_database: HumannDbDirFormat,
     protein_database: HumannDbDirFormat,
     pathway_database: HumannDBSingleFileDirFormat,
     pathway_mapping: HumannDBSingleFileDirFormat,
     bowtie_database: Bowtie2IndexDirFmt2,
+    taxonomic_profiles: biom.Table = None,
     n_parallel_samples: int = 1,
     humann3_threads: int = 1,
     memory_use: str = "minimum",
     metaphlan_stat_q: float = 0.2,
-) -> (biom.Table, biom.Table, biom.Table, biom.Table):  # type:  ignore
+    cache_dir: str = None,
+    cache_max_size: float = None,
+    max_memory: float = None,
+    max_cpus: int = None,
+    adaptive_threads: bool = False,
+    retries: int = 0,
+    sample_timeout: float = None,
+    skip_failed: bool = False,
+    staging_dir: str = None,
+    prewarm_databases: bool = False,
+    working_dir: str = None,
+    keep_alignments: bool = False,
+    stratification: str = "both",
+    min_abundance: float = 0.0,
+    min_prevalence: float = 0.0,
+    top_features: int = None,
+) -> (biom.Table, biom.Table, biom.Table, biom.Table, pd.DataFrame, pd.DataFrame, HumannAlignmentsDirFormat):  # type:  ignore
     """
     Run samples through humann3.
 
     Parameters
     ----------
-    samples : SingleLanePerSampleSingleEndFastqDirFmt
-        Samples to process
-    threads : int, optional
-        The number of threads that humann3 should use
+    demultiplexed_seqs : SingleLanePerSamplePairedEndFastqDirFmt
+        Single or paired-end samples to process, the reads of a pair are
+        profiled together
+    taxonomic_profiles : biom.Table, optional
+        MetaPhlAn profiles of some or all samples, used instead of running
+        MetaPhlAn for those samples
+    n_parallel_samples : int, optional
+        The number of samples to run at once when no budget is given
+    humann3_threads : int, optional
+        The number of threads that humann3 should use, the minimum per sample
+        when a budget is given
     memory_use : str, optional
         The amount of memory to use, default is minimum
     metaphlan_stat_q : float, optional
         Quantile value for the robust average, for Metaphlan, default is 0.2
+    cache_dir : str, optional
+        Directory of per-sample results to reuse between runs, by default
+        nothing is cached
+    cache_max_size : float, optional
+        Size of the cache in GB above which the least recently used samples
+        are evicted, by default the cache is unbounded
+    max_memory : float, optional
+        Memory budget in GB shared by the samples running at once
+    max_cpus : int, optional
+        CPU budget shared by the samples running at once, defaults to all
+        CPUs when only max_memory or adaptive_threads is given
+    adaptive_threads : bool, optional
+        Give each sample threads in proportion to its size, and the CPUs
+        no queued sample can use to the last samples started
+    retries : int, optional
+        How many times a failed sample is run again
+    sample_timeout : float, optional
+        Hours after which a sample's humann3 process is killed
+    skip_failed : bool, optional
+        Return the samples that succeeded instead of raising when some fail
+    staging_dir : str, optional
+        Node-local directory to copy the nucleotide, protein and bowtie2
+        databases to before running
+    prewarm_databases : bool, optional
+        Load the staged databases into the page cache before running
+    working_dir : str, optional
+        Directory for the per-sample humann3 outputs and the folded values
+        of the merged tables, by default the system temporary directory
+    keep_alignments : bool, optional
+        Keep the compressed alignment intermediates of every sample for
+        ``resume_from_alignments``, samples are not taken from the cache
+    stratification : str, optional
+        Keep both, only the stratified or only the unstratified rows of the
+        gene family and pathway tables
+    min_abundance : float, optional
+        Relative abundance in its sample below which a gene family or
+        pathway abundance is dropped while merging
+    min_prevalence : float, optional
+        Fraction of the samples a gene family or pathway must be kept in
+    top_features : int, optional
+        How many gene families and pathways to keep, those with the highest
+        total relative abundance, by default all of them
 
     Notes
     -----
     This command consumes per-sample FASTQs, and takes those data through
-    "humann3", then through "humann3_join_tables" and finalizes with
-    "humann3_renorm_table".
+    "humann3", then joins and renormalizes the per-sample tables.
 
     Returns
     -------
     biom.Table
-        A gene families table normalized using "cpm"
+        A gene families table normalized by relative abundance
     biom.Table
-        A pathway coverage table normalized by relative abundance
+        A pathway coverage table
     biom.Table
         A pathway abundance table normalized by relative abundance
+    biom.Table
+        A taxonomic profile
+    pd.DataFrame
+        The samples that failed, with their attempts and last error
+    pd.DataFrame
+        Wall time, CPU time, peak memory and I/O of each sample and stage
+    HumannAlignmentsDirFormat
+        The alignment intermediates of each sample, empty unless
+        keep_alignments
     """
-    with tempfile.TemporaryDirectory() as tmp:
+    from q2_humann3._merge import _Pruning, _SampleAggregator
+    from q2_humann3._metrics import _RunMetrics
+    from q2_humann3._reads import _manifest_reads
 
-        metaphlan_options = _metaphlan_options(
-            str(bowtie_database),
-            metaphlan_stat_q,
-            humann3_threads,
-        )
+    pruning = _Pruning(min_abundance, min_prevalence, top_features, stratification)
+    metrics = _RunMetrics()
+    alignments = HumannAlignmentsDirFormat()
 
-        threaded_single_sample = partial(
-            _single_sample,
-            protein_database_path=str(protein_database),
-            nucleotide_database_path=str(nucleotide_database),
-            pathway_database_path=str(pathway_database),
-            pathway_mapping_path=str(pathway_mapping),
-            threads=humann3_threads,
+    with _temporary_directory(working_dir) as merged:
+        aggregator = _SampleAggregator(merged, pruning)
+
+        def fold(sample_name: str, sample_output: str) -> None:
+            # fold the sample into the merged tables while others still run
+            with metrics.measure(sample_name, "fold"):
+                aggregator.add(sample_output)
+
+        failures = _profile_samples(
+            _manifest_reads(demultiplexed_seqs),
+            fold,
+            metrics,
+            nucleotide_database=nucleotide_database,
+            protein_database=protein_database,
+            pathway_database=pathway_database,
+            pathway_mapping=pathway_mapping,
+            bowtie_database=bowtie_database,
+            taxonomic_profiles=taxonomic_profiles,
+            n_parallel_samples=n_parallel_samples,
+            humann3_threads=humann3_threads,
             memory_use=memory_use,
-            metaphlan_options=metaphlan_options,
-            output=tmp,
+            metaphlan_stat_q=metaphlan_stat_q,
+            cache_dir=cache_dir,
+            cache_max_size=cache_max_size,
+            max_memory=max_memory,
+            max_cpus=max_cpus,
+            adaptive_threads=adaptive_threads,
+            retries=retries,
+            sample_timeout=sample_timeout,
+            skip_failed=skip_failed,
+            staging_dir=staging_dir,
+            prewarm_databases=prewarm_databases,
+            working_dir=working_dir,
+            alignments=str(alignments) if keep_alignments else None,
+        )
+        return _final_tables(aggregator, metrics) + (
+            failures,
+            metrics.to_dataframe(),
+            alignments,
         )
 
-        iter_view = [str(e) for _, e in demultiplexed_seqs.sequences.iter_views(FastqGzFormat)]  # type: ignore
 
-        with Pool(processes=n_parallel_samples) as pool:
-            try:
-                pool.map(threaded_single_sample, iter_view)
-            except subprocess.CalledProcessError as e:
-                print(f"Command failed with return code {e.returncode}")
-                print(f"Command output: {e.output}")
-                print(f"Command stderr: {e.stderr}")
-
-        final_tables = {}
-        for (name, method) in [
-            ("genefamilies", "relab"),
-            ("pathcoverage", "relab"),
-            ("pathabundance", "relab"),
-            ("taxonomy", "relab"),
-        ]:
-            joined_path = os.path.join(tmp, "%s.biom" % name)
-            result_path = os.path.join(tmp, "%s.%s.biom" % (name, method))
-
-            if name == "taxonomy":
-                _join_taxa_tables(input_dir_path=tmp, output_path=result_path)
-                final_tables[name] = biom.load_table(result_path)
-            else:
-                _join_tables(table=tmp, output=joined_path, name=name)
-                if name != "pathcoverage":
-                    _renorm(joined_path, method, result_path)
-                    final_tables[name] = biom.load_table(result_path)
-                else:
-                    final_tables[name] = biom.load_table(joined_path)
+def profile_shard(
+    demultiplexed_seqs: SingleLanePerSamplePairedEndFastqDirFmt,
+    nucleotide_database: HumannDbDirFormat,
+    protein_database: HumannDbDirFormat,
+    pathway_database: HumannDBSingleFileDirFormat,
+    pathway_mapping: HumannDBSingleFileDirFormat,
+    bowtie_database: Bowtie2IndexDirFmt2,
+    taxonomic_profiles: biom.Table = None,
+    sample_ids: list = None,
+    n_shards: int = 1,
+    shard_index: int = 0,
+    n_parallel_samples: int = 1,
+    humann3_threads: int = 1,
+    memory_use: str = "minimum",
+    metaphlan_stat_q: float = 0.2,
+    cache_dir: str = None,
+    cache_max_size: float = None,
+    max_memory: float = None,
+    max_cpus: int = None,
+    adaptive_threads: bool = False,
+    retries: int = 0,
+    sample_timeout: float = None,
+    skip_failed: bool = False,
+    staging_dir: str = None,
+    prewarm_databases: bool = False,
+    working_dir: str = None,
+    keep_alignments: bool = False,
+) -> (HumannProfilesDirFormat, pd.DataFrame, pd.DataFrame, HumannAlignmentsDirFormat):  # type: ignore
+    """
+    Run one shard of the samples through humann3 without merging them.
+
+    Parameters
+    ----------
+    sample_ids : list of str, optional
+        Samples of the shard, by default all samples
+    n_shards : int, optional
+        Number of shards the samples are hash partitioned into
+    shard_index : int, optional
+        Which hash partition of the samples this shard runs
 
-    return (
-        final_tables["genefamilies"],
-        final_tables["pathcoverage"],
-        final_tables["pathabundance"],
-        final_tables["taxonomy"],
+    The other parameters are those of ``run``.
+
+    Returns
+    -------
+    HumannProfilesDirFormat
+        The humann3 tables and MetaPhlAn profile of each sample
+    pd.DataFrame
+        The samples that failed, with their attempts and last error
+    pd.DataFrame
+        Wall time, CPU time, peak memory and I/O of each sample and stage
+    HumannAlignmentsDirFormat
+        The alignment intermediates of each sample, empty unless
+        keep_alignments
+    """
+    from q2_humann3._metrics import _RunMetrics
+    from q2_humann3._reads import _manifest_reads
+    from q2_humann3._shard import _keep_profile, _select_shard
+
+    profiles = HumannProfilesDirFormat()
+    metrics = _RunMetrics()
+    alignments = HumannAlignmentsDirFormat()
+
+    failures = _profile_samples(
+        _select_shard(
+            _manifest_reads(demultiplexed_seqs), sample_ids, n_shards, shard_index
+        ),
+        partial(_keep_profile, profiles=str(profiles)),
+        metrics,
+        nucleotide_database=nucleotide_database,
+        protein_database=protein_database,
+        pathway_database=pathway_database,
+        pathway_mapping=pathway_mapping,
+        bowtie_database=bowtie_database,
+        taxonomic_profiles=taxonomic_profiles,
+        n_parallel_samples=n_parallel_samples,
+        humann3_threads=humann3_threads,
+        memory_use=memory_use,
+        metaphlan_stat_q=metaphlan_stat_q,
+        cache_dir=cache_dir,
+        cache_max_size=cache_max_size,
+        max_memory=max_memory,
+        max_cpus=max_cpus,
+        adaptive_threads=adaptive_threads,
+        retries=retries,
+        sample_timeout=sample_timeout,
+        skip_failed=skip_failed,
+        staging_dir=staging_dir,
+        prewarm_databases=prewarm_databases,
+        working_dir=working_dir,
+        alignments=str(alignments) if keep_alignments else None,
     )
+    return profiles, failures, metrics.to_dataframe(), alignments
+
+
+def resume_from_alignments(
+    demultiplexed_seqs: SingleLanePerSamplePairedEndFastqDirFmt,
+    alignments: HumannAlignmentsDirFormat,
+    nucleotide_database: HumannDbDirFormat,
+    protein_database: HumannDbDirFormat,
+    pathway_database: HumannDBSingleFileDirFormat,
+    pathway_mapping: HumannDBSingleFileDirFormat,
+    bowtie_database: Bowtie2IndexDirFmt2,
+    stage: str = "pathways",
+    n_parallel_samples: int = 1,
+    humann3_threads: int = 1,
+    memory_use: str = "minimum",
+    metaphlan_stat_q: float = 0.2,
+    max_memory: float = None,
+    max_cpus: int = None,
+    adaptive_threads: bool = False,
+    retries: int = 0,
+    sample_timeout: float = None,
+    skip_failed: bool = False,
+    staging_dir: str = None,
+    prewarm_databases: bool = False,
+    working_dir: str = None,
+    stratification: str = "both",
+    min_abundance: float = 0.0,
+    min_prevalence: float = 0.0,
+    top_features: int = None,
+) -> (biom.Table, biom.Table, biom.Table, biom.Table, pd.DataFrame, pd.DataFrame):  # type: ignore
+    """
+    Run samples through humann3 again from the alignments a previous run
+    kept, recomputing only the later stages.
+
+    Parameters
+    ----------
+    alignments : HumannAlignmentsDirFormat
+        The alignment intermediates kept by ``run`` or ``profile_shard``,
+        samples without them are profiled from their reads
+    stage : str, optional
+        ``translated`` to run the translated search again, for a new protein
+        database, or ``pathways`` to only recompute the gene families and
+        pathways, for a new pathway database or mapping
+
+    The other parameters are those of ``run``.
+
+    Returns
+    -------
+    biom.Table
+        A gene families table normalized by relative abundance
+    biom.Table
+        A pathway coverage table
+    biom.Table
+        A pathway abundance table normalized by relative abundance
+    biom.Table
+        A taxonomic profile
+    pd.DataFrame
+        The samples that failed, with their attempts and last error
+    pd.DataFrame
+        Wall time, CPU time, peak memory and I/O of each sample and stage
+    """
+    from q2_humann3._alignments import STAGES
+    from q2_humann3._merge import _Pruning, _SampleAggregator
+    from q2_humann3._metrics import _RunMetrics
+    from q2_humann3._reads import _manifest_reads
+
+    if stage not in STAGES:
+        raise ValueError("stage must be one of %s, not %r" % (STAGES, stage))
+    pruning = _Pruning(min_abundance, min_prevalence, top_features, stratification)
+    metrics = _RunMetrics()
+
+    with _temporary_directory(working_dir) as merged:
+        aggregator = _SampleAggregator(merged, pruning)
+
+        def fold(sample_name: str, sample_output: str) -> None:
+            with metrics.measure(sample_name, "fold"):
+                aggregator.add(sample_output)
+
+        failures = _profile_samples(
+            _manifest_reads(demultiplexed_seqs),
+            fold,
+            metrics,
+            nucleotide_database=nucleotide_database,
+            protein_database=protein_database,
+            pathway_database=pathway_database,
+            pathway_mapping=pathway_mapping,
+            bowtie_database=bowtie_database,
+            n_parallel_samples=n_parallel_samples,
+            humann3_threads=humann3_threads,
+            memory_use=memory_use,
+            metaphlan_stat_q=metaphlan_stat_q,
+            max_memory=max_memory,
+            max_cpus=max_cpus,
+            adaptive_threads=adaptive_threads,
+            retries=retries,
+            sample_timeout=sample_timeout,
+            skip_failed=skip_failed,
+            staging_dir=staging_dir,
+            prewarm_databases=prewarm_databases,
+            working_dir=working_dir,
+            resume_from=str(alignments),
+            stage=stage,
+        )
+        return _final_tables(aggregator, metrics) + (
+            failures,
+            metrics.to_dataframe(),
+        )
+
+
+def finalize(
+    profiles: HumannProfilesDirFormat,
+    stratification: str = "both",
+    min_abundance: float = 0.0,
+    min_prevalence: float = 0.0,
+    top_features: int = None,
+    working_dir: str = None,
+) -> (biom.Table, biom.Table, biom.Table, biom.Table):  # type: ignore
+    """
+    Merge the shards of a run into its tables.
+
+    Parameters
+    ----------
+    profiles : list of HumannProfilesDirFormat
+        The profiles of every shard, each sample in only one of them
+    stratification : str, optional
+        Keep both, only the stratified or only the unstratified rows of the
+        gene family and pathway tables
+    min_abundance : float, optional
+        Relative abundance in its sample below which a gene family or
+        pathway abundance is dropped while merging
+    min_prevalence : float, optional
+        Fraction of the samples a gene family or pathway must be kept in
+    top_features : int, optional
+        How many gene families and pathways to keep, those with the highest
+        total relative abundance, by default all of them
+    working_dir : str, optional
+        Directory for the folded values of the merged tables, by default
+        the system temporary directory
+
+    Returns
+    -------
+    biom.Table
+        A gene families table normalized by relative abundance
+    biom.Table
+        A pathway coverage table
+    biom.Table
+        A pathway abundance table normalized by relative abundance
+    biom.Table
+        A taxonomic profile
+    """
+    from q2_humann3._merge import _Pruning, _SampleAggregator
+    from q2_humann3._metrics import _RunMetrics
+    from q2_humann3._shard import _fold_profiles
+
+    pruning = _Pruning(min_abundance, min_prevalence, top_features, stratification)
+    metrics = _RunMetrics()
+    with _temporary_directory(working_dir) as merged:
+        aggregator = _SampleAggregator(merged, pruning)
+        _fold_profiles([str(shard) for shard in profiles], aggregator)
+        return _final_tables(aggregator, metrics)
+
+
+def renorm_table(
+    table: biom.Table,
+    units: str = "relab",
+    mode: str = "community",
+    special: bool = True,
+) -> biom.Table:  # type: ignore
+    """renorm_table.
+
+    Parameters
+    ----------
+    table : biom.Table
+        table
+    units : str
+        units
+    mode : str
+        mode
+    special : bool
+        special
+
+    Returns
+    -------
+    biom.Table
+
+    """
+    from q2_humann3._renorm import _renorm_table
+
+    return _renorm_table(table, units, mode, special)
 
 
 def rename_pathways(
-    table: BIOMV210Format,
+    table: biom.Table,
     name: str = None,
     reference_mapping: HumannDBSingleReferenceFileDirFormat = None,
     simplify: bool = False,
@@ -244,7 +948,7 @@ def rename_pathways(
 
     Parameters
     ----------
-    table : BIOMV210Format
+    table : biom.Table
         table
     name : str
         name
@@ -258,11 +962,13 @@ def rename_pathways(
     biom.Table
 
     """
+    from q2_humann3._rename import _rename_table
+
     return _rename_table(table, name, reference_mapping, simplify)
 
 
 def rename_gene_families(
-    table: BIOMV210Format,
+    table: biom.Table,
     name: str = None,
     reference_mapping: HumannDBSingleReferenceFileDirFormat = None,
     simplify: bool = False,
@@ -271,7 +977,7 @@ def rename_gene_families(
 
     Parameters
     ----------
-    table : BIOMV210Format
+    table : biom.Table
         table
     name : str
         name
@@ -285,58 +991,100 @@ def rename_gene_families(
     biom.Table
 
     """
-    return _rename_table(table, name, reference_mapping, simplify)
-
+    from q2_humann3._rename import _rename_table
 
-# def rename_pathways()
+    return _rename_table(table, name, reference_mapping, simplify)
 
 
-def _rename_table(
-    table: BIOMV210Format,
-    name: str = "",
-    reference_mapping: HumannDBSingleReferenceFileDirFormat = None,
+def rename_tables(
+    tables: biom.Table,
+    names: list = None,
+    reference_mappings: HumannDBSingleReferenceFileDirFormat = None,
     simplify: bool = False,
 ) -> biom.Table:  # type: ignore
-    """_rename_table.
+    """rename_tables.
 
     Parameters
     ----------
-    table : BIOMV210Format
-        table
-    name : str
-        name
-    reference_mapping : HumannDBSingleReferenceFileDirFormat
-        reference_mapping
+    tables : dict of str to biom.Table
+        tables
+    names : list of str
+        names
+    reference_mappings : list of HumannDBSingleReferenceFileDirFormat
+        reference_mappings
     simplify : bool
         simplify
 
+    Returns
+    -------
+    dict of str to biom.Table
+
+    """
+    from q2_humann3._rename import _rename_tables
+
+    return _rename_tables(tables, names, reference_mappings, simplify)
+
+
+def regroup_gene_families(
+    table: biom.Table,
+    groups: str = None,
+    group_mapping: HumannDBSingleFileDirFormat = None,
+    features_first: bool = False,
+    function: str = "sum",
+    ungrouped: bool = True,
+    protected: bool = True,
+) -> biom.Table:  # type: ignore
+    """regroup_gene_families.
+
+    Parameters
+    ----------
+    table : biom.Table
+        table
+    groups : str
+        groups
+    group_mapping : HumannDBSingleFileDirFormat
+        group_mapping
+    features_first : bool
+        features_first
+    function : str
+        function
+    ungrouped : bool
+        ungrouped
+    protected : bool
+        protected
+
     Returns
     -------
     biom.Table
 
     """
-    table_path = str(table)
-    with tempfile.TemporaryDirectory() as tmp:
-        output_path = os.path.join(tmp, "renorm.biom")
-
-        cmd = [
-            "humann_rename_table",
-            "-i",
-            table_path,
-            "-o",
-            output_path,
-        ]
-        if simplify:
-            cmd.append("--simplify")
-
-        if name:
-            cmd.extend(["-n", name])
-
-        if reference_mapping:
-            cmd.extend(
-                ["-c", os.path.join(str(reference_mapping), "reference.txt.bz2")]
-            )
+    from q2_humann3._regroup import _regroup_table
+
+    return _regroup_table(
+        table, groups, group_mapping, features_first, function, ungrouped, protected
+    )
+
 
-        subprocess.run(cmd, check=True)
+def split_stratified(table: biom.Table) -> (biom.Table, biom.Table):  # type: ignore
+    """split_stratified.
+
+    Parameters
+    ----------
+    table : biom.Table
+        table
+
+    Returns
+    -------
+    biom.Table
+        The stratified rows
+    biom.Table
+        The unstratified rows
+
+    """
+    from q2_humann3._split import _split_stratified
+
+    return _split_stratified(table)
+
+
+# def rename_pathways()
 
-        return biom.load_table(output_path)
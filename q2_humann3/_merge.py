@@ -0,0 +1,474 @@
+import os
+import threading
+from dataclasses import dataclass
+from glob import glob
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import biom
+import numpy as np
+from scipy.sparse import coo_matrix
+
+STRATIFICATION_DELIMITER = "|"
+
+STRATIFICATIONS = ("both", "stratified", "unstratified")
+
+METAPHLAN_PROFILE_SUFFIX = "_metaphlan_bugs_list.tsv"
+
+# per-sample tables written by humann3, taxonomy comes from MetaPhlAn
+HUMANN_TABLES = ("genefamilies", "pathcoverage", "pathabundance")
+
+# tables renormalized to relative abundance as their samples are folded
+RENORMALIZED_TABLES = ("genefamilies", "pathabundance")
+
+# humann3 lists these features first in every table it writes
+_SPECIAL_FEATURE_ORDER = {"UNMAPPED": 0, "UNGROUPED": 1, "UNINTEGRATED": 2}
+
+
+def _feature_order(features: Iterable[str]) -> List[str]:
+    """
+    Sort features the way humann3's joined tables are sorted.
+
+    Special features come first, and ``A|x`` is ordered before ``AB`` so
+    that stratified rows follow their community total.
+    """
+    default = len(_SPECIAL_FEATURE_ORDER)
+    features = sorted(features, key=lambda f: f.split(STRATIFICATION_DELIMITER))
+    return sorted(
+        features,
+        key=lambda f: _SPECIAL_FEATURE_ORDER.get(
+            f.split(STRATIFICATION_DELIMITER)[0], default
+        ),
+    )
+
+
+class _ArrayStore:
+    """
+    Append-only one dimensional array, kept in memory or, with a ``path``,
+    appended to a raw file that is memory-mapped back when read.
+    """
+
+    def __init__(self, dtype, path: Optional[str] = None):
+        self._dtype = np.dtype(dtype)
+        self._path = path
+        self._chunks: List[np.ndarray] = []
+        self._size = 0
+        if path is not None:
+            open(path, "wb").close()
+
+    def append(self, values: np.ndarray) -> None:
+        values = np.ascontiguousarray(values, dtype=self._dtype)
+        if self._path is None:
+            self._chunks.append(values)
+        else:
+            with open(self._path, "ab") as fh:
+                values.tofile(fh)
+        self._size += len(values)
+
+    def array(self) -> np.ndarray:
+        """Everything appended so far, in order"""
+        if not self._size:
+            return np.empty(0, dtype=self._dtype)
+        if self._path is None:
+            return np.concatenate(self._chunks)
+        return np.memmap(self._path, dtype=self._dtype, mode="r", shape=(self._size,))
+
+
+@dataclass(frozen=True)
+class _Pruning:
+    """
+    Which values and features of a merged table to keep, applied while the
+    samples are folded so that the unpruned table is never assembled.
+
+    Features are judged by their community total, their ``FEATURE|taxon``
+    rows are kept with it. The UNMAPPED, UNGROUPED and UNINTEGRATED
+    features are always kept.
+
+    Attributes
+    ----------
+    min_abundance : float
+        Relative abundance in its sample below which a value is dropped
+    min_prevalence : float
+        Fraction of the samples a feature must be kept in
+    top_features : int, optional
+        How many features to keep, those with the highest total relative
+        abundance over all samples
+    stratification : str
+        Keep ``both``, only the ``stratified`` or only the ``unstratified``
+        rows
+    """
+
+    min_abundance: float = 0.0
+    min_prevalence: float = 0.0
+    top_features: Optional[int] = None
+    stratification: str = "both"
+
+    def __post_init__(self):
+        if self.stratification not in STRATIFICATIONS:
+            raise ValueError(
+                "stratification must be one of %s, not %r"
+                % (STRATIFICATIONS, self.stratification)
+            )
+        for name in ("min_abundance", "min_prevalence"):
+            if not 0 <= getattr(self, name) <= 1:
+                raise ValueError(
+                    "%s must be between 0 and 1, not %r" % (name, getattr(self, name))
+                )
+        if self.top_features is not None and self.top_features < 1:
+            raise ValueError("top_features must be at least 1, not %r" % self.top_features)
+
+
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    """``array`` padded with zeros to at least ``size``, doubling its length"""
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def _stratified_features(feature_ids: Iterable[str]) -> np.ndarray:
+    return np.fromiter(
+        (STRATIFICATION_DELIMITER in f for f in feature_ids), dtype=bool
+    )
+
+
+def _special_features(feature_ids: Iterable[str]) -> np.ndarray:
+    return np.fromiter(
+        (f.split(STRATIFICATION_DELIMITER)[0] in _SPECIAL_FEATURE_ORDER for f in feature_ids),
+        dtype=bool,
+    )
+
+
+class _TableAccumulator:
+    """
+    Build one sparse feature-by-sample table out of many per-sample tables.
+
+    Features are assigned a row the first time they are seen, so the union
+    of all feature IDs is built incrementally and only non-zero values are
+    kept until ``to_table`` assembles the final matrix. Each sample is
+    reduced to the row indices and values of its non-zero features right
+    away; with a ``spill_dir`` these columns are written there instead of
+    kept in memory.
+
+    With a ``pruning``, values of ``add_table`` are dropped as they are
+    added and the number of samples keeping every feature and its summed
+    abundance are counted, so that ``to_table`` only assembles the
+    features that pass.
+    """
+
+    def __init__(self, spill_dir: Optional[str] = None, pruning: Optional[_Pruning] = None):
+        self._pruning = pruning
+        # samples keeping every row, and its abundance summed over them
+        self._prevalence = np.zeros(0, dtype=np.int64)
+        self._abundance = np.zeros(0, dtype=np.float64)
+        self._features: Dict[str, int] = {}
+        self._samples: Dict[str, int] = {}
+        rows_path = values_path = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            rows_path = os.path.join(spill_dir, "rows.bin")
+            values_path = os.path.join(spill_dir, "values.bin")
+        self._rows = _ArrayStore(np.int32, rows_path)
+        self._values = _ArrayStore(np.float64, values_path)
+        # sample column and number of values of every appended column
+        self._columns: List[Tuple[int, int]] = []
+        self._metadata: Dict[str, dict] = {}
+
+    def _feature_rows(self, feature_ids: Iterable[str]) -> np.ndarray:
+        features = self._features
+        return np.fromiter(
+            (features.setdefault(f, len(features)) for f in feature_ids),
+            dtype=np.int64,
+        )
+
+    def _append(self, sample_id: str, rows: np.ndarray, values: np.ndarray) -> None:
+        column = self._samples.setdefault(sample_id, len(self._samples))
+        self._rows.append(rows)
+        self._values.append(values)
+        self._columns.append((column, len(values)))
+
+    def add(
+        self,
+        sample_id: str,
+        feature_ids: Iterable[str],
+        values: np.ndarray,
+        metadata: Optional[Dict[str, dict]] = None,
+    ) -> None:
+        """Add the abundances, and optionally feature metadata, of one sample."""
+        for feature_id, feature_metadata in (metadata or {}).items():
+            self._metadata.setdefault(feature_id, feature_metadata)
+        rows = self._feature_rows(feature_ids)
+        values = np.asarray(values, dtype=np.float64)
+        nonzero = values != 0
+        self._append(sample_id, rows[nonzero], values[nonzero])
+
+    def add_table(self, table: biom.Table) -> None:
+        """Add every sample of a biom table."""
+        feature_ids = table.ids(axis="observation")
+        rows = self._feature_rows(feature_ids)
+        matrix = table.matrix_data.tocsc()
+        pruning = self._pruning
+        if pruning is not None:
+            self._prevalence = _grow(self._prevalence, len(self._features))
+            self._abundance = _grow(self._abundance, len(self._features))
+            stratified = _stratified_features(feature_ids)
+            special = _special_features(feature_ids)
+
+        for j, sample_id in enumerate(table.ids()):
+            start, end = matrix.indptr[j], matrix.indptr[j + 1]
+            indices, values = matrix.indices[start:end], matrix.data[start:end]
+            if pruning is not None:
+                kept = (values >= pruning.min_abundance) | special[indices]
+                kept &= values != 0
+                # counted before the stratification is dropped, so stratified
+                # rows are judged by their community total even if it is not kept
+                self._prevalence[rows[indices[kept]]] += 1
+                self._abundance[rows[indices[kept]]] += values[kept]
+                if pruning.stratification != "both":
+                    kept &= stratified[indices] == (pruning.stratification == "stratified")
+                indices, values = indices[kept], values[kept]
+            self._append(sample_id, rows[indices], values)
+
+    def _kept_rows(self) -> Optional[np.ndarray]:
+        """Boolean index of the rows the pruning keeps, None to keep all"""
+        pruning = self._pruning
+        if pruning is None:
+            return None
+        features = self._features
+        prevalence = self._prevalence[: len(features)]
+        stratified = _stratified_features(features)
+        special = _special_features(features)
+        community = np.fromiter(
+            (
+                features.get(f.split(STRATIFICATION_DELIMITER)[0], row)
+                for f, row in features.items()
+            ),
+            dtype=np.int64,
+            count=len(features),
+        )
+
+        selected = (prevalence > 0) & (
+            prevalence / max(len(self._samples), 1) >= pruning.min_prevalence
+        )
+        if pruning.top_features is not None:
+            candidates = np.flatnonzero(selected & ~stratified & ~special)
+            ranked = candidates[np.argsort(-self._abundance[candidates], kind="stable")]
+            selected[ranked[pruning.top_features:]] = False
+        selected |= special & (prevalence > 0)
+
+        kept = np.where(stratified, selected[community] & (prevalence > 0), selected)
+        if pruning.stratification != "both":
+            kept &= stratified == (pruning.stratification == "stratified")
+        return kept
+
+    def to_table(self) -> biom.Table:
+        """Assemble the accumulated samples into a single biom table."""
+        features = self._features
+        kept = self._kept_rows()
+        if kept is not None:
+            # new row of every kept row
+            renumbered = np.cumsum(kept) - 1
+            features = {f: int(renumbered[row]) for f, row in features.items() if kept[row]}
+
+        shape = (len(features), len(self._samples))
+        if self._columns:
+            columns, lengths = zip(*self._columns)
+            rows = self._rows.array()
+            values = self._values.array()
+            columns = np.repeat(np.array(columns, dtype=np.int32), lengths)
+            if kept is not None:
+                stored = kept[rows]
+                rows, values, columns = renumbered[rows[stored]], values[stored], columns[stored]
+            matrix = coo_matrix((values, (rows, columns)), shape=shape).tocsr()
+        else:
+            matrix = coo_matrix(shape).tocsr()
+
+        # samples arrive in completion order
+        feature_ids = _feature_order(features)
+        sample_ids = sorted(self._samples)
+        matrix = matrix[[features[f] for f in feature_ids]]
+        matrix = matrix[:, [self._samples[s] for s in sample_ids]]
+
+        table = biom.Table(matrix, feature_ids, sample_ids)
+        if self._metadata:
+            table.add_metadata(self._metadata, axis="observation")
+        return table
+
+
+def _read_metaphlan_profile(path: str) -> Tuple[str, List[str], List[str], np.ndarray]:
+    """
+    Parse a MetaPhlAn bugs list.
+
+    Returns
+    -------
+    str
+        The sample ID, the file name without its bugs list suffix
+    list of str
+        Clade names, the full ``k__...|p__...`` lineage
+    list of str
+        NCBI taxonomy IDs of the clades, empty when not in the profile
+    np.ndarray
+        Relative abundances of the clades
+    """
+    sample_id = os.path.basename(path)
+    if sample_id.endswith(METAPHLAN_PROFILE_SUFFIX):
+        sample_id = sample_id[: -len(METAPHLAN_PROFILE_SUFFIX)]
+
+    abundance_column: Optional[int] = None
+    taxid_column: Optional[int] = None
+    clades, taxids, values = [], [], []
+    with open(path) as fh:
+        for line_number, line in enumerate(fh, start=1):
+            line = line.rstrip("\n")
+            if line.startswith("#clade_name"):
+                header = line[1:].split("\t")
+                if "relative_abundance" in header:
+                    abundance_column = header.index("relative_abundance")
+                for name in ("NCBI_tax_id", "clade_taxid"):
+                    if name in header:
+                        taxid_column = header.index(name)
+                continue
+            if not line or line.startswith("#"):
+                continue
+
+            fields = line.split("\t")
+            if abundance_column is None:
+                # profiles without a header: clade, [taxid,] abundance
+                abundance_column = 2 if len(fields) > 2 else 1
+                taxid_column = 1 if len(fields) > 2 else None
+            try:
+                values.append(float(fields[abundance_column]))
+            except (IndexError, ValueError):
+                raise ValueError(
+                    "%s, line %d: expected a relative abundance in column %d,"
+                    " found %r" % (path, line_number, abundance_column + 1, line)
+                )
+            clades.append(fields[0])
+            taxids.append(fields[taxid_column] if taxid_column is not None else "")
+
+    return sample_id, clades, taxids, np.array(values, dtype=np.float64)
+
+
+def _table_profile(table: biom.Table, sample_id: str) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    The clades, NCBI taxonomy IDs and abundances of one sample of a
+    taxonomy table, such as the one ``run`` returns. Absent clades are left
+    out.
+    """
+    values = table.data(sample_id, axis="sample", dense=True)
+    present = np.flatnonzero(values)
+    clades = [str(clade) for clade in table.ids(axis="observation")[present]]
+    metadata = table.metadata(axis="observation")
+    taxids = [
+        str(metadata[i].get("ncbi_tax_id", "")) if metadata is not None else ""
+        for i in present
+    ]
+    return clades, taxids, values[present]
+
+
+def _write_metaphlan_profile(
+    path: str,
+    database_version: str,
+    clades: List[str],
+    taxids: List[str],
+    values: np.ndarray,
+) -> None:
+    """
+    Write a MetaPhlAn bugs list humann3 accepts as --taxonomic-profile.
+
+    humann3 only uses profiles whose comment lines name the MetaPhlAn
+    database they were made with, such as mpa_vJan21_CHOCOPhlAnSGB_202103.
+    """
+    with open(path, "w") as fh:
+        fh.write("#%s\n" % database_version)
+        fh.write("#clade_name\tNCBI_tax_id\trelative_abundance\tadditional_species\n")
+        for clade, taxid, value in zip(clades, taxids, values):
+            fh.write("%s\t%s\t%r\t\n" % (clade, taxid, float(value)))
+
+
+def _clade_metadata(clades: List[str], taxids: List[str]) -> Dict[str, dict]:
+    """Ranks and NCBI taxonomy ID of every clade of a MetaPhlAn profile"""
+    return {
+        clade: {
+            "taxonomy": clade.split(STRATIFICATION_DELIMITER),
+            "ncbi_tax_id": taxid,
+        }
+        for clade, taxid in zip(clades, taxids)
+    }
+
+
+def _sample_outputs(sample_output: str) -> Dict[str, str]:
+    """Paths of the humann3 tables and MetaPhlAn profile of one sample"""
+    outputs = {}
+    for name, pattern in [(n, "*_%s.biom" % n) for n in HUMANN_TABLES] + [
+        ("taxonomy", "*" + METAPHLAN_PROFILE_SUFFIX)
+    ]:
+        paths = glob(os.path.join(sample_output, "**", pattern), recursive=True)
+        if len(paths) != 1:
+            raise ValueError(
+                "Expected one %s output in %s, found %d" % (name, sample_output, len(paths))
+            )
+        outputs[name] = paths[0]
+    return outputs
+
+
+class _SampleAggregator:
+    """
+    Fold the outputs of each sample into the merged tables as it finishes.
+
+    Reading a sample's outputs happens in the calling thread, so samples
+    finishing together are parsed in parallel; only adding the parsed
+    values to the merged tables is serialized. Clades of the taxonomy keep
+    their full lineage as ID, with their ranks and NCBI taxonomy ID as
+    observation metadata. With a ``spill_dir`` the folded values are kept
+    on disk there rather than in memory.
+
+    The gene family and pathway abundance tables of every sample are
+    renormalized to relative abundance before they are folded, so that the
+    ``pruning`` thresholds are relative abundances and the kept values keep
+    their share of the unpruned community. Only the stratification of the
+    pruning applies to the pathway coverage, none of it to the taxonomy.
+    """
+
+    def __init__(self, spill_dir: Optional[str] = None, pruning: Optional[_Pruning] = None):
+        # without pruning every feature seen is kept, as humann3 joins them
+        if pruning == _Pruning():
+            pruning = None
+        coverage = None
+        if pruning is not None and pruning.stratification != "both":
+            coverage = _Pruning(stratification=pruning.stratification)
+        prunings = {"genefamilies": pruning, "pathcoverage": coverage, "pathabundance": pruning}
+        self._accumulators = {
+            name: _TableAccumulator(
+                None if spill_dir is None else os.path.join(spill_dir, name),
+                prunings.get(name),
+            )
+            for name in HUMANN_TABLES + ("taxonomy",)
+        }
+        self._lock = threading.Lock()
+
+    def add(self, sample_output: str) -> None:
+        """Fold the outputs humann3 wrote to ``sample_output``."""
+        from q2_humann3._renorm import _renorm_table
+
+        outputs = _sample_outputs(sample_output)
+        tables = {name: biom.load_table(outputs[name]) for name in HUMANN_TABLES}
+        for name in RENORMALIZED_TABLES:
+            tables[name] = _renorm_table(tables[name], "relab")
+        sample_id, clades, taxids, values = _read_metaphlan_profile(outputs["taxonomy"])
+
+        with self._lock:
+            for name, table in tables.items():
+                self._accumulators[name].add_table(table)
+            self._accumulators["taxonomy"].add(
+                sample_id, clades, values, _clade_metadata(clades, taxids)
+            )
+
+    def table(self, name: str) -> biom.Table:
+        """One merged table, of the samples folded so far."""
+        with self._lock:
+            return self._accumulators[name].to_table()
+
+    def tables(self) -> Dict[str, biom.Table]:
+        """The merged tables of every sample folded so far."""
+        return {name: self.table(name) for name in self._accumulators}
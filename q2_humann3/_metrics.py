@@ -0,0 +1,134 @@
+import asyncio
+import os
+import re
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+METRIC_COLUMNS = [
+    "sample",
+    "stage",
+    "wall_time",
+    "cpu_time",
+    "peak_rss",
+    "bytes_read",
+    "bytes_written",
+]
+
+# humann3 logs the duration of each of its stages, tab delimited
+_HUMANN_STAGE_PATTERN = re.compile(
+    r"TIMESTAMP: Completed \t(?P<stage>.+?) \t:\t (?P<seconds>\d+)\t seconds"
+)
+
+# how often a running process is checked for completion
+_POLL_INTERVAL = 1.0
+
+
+async def _wait_with_usage(
+    process: subprocess.Popen, timeout: Optional[float] = None
+) -> Tuple[int, resource.struct_rusage]:
+    """
+    Wait for a process like ``Popen.wait`` and return its resource usage,
+    without holding a thread while it runs.
+
+    The usage covers the process and every descendant it waited for, so
+    the peak RSS is that of the largest process in the tree.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return process.returncode, usage
+        if deadline is not None and time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        await asyncio.sleep(_POLL_INTERVAL)
+
+
+def _humann_log_stages(log_path: str) -> Dict[str, float]:
+    """Seconds spent in each stage according to a humann3 log"""
+    stages: Dict[str, float] = {}
+    if not os.path.exists(log_path):
+        return stages
+    with open(log_path) as fh:
+        for line in fh:
+            match = _HUMANN_STAGE_PATTERN.search(line)
+            if match:
+                stage = match.group("stage")
+                stages[stage] = stages.get(stage, 0) + float(match.group("seconds"))
+    return stages
+
+
+class _RunMetrics:
+    """
+    Thread safe collection of per-sample and per-stage measurements.
+
+    Times are in seconds, memory and I/O in bytes. Measurements that do not
+    apply to a stage, such as the I/O of a stage parsed from a humann3 log,
+    are left empty.
+    """
+
+    def __init__(self):
+        self._records = []
+        self._lock = threading.Lock()
+
+    def record(self, sample: str, stage: str, **values) -> None:
+        with self._lock:
+            self._records.append(dict(values, sample=sample, stage=stage))
+
+    def record_process(
+        self, sample: str, stage: str, wall_time: float, usage: resource.struct_rusage
+    ) -> None:
+        """Record a child process from the usage ``_wait_with_usage`` returned"""
+        self.record(
+            sample,
+            stage,
+            wall_time=wall_time,
+            cpu_time=usage.ru_utime + usage.ru_stime,
+            # ru_maxrss is in kilobytes and blocks are 512 bytes on Linux
+            peak_rss=usage.ru_maxrss * 1024,
+            bytes_read=usage.ru_inblock * 512,
+            bytes_written=usage.ru_oublock * 512,
+        )
+
+    def record_humann_log(self, sample: str, log_path: str) -> None:
+        """Record the stages humann3 timed itself"""
+        for stage, seconds in _humann_log_stages(log_path).items():
+            self.record(sample, "humann3 %s" % stage, wall_time=seconds)
+
+    @contextmanager
+    def measure(self, sample: str, stage: str):
+        """Measure wall and CPU time of an in-process stage"""
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(
+                sample,
+                stage,
+                wall_time=time.perf_counter() - wall_start,
+                cpu_time=time.thread_time() - cpu_start,
+                peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            )
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        The measurements by ``<sample>/<stage>`` ID, with `` #<n>`` added
+        for the nth attempt of a stage of a retried sample.
+        """
+        with self._lock:
+            metrics = pd.DataFrame(self._records, columns=METRIC_COLUMNS)
+        attempts = metrics.groupby(["sample", "stage"], sort=False).cumcount() + 1
+        metrics.index = pd.Index(
+            [
+                "%s/%s" % (sample or "run", stage) + (" #%d" % attempt if attempt > 1 else "")
+                for sample, stage, attempt in zip(metrics["sample"], metrics["stage"], attempts)
+            ],
+            name="id",
+        )
+        return metrics
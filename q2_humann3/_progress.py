@@ -0,0 +1,115 @@
+import asyncio
+import sys
+import time
+from typing import IO, Callable, Dict, Optional
+
+# what humann3 prints as it starts each of its steps, in order
+_HUMANN_STEPS = (
+    ("Running metaphlan", "prescreen"),
+    ("Creating custom ChocoPhlAn database", "custom database"),
+    ("Running bowtie2-build", "nucleotide index"),
+    ("Running bowtie2", "nucleotide alignment"),
+    ("Running diamond", "translated alignment"),
+    ("Computing gene families", "gene families"),
+    ("Computing pathways", "pathways"),
+)
+
+# longest line read from a process, humann3 lines are far shorter
+_LINE_LIMIT = 1024**2
+
+
+async def _stream_lines(pipe: IO[bytes], on_line: Callable[[str], None]) -> None:
+    """Call ``on_line`` with every line written to ``pipe``, until it is closed"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=_LINE_LIMIT)
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    try:
+        async for line in reader:
+            on_line(line.decode(errors="replace").rstrip("\n"))
+    finally:
+        transport.close()
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class _Progress:
+    """
+    Follow the humann3 step of every running sample from its output, and
+    report how many samples are done and roughly how long the rest take.
+
+    The estimate assumes the remaining reads take as long per byte as the
+    reads profiled so far, each step a running sample has finished
+    counting for an equal share of its reads. Only used from the event
+    loop thread.
+
+    Parameters
+    ----------
+    sizes : dict of str to int
+        Bytes of reads of every sample
+    stream : file, optional
+        Where the output of humann3 and the progress are written, standard
+        output by default
+    """
+
+    def __init__(self, sizes: Dict[str, int], stream: Optional[IO[str]] = None):
+        self._sizes = sizes
+        self._total = sum(sizes.values())
+        self._stream = stream
+        self._start = time.monotonic()
+        # steps started by every running sample
+        self._steps: Dict[str, int] = {}
+        self._done = 0
+        self._finished = 0
+
+    def _write(self, text: str) -> None:
+        print(text, file=self._stream or sys.stdout, flush=True)
+
+    def remaining(self) -> Optional[float]:
+        """Estimated seconds until every sample is done, None before any progress"""
+        done = self._done + sum(
+            self._sizes[sample] * max(steps - 1, 0) / len(_HUMANN_STEPS)
+            for sample, steps in self._steps.items()
+        )
+        if not done:
+            return None
+        return (time.monotonic() - self._start) * max(self._total - done, 0) / done
+
+    def _report(self, sample: str, step: str) -> None:
+        remaining = self.remaining()
+        self._write(
+            "progress: %s %s, %d of %d samples done%s"
+            % (
+                sample,
+                step,
+                self._finished,
+                len(self._sizes),
+                "" if remaining is None else ", about %s left" % _format_duration(remaining),
+            )
+        )
+
+    def start(self, sample: str) -> None:
+        self._steps[sample] = 0
+
+    def output(self, sample: str, line: str) -> None:
+        """Pass on a line humann3 printed for ``sample`` and follow its steps"""
+        self._write("%s: %s" % (sample, line))
+        for number, (prefix, step) in enumerate(_HUMANN_STEPS, start=1):
+            if line.startswith(prefix):
+                if number > self._steps.get(sample, 0):
+                    self._steps[sample] = number
+                    self._report(sample, step)
+                break
+
+    def finish(self, sample: str, succeeded: bool = True) -> None:
+        """Stop following a sample, counting its reads as done if it succeeded"""
+        self._steps.pop(sample, None)
+        if succeeded:
+            self._done += self._sizes[sample]
+            self._finished += 1
+            self._report(sample, "done")
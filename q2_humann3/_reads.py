@@ -0,0 +1,66 @@
+import gzip
+import os
+import shutil
+import subprocess
+from typing import Dict, List
+
+import pandas as pd
+
+# forward reads first, so a pair is concatenated in the same order humann3
+# users concatenate them by hand
+_DIRECTIONS = ("forward", "reverse")
+
+
+def _manifest_reads(demultiplexed_seqs) -> Dict[str, List[str]]:
+    """
+    FASTQ files of every sample ID in the manifest of a demultiplexed
+    sequences artifact, single or paired end.
+    """
+    directory = str(demultiplexed_seqs)
+    manifest = pd.read_csv(os.path.join(directory, "MANIFEST"), comment="#")
+    manifest["order"] = manifest["direction"].map(_DIRECTIONS.index)
+    samples: Dict[str, List[str]] = {}
+    for sample_id, filename in (
+        manifest.sort_values(["order"], kind="stable")[["sample-id", "filename"]]
+        .itertuples(index=False)
+    ):
+        samples.setdefault(str(sample_id), []).append(
+            os.path.join(directory, os.path.basename(filename))
+        )
+    return samples
+
+
+def _decompress(paths: List[str], target: str, threads: int = 1) -> None:
+    """
+    Decompress and concatenate ``paths`` into ``target`` in one pass.
+
+    pigz is used when it is installed, so decompression runs on the
+    sample's threads instead of humann3's single threaded gzip reader.
+    """
+    pigz = shutil.which("pigz")
+    with open(target, "wb") as out:
+        if pigz:
+            subprocess.run(
+                [pigz, "-dc", "-p", str(threads)] + paths, stdout=out, check=True
+            )
+            return
+        for path in paths:
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rb") as fh:
+                shutil.copyfileobj(fh, out, 16 * 1024**2)
+
+
+def _sample_reads(paths: List[str], work_dir: str, sample_id: str, threads: int = 1) -> str:
+    """
+    The single FASTQ humann3 should read for a sample.
+
+    An uncompressed single-end FASTQ is used as is. Otherwise the reads are
+    decompressed, pairs concatenated, into ``work_dir``: humann3 would
+    decompress them into its temporary directory anyway, and only accepts
+    one input file.
+    """
+    if len(paths) == 1 and not paths[0].endswith(".gz"):
+        return paths[0]
+    target = os.path.join(work_dir, sample_id + ".fastq")
+    _decompress(paths, target, threads)
+    return target
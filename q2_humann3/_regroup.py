@@ -0,0 +1,266 @@
+import array
+import hashlib
+import importlib
+import importlib.util
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import biom
+import numpy as np
+from scipy import sparse
+
+from q2_humann3._cache import _database_identity
+from q2_humann3._merge import STRATIFICATION_DELIMITER, _feature_order
+from q2_humann3._rename import NAME_DELIMITER, _file_identity, _load_index, _open_text
+
+UNGROUPED = "UNGROUPED"
+# carried through regrouping as their own group, as humann_regroup_table -p Y
+PROTECTED_FEATURES = ("UNMAPPED", "UNINTEGRATED")
+
+# groups shipped with humann: (data directory, file, column of the group,
+# columns to ignore)
+_HUMANN_GROUP_FILES = {
+    "uniref90_rxn": ("pathways", "metacyc_reactions_level4ec_only.uniref.bz2", 0, (1,)),
+    "uniref50_rxn": ("pathways", "metacyc_reactions_level4ec_only.uniref.bz2", 0, (1,)),
+}
+# groups in the utility mapping database downloaded with humann_databases
+for _target in ("go", "infogo1000", "ko", "level4ec", "pfam", "eggnog"):
+    for _uniref in ("uniref50", "uniref90"):
+        _HUMANN_GROUP_FILES["%s_%s" % (_uniref, _target)] = (
+            None,
+            "map_%s_%s.txt.gz" % (_target, _uniref),
+            0,
+            (),
+        )
+
+_FUNCTIONS = ("sum", "mean")
+
+
+def _humann_group_file(groups: str) -> Tuple[str, int, Sequence[int]]:
+    """Path, group column and ignored columns of a built-in humann group file"""
+    directory, name, start, skip = _HUMANN_GROUP_FILES[groups]
+    if directory is None:
+        try:
+            config = importlib.import_module("humann.config")
+        except ImportError:
+            config = None
+        directory = getattr(config, "utility_mapping_database", "")
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            raise ValueError(
+                "%s was not found in the humann utility mapping database %r, download"
+                " it with humann_databases --download utility_mapping full"
+                % (name, directory)
+            )
+        return path, start, skip
+
+    spec = importlib.util.find_spec("humann")
+    if spec is None or not spec.submodule_search_locations:
+        raise ValueError(
+            "humann must be installed to regroup with the built-in %r groups" % groups
+        )
+    return os.path.join(spec.submodule_search_locations[0], "data", directory, name), start, skip
+
+
+class _GroupIndex:
+    """
+    Memory-mapped feature to group index.
+
+    The index is the sorted feature IDs and, like a CSR matrix, offsets
+    into a flat array of the indices of their groups, plus the group names
+    in the order they first appear in the mapping file.
+    """
+
+    directory = "group-index"
+
+    def __init__(self, path: str):
+        self._features = np.load(os.path.join(path, "features.npy"), mmap_mode="r")
+        self._indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self._indices = np.load(os.path.join(path, "indices.npy"), mmap_mode="r")
+        self._groups = np.load(os.path.join(path, "groups.npy"), mmap_mode="r")
+
+    @staticmethod
+    def build(
+        source: str,
+        path: str,
+        start: int = 0,
+        skip: Sequence[int] = (),
+        features_first: bool = False,
+    ) -> None:
+        """
+        Index the mapping file ``source`` into the directory ``path``.
+
+        Every line holds a group in column ``start`` and its features in the
+        other columns, or a feature and its groups when ``features_first``.
+        """
+        group_index: Dict[str, int] = {}
+        features: List[bytes] = []
+        groups = array.array("q")
+        with _open_text(source) as fh:
+            for line in fh:
+                row = line.rstrip().split("\t")
+                key = row[start]
+                values = [v for i, v in enumerate(row) if i != start and i not in skip]
+                if features_first:
+                    for group in values:
+                        features.append(key.encode())
+                        groups.append(group_index.setdefault(group, len(group_index)))
+                else:
+                    group = group_index.setdefault(key, len(group_index))
+                    for feature in values:
+                        features.append(feature.encode())
+                        groups.append(group)
+
+        feature_ids = np.array(features, dtype=bytes)
+        del features
+        group_ids = np.frombuffer(groups, dtype=np.int64)
+        order = np.lexsort((group_ids, feature_ids))
+        feature_ids, group_ids = feature_ids[order], group_ids[order]
+
+        # a feature listed twice under the same group counts once
+        keep = np.ones(len(feature_ids), dtype=bool)
+        keep[1:] = (feature_ids[1:] != feature_ids[:-1]) | (group_ids[1:] != group_ids[:-1])
+        feature_ids, group_ids = feature_ids[keep], group_ids[keep]
+
+        unique, starts = np.unique(feature_ids, return_index=True)
+        indptr = np.append(starts, len(feature_ids)).astype(np.int64)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "features.npy"), unique)
+        np.save(os.path.join(path, "indptr.npy"), indptr)
+        np.save(os.path.join(path, "indices.npy"), group_ids.astype(np.int32))
+        np.save(
+            os.path.join(path, "groups.npy"),
+            np.array([g.encode() for g in group_index], dtype=bytes),
+        )
+
+    def lookup(self, feature_ids: List[str]) -> List[List[str]]:
+        """Groups of each feature, empty for features not in the index"""
+        if not len(self._features):
+            return [[] for _ in feature_ids]
+
+        width = self._features.dtype.itemsize
+        queries = [f.encode() for f in feature_ids]
+        positions = np.searchsorted(
+            self._features, np.array(queries, dtype=self._features.dtype)
+        )
+        positions = np.minimum(positions, len(self._features) - 1)
+
+        found = []
+        for query, position in zip(queries, positions):
+            if len(query) > width or self._features[position] != query:
+                found.append([])
+                continue
+            indices = self._indices[self._indptr[position]:self._indptr[position + 1]]
+            found.append([self._groups[i].decode() for i in indices])
+        return found
+
+
+def _group_index(
+    groups: str = "", group_mapping=None, features_first: bool = False
+) -> _GroupIndex:
+    """The group index of a mapping artifact or of a built-in humann group file"""
+    if group_mapping:
+        path = os.path.join(str(group_mapping), "mapping.gz")
+        identity, start, skip = _database_identity(str(group_mapping)), 0, ()
+    elif groups:
+        path, start, skip = _humann_group_file(groups)
+        identity = _file_identity(path)
+    else:
+        raise ValueError("Either groups or a group mapping must be provided")
+
+    options = dict(start=start, skip=tuple(skip), features_first=features_first)
+    identity = hashlib.sha256(
+        ("%s:%r" % (identity, sorted(options.items()))).encode()
+    ).hexdigest()
+    return _load_index(_GroupIndex, path, identity, **options)
+
+
+def _aggregation_matrix(
+    feature_ids: List[str],
+    index: _GroupIndex,
+    ungrouped: bool = True,
+    protected: bool = True,
+) -> Tuple[sparse.csr_matrix, List[str]]:
+    """
+    Sparse group-by-feature matrix of ones and the ID of every group row.
+
+    Stratified features ``F|taxon`` go to ``G|taxon`` for each group G of
+    F, so a table regroups with a single matrix product.
+    """
+    codes = [
+        f.split(STRATIFICATION_DELIMITER)[0].split(NAME_DELIMITER)[0] for f in feature_ids
+    ]
+    unique = list(dict.fromkeys(codes))
+    feature_groups = dict(zip(unique, index.lookup(unique)))
+    if protected:
+        for feature in PROTECTED_FEATURES:
+            if feature in feature_groups and feature not in feature_groups[feature]:
+                feature_groups[feature].append(feature)
+
+    group_rows: Dict[str, int] = {}
+    rows, columns = [], []
+    for column, (feature_id, code) in enumerate(zip(feature_ids, codes)):
+        groups = feature_groups[code] or ([UNGROUPED] if ungrouped else [])
+        stratum = feature_id.split(STRATIFICATION_DELIMITER)[1:]
+        for group in groups:
+            group_id = STRATIFICATION_DELIMITER.join([group] + stratum)
+            rows.append(group_rows.setdefault(group_id, len(group_rows)))
+            columns.append(column)
+
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, columns)), shape=(len(group_rows), len(feature_ids))
+    )
+    return matrix, list(group_rows)
+
+
+def _regroup_table(
+    table: biom.Table,
+    groups: str = "",
+    group_mapping=None,
+    features_first: bool = False,
+    function: str = "sum",
+    ungrouped: bool = True,
+    protected: bool = True,
+) -> biom.Table:
+    """
+    Regroup the features of a table, as ``humann_regroup_table``.
+
+    Parameters
+    ----------
+    table : biom.Table
+        table
+    groups : str
+        built-in humann groups
+    group_mapping : HumannDBSingleFileDirFormat
+        group_mapping, used instead of groups when given
+    features_first : bool
+        the mapping lists the groups of each feature rather than the
+        features of each group
+    function : str
+        sum or mean
+    ungrouped : bool
+        collect features without a group in UNGROUPED
+    protected : bool
+        carry UNMAPPED and UNINTEGRATED through
+
+    Returns
+    -------
+    biom.Table
+
+    """
+    if function not in _FUNCTIONS:
+        raise ValueError("function must be one of %s, not %r" % (_FUNCTIONS, function))
+
+    index = _group_index(groups, group_mapping, features_first)
+    matrix, group_ids = _aggregation_matrix(
+        list(table.ids(axis="observation")), index, ungrouped, protected
+    )
+    data = matrix @ table.matrix_data.tocsr()
+    if function == "mean":
+        sizes = np.asarray(matrix.sum(axis=1)).ravel()
+        data = sparse.diags(1 / sizes) @ data
+
+    order = {group_id: i for i, group_id in enumerate(group_ids)}
+    group_ids = _feature_order(group_ids)
+    data = sparse.csr_matrix(data)[[order[g] for g in group_ids]]
+    return biom.Table(data, group_ids, table.ids(axis="sample"))
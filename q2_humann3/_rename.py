@@ -0,0 +1,314 @@
+import bz2
+import gzip
+import hashlib
+import importlib.util
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import biom
+import numpy as np
+
+from q2_humann3._cache import _database_identity
+from q2_humann3._merge import STRATIFICATION_DELIMITER
+from q2_humann3._renorm import SPECIAL_FEATURES
+
+NAME_DELIMITER = ": "
+MULTINAME_DELIMITER = ";"
+UNKNOWN_NAME = "NO_NAME"
+
+# name maps shipped in humann's data/misc directory, as humann_rename_table -n
+_HUMANN_NAME_FILES = {
+    "kegg-orthology": "map_ko_name.txt.gz",
+    "kegg-pathway": "map_kegg-pwy_name.txt.gz",
+    "kegg-module": "map_kegg-mdl_name.txt.gz",
+    "ec": "map_level4ec_name.txt.gz",
+    "metacyc-rxn": "map_metacyc-rxn_name.txt.gz",
+    "metacyc-pwy": "map_metacyc-pwy_name.txt.gz",
+    "pfam": "map_pfam_name.txt.gz",
+    "eggnog": "map_eggnog_name.txt.gz",
+    "go": "map_go_name.txt.gz",
+    "infogo1000": "map_go_name.txt.gz",
+}
+
+_INDEX_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser(os.path.join("~", ".cache"))),
+    "q2-humann3",
+)
+
+# indexes already opened by this process, by directory
+_loaded_indexes: Dict[str, object] = {}
+_loaded_indexes_lock = threading.Lock()
+
+
+def _humann_name_file(name: str) -> str:
+    """Path of one of the name maps installed with humann"""
+    spec = importlib.util.find_spec("humann")
+    if spec is None or not spec.submodule_search_locations:
+        raise ValueError(
+            "humann must be installed to rename with the built-in %r names" % name
+        )
+    return os.path.join(
+        spec.submodule_search_locations[0], "data", "misc", _HUMANN_NAME_FILES[name]
+    )
+
+
+def _file_identity(path: str) -> str:
+    stat = os.stat(path)
+    return hashlib.sha256(
+        ("%s:%d:%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode()
+    ).hexdigest()
+
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt")
+    return open(path)
+
+
+def _read_name_map(path: str) -> Iterator[Tuple[str, List[str]]]:
+    """``(feature ID, names)`` for every line of a tab separated name map"""
+    with _open_text(path) as fh:
+        for line in fh:
+            row = line.rstrip().split("\t")
+            if len(row) > 1:
+                yield row[0], row[1:]
+
+
+class _NameIndex:
+    """
+    Memory-mapped feature ID to name index.
+
+    The index is three files: the sorted feature IDs as a fixed width byte
+    array, offsets into a blob of names, and the blob itself. Features
+    mapped to several names have them joined by ``;`` in first seen order,
+    as ``humann_rename_table`` does. Lookups are a binary search over the
+    memory-mapped IDs, so only the pages touched by a table are read.
+    """
+
+    directory = "name-index"
+
+    def __init__(self, path: str):
+        self._ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self._names = np.memmap(os.path.join(path, "names.bin"), dtype=np.uint8, mode="r") \
+            if os.path.getsize(os.path.join(path, "names.bin")) else np.zeros(0, np.uint8)
+
+    @staticmethod
+    def build(source: str, path: str) -> None:
+        """Index the name map ``source`` into the directory ``path``"""
+        names: Dict[str, Dict[str, None]] = {}
+        for feature_id, feature_names in _read_name_map(source):
+            entry = names.setdefault(feature_id, {})
+            for name in feature_names:
+                entry[name] = None
+
+        ids = np.array([f.encode() for f in names], dtype=bytes)
+        order = np.argsort(ids, kind="stable")
+        encoded = [
+            MULTINAME_DELIMITER.join(entry).encode() for entry in names.values()
+        ]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(encoded[i]) for i in order], out=offsets[1:])
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "ids.npy"), ids[order])
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        with open(os.path.join(path, "names.bin"), "wb") as fh:
+            for i in order:
+                fh.write(encoded[i])
+
+    def lookup(self, feature_ids: List[str]) -> List[Optional[str]]:
+        """Names of each feature, None for features not in the index"""
+        if not len(self._ids):
+            return [None] * len(feature_ids)
+
+        width = self._ids.dtype.itemsize
+        queries = [f.encode() for f in feature_ids]
+        positions = np.searchsorted(self._ids, np.array(queries, dtype=self._ids.dtype))
+        positions = np.minimum(positions, len(self._ids) - 1)
+
+        found = []
+        for query, position in zip(queries, positions):
+            if len(query) > width or self._ids[position] != query:
+                found.append(None)
+                continue
+            start, end = self._offsets[position], self._offsets[position + 1]
+            found.append(bytes(self._names[start:end]).decode())
+        return found
+
+
+def _load_index(index_type: type, source: str, identity: str, **options):
+    """
+    Open the ``index_type`` index of ``source``, building it the first time.
+
+    Indexes are kept on disk by the identity of their source, so each
+    reference is only decompressed and parsed once. ``options`` are passed
+    to ``index_type.build`` and must be part of ``identity``.
+    """
+    parent = os.path.join(_INDEX_DIR, index_type.directory)
+    path = os.path.join(parent, identity)
+    with _loaded_indexes_lock:
+        if path in _loaded_indexes:
+            return _loaded_indexes[path]
+
+        if not os.path.isdir(path):
+            os.makedirs(parent, exist_ok=True)
+            partial = tempfile.mkdtemp(prefix=".%s-" % identity, dir=parent)
+            try:
+                index_type.build(source, partial, **options)
+                os.rename(partial, path)
+            except OSError:
+                # another process built the same index first
+                shutil.rmtree(partial, ignore_errors=True)
+                if not os.path.isdir(path):
+                    raise
+
+        _loaded_indexes[path] = index_type(path)
+        return _loaded_indexes[path]
+
+
+def _simplify(names: str) -> str:
+    """Replace runs of non-alphanumeric characters in every name by ``_``"""
+    simplified = {
+        re.sub("[^A-Za-z0-9]+", "_", name): None
+        for name in names.split(MULTINAME_DELIMITER)
+    }
+    return MULTINAME_DELIMITER.join(simplified)
+
+
+def _rename_features(
+    feature_ids: List[str], index: _NameIndex, simplify: bool = False
+) -> Dict[str, str]:
+    """
+    New ID of every feature, ``ID: name`` with any ``|taxon`` kept.
+
+    Mirrors ``humann_rename_table``: special features are left alone,
+    features already carrying a name are renamed from their bare ID and
+    features missing from the reference are named NO_NAME.
+    """
+    bases = {}
+    for feature_id in feature_ids:
+        base = feature_id.split(STRATIFICATION_DELIMITER)[0].split(NAME_DELIMITER)[0]
+        bases[feature_id] = base
+
+    unique = list(dict.fromkeys(b for b in bases.values() if b not in SPECIAL_FEATURES))
+    names = {}
+    for base, found in zip(unique, index.lookup(unique)):
+        if found is None:
+            found = UNKNOWN_NAME
+        elif simplify:
+            found = _simplify(found)
+        names[base] = base + NAME_DELIMITER + found
+
+    renamed = {}
+    for feature_id, base in bases.items():
+        if base in SPECIAL_FEATURES:
+            renamed[feature_id] = feature_id
+            continue
+        items = feature_id.split(STRATIFICATION_DELIMITER)
+        items[0] = names[base]
+        renamed[feature_id] = STRATIFICATION_DELIMITER.join(items)
+    return renamed
+
+
+def _reference_index(name: str = "", reference_mapping=None) -> _NameIndex:
+    """The name index of a reference artifact or of a built-in name map"""
+    if reference_mapping:
+        return _load_index(
+            _NameIndex,
+            os.path.join(str(reference_mapping), "reference.txt.bz2"),
+            _database_identity(str(reference_mapping)),
+        )
+    if name:
+        path = _humann_name_file(name)
+        return _load_index(_NameIndex, path, _file_identity(path))
+    raise ValueError("Either a name or a reference mapping must be provided")
+
+
+def _rename_table(
+    table: biom.Table,
+    name: str = "",
+    reference_mapping=None,
+    simplify: bool = False,
+) -> biom.Table:
+    """
+    Rename the features of a table in place.
+
+    Parameters
+    ----------
+    table : biom.Table
+        table
+    name : str
+        name of a name map installed with humann
+    reference_mapping : HumannDBSingleReferenceFileDirFormat
+        reference_mapping, used instead of name when given
+    simplify : bool
+        simplify
+
+    Returns
+    -------
+    biom.Table
+
+    """
+    index = _reference_index(name, reference_mapping)
+    feature_ids = list(table.ids(axis="observation"))
+    table.update_ids(
+        _rename_features(feature_ids, index, simplify), axis="observation", inplace=True
+    )
+    return table
+
+
+def _rename_tables(
+    tables: Dict[str, biom.Table],
+    names: Optional[List[str]] = None,
+    reference_mappings: Optional[list] = None,
+    simplify: bool = False,
+) -> Dict[str, biom.Table]:
+    """
+    Rename every table against every reference.
+
+    Each reference is indexed once and looked up once for the features of
+    all tables together. The renamed tables are keyed ``<table>-<name>``,
+    or ``<table>-reference-<n>`` for the nth reference mapping.
+
+    Parameters
+    ----------
+    tables : dict of str to biom.Table
+        tables
+    names : list of str
+        names of name maps installed with humann
+    reference_mappings : list of HumannDBSingleReferenceFileDirFormat
+        reference_mappings
+    simplify : bool
+        simplify
+
+    Returns
+    -------
+    dict of str to biom.Table
+
+    """
+    references = [(name, _reference_index(name=name)) for name in names or []]
+    references.extend(
+        ("reference-%d" % i, _reference_index(reference_mapping=mapping))
+        for i, mapping in enumerate(reference_mappings or [], 1)
+    )
+    if not references:
+        raise ValueError("Either names or reference mappings must be provided")
+
+    feature_ids = list(
+        dict.fromkeys(f for table in tables.values() for f in table.ids(axis="observation"))
+    )
+    renamed = {}
+    for label, index in references:
+        new_ids = _rename_features(feature_ids, index, simplify)
+        for key, table in tables.items():
+            renamed["%s-%s" % (key, label)] = table.update_ids(
+                new_ids, axis="observation", inplace=False
+            )
+    return renamed
@@ -0,0 +1,87 @@
+import biom
+import numpy as np
+from scipy.sparse import diags
+
+from q2_humann3._merge import STRATIFICATION_DELIMITER
+
+# features humann3 adds to every table which do not map to a reference
+SPECIAL_FEATURES = ("UNMAPPED", "UNINTEGRATED", "UNGROUPED")
+
+_UNITS = {"relab": 1.0, "cpm": 1e6}
+
+
+def _feature_levels(feature_ids) -> np.ndarray:
+    """Stratification level of every feature, 1 being the community total"""
+    return np.fromiter(
+        (f.count(STRATIFICATION_DELIMITER) + 1 for f in feature_ids),
+        dtype=np.int64,
+        count=len(feature_ids),
+    )
+
+
+def _renorm_table(
+    table: biom.Table,
+    units: str = "relab",
+    mode: str = "community",
+    special: bool = True,
+) -> biom.Table:
+    """
+    Renormalize a humann3 table in memory.
+
+    Mirrors ``humann_renorm_table``: every stratification level is divided
+    by the per-sample total of the community (unstratified) rows, or by the
+    total of its own level in ``levelwise`` mode. Samples summing to zero at
+    a level are left at zero.
+
+    Parameters
+    ----------
+    table : biom.Table
+        Joined humann3 table, optionally with ``FEATURE|taxon`` rows
+    units : str
+        ``relab`` for relative abundance or ``cpm`` for copies per million
+    mode : str
+        ``community`` or ``levelwise``
+    special : bool
+        Keep the UNMAPPED, UNINTEGRATED and UNGROUPED features
+
+    Returns
+    -------
+    biom.Table
+    """
+    if units not in _UNITS:
+        raise ValueError("Unknown normalization units: %s" % units)
+    if mode not in ("community", "levelwise"):
+        raise ValueError("Unknown normalization mode: %s" % mode)
+
+    feature_ids = table.ids(axis="observation")
+    if not special:
+        keep = [
+            f for f in feature_ids
+            if f.split(STRATIFICATION_DELIMITER)[0] not in SPECIAL_FEATURES
+        ]
+        table = table.filter(keep, axis="observation", inplace=False)
+        feature_ids = table.ids(axis="observation")
+
+    matrix = table.matrix_data.tocsr().astype(np.float64)
+    levels = _feature_levels(feature_ids)
+
+    def level_totals(level):
+        totals = np.asarray(matrix[levels == level].sum(axis=0)).ravel()
+        totals[totals == 0] = 1
+        return totals / _UNITS[units]
+
+    if mode == "community":
+        normalized = matrix @ diags(1 / level_totals(1))
+    else:
+        normalized = matrix.tocoo(copy=True)
+        for level in np.unique(levels):
+            in_level = levels[normalized.row] == level
+            normalized.data[in_level] /= level_totals(level)[normalized.col[in_level]]
+
+    return biom.Table(
+        normalized.tocsr(),
+        feature_ids,
+        table.ids(),
+        observation_metadata=table.metadata(axis="observation"),
+        sample_metadata=table.metadata(),
+    )
@@ -0,0 +1,349 @@
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Rough peak memory of humann3 in GB for a small sample, dominated by the
+# translated search, and how it grows with the size of the compressed reads
+_BASE_MEMORY = {"minimum": 8.0, "maximum": 16.0}
+_MEMORY_PER_READ_GB = 2.0
+
+
+@dataclass
+class _Job:
+    sample: str
+    paths: List[str]
+    size: int
+    memory: float
+
+
+@dataclass
+class _Failure:
+    sample: str
+    paths: List[str]
+    attempts: int
+    error: str
+
+
+def _describe_error(error: BaseException) -> str:
+    """One line summary of why a sample failed"""
+    if isinstance(error, subprocess.TimeoutExpired):
+        return "timed out after %g seconds" % error.timeout
+    if isinstance(error, subprocess.CalledProcessError):
+        return "%s exited with status %d" % (error.cmd[0], error.returncode)
+    return "%s: %s" % (type(error).__name__, error)
+
+
+def _estimate_memory(size: int, memory_use: str) -> float:
+    """Estimated peak memory in GB of profiling ``size`` bytes of reads"""
+    return _BASE_MEMORY[memory_use] + _MEMORY_PER_READ_GB * size / 1024**3
+
+
+class _SampleScheduler:
+    """
+    Decide which samples to start, and with how many threads, under a
+    memory and CPU budget.
+
+    Samples are started largest first so that the biggest FASTQs do not hold
+    up the end of a batch. When memory limits how many samples can run side
+    by side, the idle CPUs are handed to the samples that do run instead.
+    A sample that does not fit the memory budget on its own is still run,
+    one at a time.
+
+    In adaptive mode a sample's threads are its size's share of the CPU
+    budget, relative to all samples not yet finished, so large samples get
+    more threads than small ones and the last samples, which nothing is
+    queued behind, split every CPU left between them. humann3 cannot
+    change its threads once started, so this is decided when a sample
+    starts.
+
+    Parameters
+    ----------
+    samples : dict of str to list of str
+        FASTQ files of every sample
+    memory_use : str
+        The humann3 memory_use setting, used to estimate memory
+    max_memory : float, optional
+        Memory budget in GB, unbounded when omitted
+    max_cpus : int
+        CPU budget shared by all running samples
+    min_threads : int
+        Fewest threads a sample is started with
+    max_threads : int, optional
+        Most threads a sample is started with when not adaptive, unbounded
+        when omitted
+    adaptive : bool
+        Size weighted threads rather than an even split of the free CPUs
+    """
+
+    def __init__(
+        self,
+        samples: Dict[str, List[str]],
+        memory_use: str,
+        max_memory: Optional[float],
+        max_cpus: int,
+        min_threads: int = 1,
+        adaptive: bool = False,
+        max_threads: Optional[int] = None,
+    ):
+        jobs = []
+        for sample, paths in samples.items():
+            size = sum(os.path.getsize(path) for path in paths)
+            jobs.append(_Job(sample, paths, size, _estimate_memory(size, memory_use)))
+        self._pending = sorted(jobs, key=lambda job: job.size, reverse=True)
+        self._free_memory = float("inf") if max_memory is None else max_memory
+        self._free_cpus = max_cpus
+        self._max_cpus = max_cpus
+        self._min_threads = max(1, min(min_threads, max_cpus))
+        self._max_threads = max_cpus
+        if max_threads is not None:
+            self._max_threads = max(self._min_threads, max_threads)
+        self._adaptive = adaptive
+        self._running = 0
+        # bytes of reads of the running samples
+        self._running_size = 0
+        self.max_parallel = max(1, max_cpus // self._min_threads)
+
+    @property
+    def done(self) -> bool:
+        return not self._pending and not self._running
+
+    def _fits(self, job: _Job, memory: float, cpus: int, running: int) -> bool:
+        if cpus < self._min_threads:
+            return False
+        return job.memory <= memory or not running
+
+    def _startable(self) -> int:
+        """How many pending samples, in order, could be started right now"""
+        memory, cpus, running = self._free_memory, self._free_cpus, self._running
+        count = 0
+        for job in self._pending:
+            if not self._fits(job, memory, cpus, running):
+                break
+            memory -= job.memory
+            cpus -= self._min_threads
+            running += 1
+            count += 1
+        return count
+
+    def _share(self, job: _Job, unfinished: int) -> int:
+        """Threads of a sample in proportion to its part of the unfinished reads"""
+        share = int(self._max_cpus * max(job.size, 1) / max(unfinished, 1))
+        return max(self._min_threads, share)
+
+    def _adaptive_batch(self) -> List[Tuple[_Job, int]]:
+        """The pending samples to start now with their size weighted threads"""
+        memory, cpus, running = self._free_memory, self._free_cpus, self._running
+        unfinished = self._running_size + sum(job.size for job in self._pending)
+        batch = []
+        for job in self._pending:
+            if not self._fits(job, memory, cpus, running):
+                break
+            threads = min(cpus, self._share(job, unfinished))
+            batch.append((job, threads))
+            memory -= job.memory
+            cpus -= threads
+            running += 1
+
+        if batch and (len(batch) == len(self._pending) or cpus >= self._min_threads):
+            # no queued sample can use the free CPUs, either because none is
+            # left or because of memory, so the batch splits all of them
+            cpus = self._free_cpus
+            weight = sum(max(job.size, 1) for job, _ in batch)
+            for i, (job, _) in enumerate(batch):
+                rest = len(batch) - i - 1
+                threads = max(
+                    self._min_threads,
+                    min(int(cpus * max(job.size, 1) / weight), cpus - rest * self._min_threads),
+                )
+                batch[i] = (job, threads if rest else cpus)
+                cpus -= threads
+                weight -= max(job.size, 1)
+        return batch
+
+    def admit(self) -> List[Tuple[_Job, int]]:
+        """Start as many pending samples as the budgets allow"""
+        if self._adaptive:
+            batch = self._adaptive_batch()
+        else:
+            startable = self._startable()
+            batch = []
+            free_cpus = self._free_cpus
+            for job in self._pending[:startable]:
+                threads = max(self._min_threads, free_cpus // (startable - len(batch)))
+                threads = min(threads, self._max_threads)
+                free_cpus -= threads
+                batch.append((job, threads))
+
+        # batches are always taken from the front of the queue
+        del self._pending[: len(batch)]
+        for job, threads in batch:
+            self._free_memory -= job.memory
+            self._free_cpus -= threads
+            self._running += 1
+            self._running_size += job.size
+        return batch
+
+    def release(self, job: _Job, threads: int) -> None:
+        """Return the resources of a finished sample"""
+        self._free_memory += job.memory
+        self._free_cpus += threads
+        self._running -= 1
+        self._running_size -= job.size
+
+    def retry(self, job: _Job) -> None:
+        """Queue a failed sample again"""
+        self._pending.append(job)
+        self._pending.sort(key=lambda job: job.size, reverse=True)
+
+
+def _in_thread(func: Callable, *args, **kwargs) -> asyncio.Future:
+    """Run a blocking call in the executor of the running event loop"""
+    return asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+@contextmanager
+def _cancel_on_signals(task: asyncio.Task, received: List[int]):
+    """
+    Cancel ``task`` on SIGINT or SIGTERM, recording the signal in
+    ``received``, so running samples are killed before the signal is
+    handled as usual. Signals can only be caught in the main thread.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    loop = asyncio.get_running_loop()
+    previous = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        handler = signal.getsignal(signum)
+        if handler in (signal.SIG_IGN, None):
+            continue
+        previous[signum] = handler
+        loop.add_signal_handler(
+            signum, lambda signum=signum: (received.append(signum), task.cancel())
+        )
+    try:
+        yield
+    finally:
+        for signum, handler in previous.items():
+            loop.remove_signal_handler(signum)
+            signal.signal(signum, handler)
+
+
+async def _supervise(
+    scheduler: _SampleScheduler,
+    func: Callable[[str, int], Awaitable[None]],
+    retries: int,
+    received: List[int],
+) -> List[_Failure]:
+    attempts: Counter = Counter()
+    failures = []
+    running: Dict[asyncio.Task, Tuple[_Job, int]] = {}
+    # blocking steps of the samples, such as decompressing their reads,
+    # run in threads, at most one per sample that can run at once
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=scheduler.max_parallel))
+
+    with _cancel_on_signals(asyncio.current_task(), received):
+        try:
+            while not scheduler.done:
+                for job, threads in scheduler.admit():
+                    running[asyncio.ensure_future(func(job.sample, threads))] = (job, threads)
+
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    job, threads = running.pop(task)
+                    scheduler.release(job, threads)
+                    error = task.exception()
+                    if error is None:
+                        continue
+
+                    attempts[job.sample] += 1
+                    if attempts[job.sample] <= retries:
+                        scheduler.retry(job)
+                    else:
+                        failures.append(
+                            _Failure(
+                                job.sample,
+                                job.paths,
+                                attempts[job.sample],
+                                _describe_error(error),
+                            )
+                        )
+        except asyncio.CancelledError:
+            # every sample kills its process group when cancelled
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+
+    return failures
+
+
+def _run_coroutine(coroutine: Awaitable):
+    """
+    Run a coroutine to completion in a new event loop.
+
+    When this thread already runs an event loop, as in a notebook, the
+    coroutine runs in another thread and is cancelled if this one is
+    interrupted.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        in_event_loop = False
+    else:
+        in_event_loop = True
+    if not in_event_loop:
+        return asyncio.run(coroutine)
+
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(coroutine)
+
+    def run() -> None:
+        try:
+            loop.run_until_complete(asyncio.wait([task]))
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        thread.join()
+    except BaseException:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+        raise
+    return task.result()
+
+
+def _run_scheduled(
+    scheduler: _SampleScheduler,
+    func: Callable[[str, int], Awaitable[None]],
+    retries: int = 0,
+) -> List[_Failure]:
+    """
+    Run the coroutine ``func(sample, threads)`` for every sample as the
+    scheduler admits it, all in one event loop.
+
+    A failing sample is queued again up to ``retries`` times and never stops
+    the other samples. The samples that still failed are returned. On
+    SIGINT or SIGTERM the running samples are cancelled, and so killed,
+    before the signal is handled as it would have been.
+    """
+    received: List[int] = []
+    try:
+        return _run_coroutine(_supervise(scheduler, func, retries, received))
+    except asyncio.CancelledError:
+        if not received:
+            raise
+    signal.raise_signal(received[0])
+    raise RuntimeError("Cancelled by signal %d" % received[0])
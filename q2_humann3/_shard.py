@@ -0,0 +1,89 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Dict, Iterable, List, Optional
+
+from q2_humann3._merge import _sample_outputs, _SampleAggregator
+
+
+def _shard_of(sample_id: str, n_shards: int) -> int:
+    """Shard a sample belongs to, the same on every node and run"""
+    return int(hashlib.sha256(sample_id.encode()).hexdigest(), 16) % n_shards
+
+
+def _select_shard(
+    samples: dict,
+    sample_ids: Optional[List[str]] = None,
+    n_shards: int = 1,
+    shard_index: int = 0,
+) -> Dict[str, List[str]]:
+    """
+    FASTQ files of the samples in one shard.
+
+    Parameters
+    ----------
+    samples : dict of str to list of str
+        FASTQ files of every sample ID
+    sample_ids : list of str, optional
+        Samples of the shard, all samples when omitted
+    n_shards : int
+        Number of shards the samples are hash partitioned into
+    shard_index : int
+        Which of the hash partitions to keep
+    """
+    if not 0 <= shard_index < n_shards:
+        raise ValueError(
+            "shard_index must be between 0 and %d, not %d" % (n_shards - 1, shard_index)
+        )
+    if sample_ids:
+        missing = set(sample_ids) - set(samples)
+        if missing:
+            raise ValueError(
+                "Samples not found in the sequences: %s" % ", ".join(sorted(missing))
+            )
+
+    return {
+        sample_id: paths
+        for sample_id, paths in samples.items()
+        if (not sample_ids or sample_id in sample_ids)
+        and _shard_of(sample_id, n_shards) == shard_index
+    }
+
+
+def _keep_profile(sample_name: str, sample_output: str, profiles: str) -> None:
+    """
+    Move the tables and MetaPhlAn profile of one sample into ``profiles``,
+    replacing what an earlier attempt of a retried sample kept.
+    """
+    target = os.path.join(profiles, sample_name)
+    shutil.rmtree(target, ignore_errors=True)
+    partial = tempfile.mkdtemp(prefix=".%s-" % sample_name, dir=profiles)
+    try:
+        for path in _sample_outputs(sample_output).values():
+            shutil.move(path, os.path.join(partial, os.path.basename(path)))
+        os.chmod(partial, 0o755)
+        os.rename(partial, target)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+
+def _fold_profiles(profiles: Iterable[str], aggregator: _SampleAggregator) -> None:
+    """
+    Fold the samples of every shard, which must not overlap. Empty shards
+    are skipped, but at least one shard must hold a sample.
+    """
+    seen = {}
+    profiles = list(profiles)
+    for shard in profiles:
+        for sample_name in sorted(os.listdir(shard)):
+            if sample_name in seen:
+                raise ValueError(
+                    "Sample %s is in more than one shard: %s and %s"
+                    % (sample_name, seen[sample_name], shard)
+                )
+            seen[sample_name] = shard
+            aggregator.add(os.path.join(shard, sample_name))
+    if not seen:
+        raise ValueError("None of the %d shards holds a sample" % len(profiles))
@@ -0,0 +1,50 @@
+from typing import Tuple
+
+import biom
+import numpy as np
+
+from q2_humann3._merge import STRATIFICATION_DELIMITER
+
+
+def _stratified_rows(table: biom.Table) -> np.ndarray:
+    """Boolean index of the ``FEATURE|taxon`` rows of a table"""
+    ids = table.ids(axis="observation").astype(str)
+    return np.char.find(ids, STRATIFICATION_DELIMITER) >= 0
+
+
+def _select_rows(table: biom.Table, rows: np.ndarray) -> biom.Table:
+    """The rows of a table where ``rows`` is true, keeping their metadata"""
+    metadata = table.metadata(axis="observation")
+    return biom.Table(
+        table.matrix_data.tocsr()[rows],
+        table.ids(axis="observation")[rows],
+        table.ids(axis="sample"),
+        observation_metadata=None if metadata is None else list(np.asarray(metadata)[rows]),
+        sample_metadata=table.metadata(axis="sample"),
+        table_id=table.table_id,
+    )
+
+
+def _split_stratified(table: biom.Table) -> Tuple[biom.Table, biom.Table]:
+    """
+    Split a table into its stratified and unstratified rows.
+
+    Rows are assigned as ``humann_split_stratified_table`` does: a row is
+    stratified when its ID contains ``|``, special features included.
+
+    Parameters
+    ----------
+    table : biom.Table
+        table
+
+    Returns
+    -------
+    biom.Table
+        The stratified rows
+    biom.Table
+        The unstratified rows
+
+    """
+    stratified = _stratified_rows(table)
+    return _select_rows(table, stratified), _select_rows(table, ~stratified)
+
@@ -0,0 +1,186 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import qiime2
+
+from q2_humann3._cache import _CHUNK_SIZE, _database_identity
+from q2_humann3._format import Bowtie2IndexDirFmt2, HumannDbDirFormat
+from q2_humann3._validation import (_check_bowtie2_index, _check_database,
+                                    _check_header, _write_checksums)
+
+# FICLONE from linux/fs.h, shares the blocks of a file on btrfs and XFS
+_FICLONE = 0x40049409
+
+_DATABASE_FORMATS = {
+    "HumannDB[Nucleotide]": HumannDbDirFormat,
+    "HumannDB[Protein]": HumannDbDirFormat,
+    "Bowtie2Index2": Bowtie2IndexDirFmt2,
+}
+
+
+def _reflink(source: str, target: str) -> None:
+    """Copy-on-write clone of ``source``, on filesystems that support it"""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            os.remove(target)
+            raise
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    """
+    Hardlink ``source`` to ``target``, reflinking where hardlinks are not
+    allowed and copying across filesystems
+    """
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    try:
+        _reflink(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _list_files(path: str) -> dict:
+    """Relative path and size of every file below ``path``"""
+    return {
+        os.path.relpath(os.path.join(root, name), path): os.path.getsize(
+            os.path.join(root, name)
+        )
+        for root, _, files in os.walk(path)
+        for name in files
+    }
+
+
+def _prewarm(path: str) -> None:
+    """Read every file below ``path`` once so it is in the page cache"""
+
+    def read(file_path):
+        with open(file_path, "rb", buffering=0) as fh:
+            while fh.read(_CHUNK_SIZE * 16):
+                pass
+
+    paths = [os.path.join(path, name) for name in _list_files(path)]
+    with ThreadPoolExecutor(max_workers=min(8, len(paths) or 1)) as executor:
+        list(executor.map(read, paths))
+
+
+def _listing_digest(files: dict) -> str:
+    """Short digest of the relative paths and sizes ``_list_files`` returns"""
+    digest = hashlib.sha256()
+    for name, size in sorted(files.items()):
+        digest.update(("%s\t%d\n" % (name, size)).encode())
+    return digest.hexdigest()[:16]
+
+
+def _stage_database(path: str, staging_dir: str, prewarm: bool = False) -> str:
+    """
+    Copy a database artifact to node-local storage once and return its path.
+
+    The staged copy is named after the artifact's UUID and the paths and
+    sizes of its files, so later runs reuse it and a database that differs
+    is staged next to it rather than over it: a staged copy is never
+    replaced, and runs still reading it are unaffected. Copies are
+    assembled in a temporary directory and renamed into place, so
+    concurrent runs never see a partial copy.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the database artifact
+    staging_dir : str
+        Node-local directory the databases are staged in
+    prewarm : bool
+        Read the staged files once to load them into the page cache
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    files = _list_files(path)
+    staged = os.path.join(
+        staging_dir, "%s-%s" % (_database_identity(path), _listing_digest(files))
+    )
+
+    if not os.path.isdir(staged):
+        partial = tempfile.mkdtemp(prefix=".staging-", dir=staging_dir)
+        try:
+            for name in files:
+                target = os.path.join(partial, name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                _link_or_copy(os.path.join(path, name), target)
+            # mkdtemp is private to this user, staged databases are shared
+            os.chmod(partial, 0o755)
+            os.rename(partial, staged)
+        except OSError:
+            # another run staged the same database first
+            shutil.rmtree(partial, ignore_errors=True)
+            if not os.path.isdir(staged):
+                raise
+    elif _list_files(staged) != files:
+        raise ValueError(
+            "The staged database %s was changed after it was staged, remove it"
+            " to stage %s again" % (staged, path)
+        )
+
+    if prewarm:
+        _prewarm(staged)
+    return staged
+
+
+def import_database(
+    path: str, semantic_type: str, threads: Optional[int] = None
+) -> qiime2.Artifact:
+    """
+    Import a humann3 or MetaPhlAn database directory without copying it.
+
+    The files are hardlinked, or reflinked, into the artifact rather than
+    copied, and fully checked in parallel: DIAMOND and bowtie2 headers,
+    and every compressed file decompressed once to find truncated
+    downloads. Their checksums are recorded in the artifact so a later
+    thorough validation only needs to hash them.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the database files
+    semantic_type : str
+        HumannDB[Nucleotide], HumannDB[Protein] or Bowtie2Index2
+    threads : int, optional
+        Files checked at once, by default up to 8
+
+    Returns
+    -------
+    qiime2.Artifact
+        The database artifact. Saving it as a .qza still writes a zip
+        archive, keep it in a QIIME 2 cache to avoid that copy.
+    """
+    if semantic_type not in _DATABASE_FORMATS:
+        raise ValueError(
+            "semantic_type must be one of %s, not %r"
+            % (", ".join(_DATABASE_FORMATS), semantic_type)
+        )
+    database = _DATABASE_FORMATS[semantic_type]()
+    target = str(database)
+    files = _list_files(path)
+
+    def link(name):
+        os.makedirs(os.path.dirname(os.path.join(target, name)), exist_ok=True)
+        _link_or_copy(os.path.join(path, name), os.path.join(target, name))
+
+    with ThreadPoolExecutor(max_workers=min(8, len(files) or 1)) as executor:
+        list(executor.map(link, files))
+
+    # the cheap checks first, before every file is read
+    for name in files:
+        _check_header(os.path.join(target, name))
+    if isinstance(database, Bowtie2IndexDirFmt2):
+        _check_bowtie2_index(target)
+    _write_checksums(target, _check_database(target, threads, digest=True))
+
+    return qiime2.Artifact.import_data(semantic_type, database, validate_level="min")
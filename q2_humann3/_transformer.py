@@ -0,0 +1,22 @@
+import pandas as pd
+import qiime2
+
+from q2_humann3._format import HumannReportFormat
+from q2_humann3.plugin_setup import plugin
+
+
+@plugin.register_transformer
+def _1(data: pd.DataFrame) -> HumannReportFormat:
+    ff = HumannReportFormat()
+    data.to_csv(str(ff), sep="\t", index=True, index_label="id")
+    return ff
+
+
+@plugin.register_transformer
+def _2(ff: HumannReportFormat) -> pd.DataFrame:
+    return pd.read_csv(str(ff), sep="\t", index_col="id", dtype={"id": str})
+
+
+@plugin.register_transformer
+def _3(ff: HumannReportFormat) -> qiime2.Metadata:
+    return qiime2.Metadata(_2(ff))
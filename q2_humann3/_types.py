@@ -1,3 +1,4 @@
+from q2_types.sample_data import SampleData
 from qiime2.plugin import SemanticType
 
 HumannDB = SemanticType("HumannDB", field_names=["annotation"])
@@ -9,3 +10,9 @@ PathwayMapping = SemanticType("PathwayMapping", variant_of=HumannDB.field["annot
 ReferenceNameMapping = SemanticType(
     "ReferenceNameMapping", variant_of=HumannDB.field["annotation"]
 )
+GroupMapping = SemanticType("GroupMapping", variant_of=HumannDB.field["annotation"])
+
+HumannReport = SemanticType("HumannReport")
+
+HumannProfiles = SemanticType("HumannProfiles", variant_of=SampleData.field["type"])
+HumannAlignments = SemanticType("HumannAlignments", variant_of=SampleData.field["type"])
@@ -0,0 +1,229 @@
+import bz2
+import hashlib
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from q2_humann3._cache import _CHUNK_SIZE
+
+# sha256sum style manifest written into database artifacts on import
+CHECKSUMS = "checksums.sha256"
+
+# DIAMOND's reference header: magic number, build, database version,
+# sequences, letters and the offset of the position array, which is
+# written after all sequences
+_DIAMOND_MAGIC = 0x24AF8A415EE186D
+_DIAMOND_HEADER = struct.Struct("<QIIQQQ")
+# every sequence has at least an 8 byte offset in the position array
+_DIAMOND_POSITION_SIZE = 8
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_BZIP2_MAGIC = b"BZh"
+_FASTA_SUFFIXES = (".ffn", ".fna", ".fa", ".fasta", ".faa")
+
+# bowtie2 .1 and .3 index files start with the endianness sentinel 1; the
+# forward and reverse .1 indexes follow it with the int32 index version and
+# the length of the reference, 32 bits in small .bt2 and 64 bits in large
+# .bt2l indexes
+_BOWTIE2_SENTINEL = struct.Struct("<I")
+_BOWTIE2_HEADERS = {".bt2": "IiI", ".bt2l": "IiQ"}
+
+
+def _decompressor(name: str):
+    """Decompressor for the suffix of ``name``, None for plain files"""
+    if name.endswith(".gz"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if name.endswith((".bz2", ".pkl", ".pk")):
+        # MetaPhlAn pickles are bzip2 compressed
+        return bz2.BZ2Decompressor()
+    return None
+
+
+def _check_diamond(path: str, size: int) -> None:
+    with open(path, "rb") as fh:
+        header = fh.read(_DIAMOND_HEADER.size)
+    if len(header) < _DIAMOND_HEADER.size:
+        raise ValueError("%s is too short to be a DIAMOND database" % path)
+    magic, _, _, sequences, _, positions = _DIAMOND_HEADER.unpack(header)
+    if magic != _DIAMOND_MAGIC:
+        raise ValueError("%s is not a DIAMOND database" % path)
+    if positions + sequences * _DIAMOND_POSITION_SIZE > size:
+        raise ValueError(
+            "%s is truncated, it holds %d bytes but its header lists %d sequences"
+            " ending after byte %d" % (path, size, sequences, positions)
+        )
+
+
+def _check_header(path: str) -> None:
+    """
+    Check that a database file starts the way its name says it should.
+
+    Only the first bytes are read, so this is cheap even for UniRef: the
+    DIAMOND header, gzip and bzip2 magic numbers and the ``>`` of FASTA
+    files, compressed or not.
+    """
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    if name.endswith(".dmnd"):
+        _check_diamond(path, size)
+        return
+
+    with open(path, "rb") as fh:
+        head = fh.read(_CHUNK_SIZE)
+    decompressor = _decompressor(name)
+    if name.endswith(".gz") and not head.startswith(_GZIP_MAGIC):
+        raise ValueError("%s is not gzip compressed" % path)
+    if decompressor is not None and not name.endswith(".gz"):
+        if not head.startswith(_BZIP2_MAGIC):
+            raise ValueError("%s is not bzip2 compressed" % path)
+
+    content = name[: -len(".gz")] if name.endswith(".gz") else name
+    content = content[: -len(".bz2")] if content.endswith(".bz2") else content
+    if content.endswith(_FASTA_SUFFIXES):
+        if decompressor is not None:
+            try:
+                head = decompressor.decompress(head, 1)
+            except (OSError, EOFError, zlib.error) as error:
+                raise ValueError("%s could not be decompressed: %s" % (path, error))
+        if not head.startswith(b">"):
+            raise ValueError("%s is not a FASTA file" % path)
+
+
+def _check_file(
+    path: str, checksum: Optional[str] = None, digest: bool = False
+) -> Optional[str]:
+    """
+    Read a whole database file once, decompressing it to find truncated or
+    corrupt archives, and return its sha256 when ``digest`` is set.
+
+    When the ``checksum`` recorded on import is given, the file is only
+    hashed, which is faster than decompressing and proves the same.
+    Uncompressed files without a checksum have nothing to prove and are
+    not read unless their digest is wanted.
+    """
+    decompressor = None if checksum else _decompressor(path)
+    if not (checksum or digest or decompressor):
+        return None
+    sha256 = hashlib.sha256()
+    with open(path, "rb", buffering=0) as fh:
+        for chunk in iter(lambda: fh.read(_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            while decompressor is not None and chunk:
+                if decompressor.eof:
+                    # concatenated members or streams, as pigz and pbzip2 write
+                    decompressor = _decompressor(path)
+                try:
+                    decompressor.decompress(chunk)
+                except (OSError, EOFError, zlib.error) as error:
+                    raise ValueError("%s is corrupt: %s" % (path, error))
+                chunk = decompressor.unused_data
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError("%s is truncated" % path)
+
+    hexdigest = sha256.hexdigest()
+    if checksum and hexdigest != checksum:
+        raise ValueError("%s does not match the checksum recorded on import" % path)
+    return hexdigest
+
+
+def _read_checksums(path: str) -> Optional[Dict[str, str]]:
+    """Relative path to checksum of the manifest in ``path``, if it has one"""
+    manifest = os.path.join(path, CHECKSUMS)
+    if not os.path.exists(manifest):
+        return None
+    checksums = {}
+    with open(manifest) as fh:
+        for line in fh:
+            checksum, name = line.rstrip("\n").split("  ", 1)
+            checksums[name] = checksum
+    return checksums
+
+
+def _database_files(path: str) -> Iterable[str]:
+    """Relative paths of the files of a database directory, but its manifest"""
+    for root, _, files in os.walk(path):
+        for name in files:
+            relative = os.path.relpath(os.path.join(root, name), path)
+            if relative != CHECKSUMS:
+                yield relative
+
+
+def _check_database(
+    path: str, threads: Optional[int] = None, digest: bool = False
+) -> Dict[str, Optional[str]]:
+    """
+    Fully check every file of a database directory in parallel.
+
+    Files are verified against the manifest written on import when there is
+    one, and decompressed otherwise. Returns the checksum of every file,
+    which is only computed for all of them when ``digest`` is set.
+    """
+    checksums = _read_checksums(path)
+    files = sorted(_database_files(path))
+    if checksums is not None and set(checksums) != set(files):
+        missing = sorted(set(checksums) - set(files))
+        extra = sorted(set(files) - set(checksums))
+        raise ValueError(
+            "The files of %s do not match its %s, missing: %s, not listed: %s"
+            % (path, CHECKSUMS, ", ".join(missing) or "none", ", ".join(extra) or "none")
+        )
+
+    def check(name):
+        return _check_file(
+            os.path.join(path, name),
+            None if checksums is None else checksums[name],
+            digest,
+        )
+
+    threads = threads or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(files, executor.map(check, files)))
+
+
+def _write_checksums(path: str, checksums: Dict[str, str]) -> None:
+    with open(os.path.join(path, CHECKSUMS), "w") as fh:
+        for name in sorted(checksums):
+            fh.write("%s  %s\n" % (checksums[name], name))
+
+
+def _check_bowtie2_index(path: str) -> None:
+    """
+    Check that the bowtie2 index files of a directory belong together: one
+    base name, valid endianness sentinels, and forward and reverse indexes
+    of the same reference length.
+    """
+    names = [name for name in os.listdir(path) if name != CHECKSUMS]
+    bases = {name.split(".")[0] for name in names}
+    if len(bases) != 1:
+        raise ValueError(
+            "The index files in the Bowtie database are not named in a"
+            " consistent fashion, found the base names %s" % ", ".join(sorted(bases))
+        )
+
+    lengths = {}
+    for name in names:
+        base, _, suffix = name.rpartition(".")
+        header_format = _BOWTIE2_HEADERS.get("." + suffix)
+        if header_format is None or not base.endswith((".1", ".3")):
+            continue
+        with open(os.path.join(path, name), "rb") as fh:
+            header = fh.read(struct.calcsize("<" + header_format))
+        if len(header) < _BOWTIE2_SENTINEL.size:
+            raise ValueError("%s is too short to be a bowtie2 index" % name)
+        (sentinel,) = _BOWTIE2_SENTINEL.unpack_from(header)
+        if sentinel not in (1, 1 << 24):
+            raise ValueError("%s is not a bowtie2 index" % name)
+        if base.endswith(".1"):
+            header_format = ("<" if sentinel == 1 else ">") + header_format
+            if len(header) < struct.calcsize(header_format):
+                raise ValueError("%s is too short to be a bowtie2 index" % name)
+            _, _, lengths[name] = struct.unpack(header_format, header)
+
+    if len(set(lengths.values())) > 1:
+        raise ValueError(
+            "The forward and reverse bowtie2 indexes were built from different"
+            " references: %s"
+            % ", ".join("%s has length %d" % item for item in sorted(lengths.items()))
+        )
@@ -0,0 +1,330 @@
+"""
+Run humann3 from Python and get its tables straight from memory.
+
+The actions of the plugin take and return QIIME 2 artifacts. These
+functions take plain paths instead: FASTQ files or a demultiplexed
+sequences directory, and database directories or files. They return
+each merged table as a sparse matrix with its feature and sample IDs,
+without writing it to disk or importing it into an artifact. ``profile``
+returns all four tables, with the failed samples and the metrics of the
+run, like the outputs of ``run``. ``iter_profile`` profiles every sample
+first and then yields each table as soon as it is assembled, so you can
+start on the gene families while the pathway tables are still being
+merged.
+
+Example::
+
+    from q2_humann3.api import iter_profile
+
+    run = iter_profile(
+        {"S1": ["S1_R1.fastq.gz", "S1_R2.fastq.gz"]},
+        nucleotide_database="chocophlan",
+        protein_database="uniref",
+        pathway_database="metacyc_pathways_structured_filtered_v24",
+        pathway_mapping="metacyc_reactions_level4ec_only.uniref.bz2",
+        bowtie_database="mpa_vJan21",
+        humann3_threads=8,
+        skip_failed=True,
+    )
+    for name, table in run:
+        ...
+    print(run.failures)
+"""
+import os
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import biom
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from q2_humann3._humann import (_final_table, _profile_samples,
+                                _temporary_directory)
+from q2_humann3._merge import HUMANN_TABLES, _Pruning, _SampleAggregator
+from q2_humann3._metrics import _RunMetrics
+from q2_humann3._reads import _manifest_reads
+
+__all__ = ["HumannProfile", "HumannTable", "ProfileRun", "TABLES", "iter_profile",
+           "profile"]
+
+# the tables of a run, in the order they are assembled
+TABLES = HUMANN_TABLES + ("taxonomy",)
+
+# parameters of ``run`` passed through the options of ``iter_profile``, the
+# alignments of ``keep_alignments`` are an artifact this API does not return
+_RUN_OPTIONS = (
+    "taxonomic_profiles", "n_parallel_samples", "humann3_threads", "memory_use",
+    "metaphlan_stat_q", "cache_dir", "cache_max_size", "max_memory", "max_cpus",
+    "adaptive_threads", "retries", "sample_timeout", "skip_failed", "staging_dir",
+    "prewarm_databases",
+)
+
+
+@dataclass(frozen=True)
+class HumannTable:
+    """
+    A merged humann3 table.
+
+    Attributes
+    ----------
+    data : scipy.sparse.csr_matrix
+        Features by samples
+    feature_ids : np.ndarray
+        The ID of every row, stratified rows are ``FEATURE|taxon``
+    sample_ids : np.ndarray
+        The ID of every column
+    metadata : list of dict, optional
+        Metadata of every row, the ranks and NCBI taxonomy ID of every
+        clade of the taxonomy
+    """
+
+    data: sparse.csr_matrix
+    feature_ids: np.ndarray
+    sample_ids: np.ndarray
+    metadata: Optional[List[dict]] = None
+
+    @classmethod
+    def from_biom(cls, table: biom.Table) -> "HumannTable":
+        """The matrix, IDs and metadata of a biom table, without copying"""
+        metadata = table.metadata(axis="observation")
+        return cls(
+            table.matrix_data.tocsr(),
+            table.ids(axis="observation"),
+            table.ids(axis="sample"),
+            None if metadata is None else [dict(m) for m in metadata],
+        )
+
+    def to_biom(self) -> biom.Table:
+        """The table as a biom table, like the tables ``run`` returns"""
+        return biom.Table(
+            self.data,
+            self.feature_ids,
+            self.sample_ids,
+            observation_metadata=self.metadata,
+        )
+
+
+def _samples(
+    samples: Union[str, Dict[str, Union[str, List[str]]]]
+) -> Dict[str, List[str]]:
+    """FASTQ files of every sample, from a mapping or a demultiplexed directory"""
+    if isinstance(samples, (str, os.PathLike)):
+        return _manifest_reads(samples)
+    return {
+        str(sample_id): [str(paths)] if isinstance(paths, (str, os.PathLike))
+        else [str(path) for path in paths]
+        for sample_id, paths in samples.items()
+    }
+
+
+class ProfileRun:
+    """
+    The tables of a run, yielded one by one as ``(name, table)`` pairs, and
+    the reports ``run`` returns with them.
+
+    Nothing is yielded until every sample has been profiled, then each
+    table is assembled when it is asked for.
+
+    Attributes
+    ----------
+    failures : pd.DataFrame
+        The samples that failed every attempt, with their attempts and last
+        error. Set once every sample has been profiled, before the first
+        table is yielded
+    metrics : pd.DataFrame
+        Wall time, CPU time, peak memory and I/O of every sample and stage.
+        Set once the last table has been yielded
+    """
+
+    def __init__(self):
+        self.failures: Optional[pd.DataFrame] = None
+        self.metrics: Optional[pd.DataFrame] = None
+        self._tables: Iterator[Tuple[str, Union[HumannTable, biom.Table]]] = iter(())
+
+    def __iter__(self) -> "ProfileRun":
+        return self
+
+    def __next__(self) -> Tuple[str, Union[HumannTable, biom.Table]]:
+        return next(self._tables)
+
+
+@dataclass(frozen=True)
+class HumannProfile:
+    """
+    The merged tables of a run and its reports.
+
+    Attributes
+    ----------
+    tables : dict of str to HumannTable or biom.Table
+        Every table, by name
+    failures : pd.DataFrame
+        The samples that failed every attempt, with their attempts and last
+        error, empty when all succeeded
+    metrics : pd.DataFrame
+        Wall time, CPU time, peak memory and I/O of every sample and stage
+    """
+
+    tables: Dict[str, Union[HumannTable, biom.Table]]
+    failures: pd.DataFrame
+    metrics: pd.DataFrame
+
+
+def _tables(
+    run: ProfileRun,
+    samples: Dict[str, List[str]],
+    tables: Tuple[str, ...],
+    pruning: _Pruning,
+    as_biom: bool,
+    working_dir: Optional[str],
+    options: dict,
+) -> Iterator[Tuple[str, Union[HumannTable, biom.Table]]]:
+    metrics = _RunMetrics()
+    with _temporary_directory(working_dir) as merged:
+        aggregator = _SampleAggregator(merged, pruning)
+        run.failures = _profile_samples(
+            samples,
+            lambda sample_name, sample_output: aggregator.add(sample_output),
+            metrics,
+            working_dir=working_dir,
+            **options,
+        )
+        for name in tables:
+            table = _final_table(aggregator, name, metrics)
+            yield name, table if as_biom else HumannTable.from_biom(table)
+    run.metrics = metrics.to_dataframe()
+
+
+def iter_profile(
+    samples: Union[str, Dict[str, Union[str, List[str]]]],
+    nucleotide_database: str,
+    protein_database: str,
+    pathway_database: str,
+    pathway_mapping: str,
+    bowtie_database: str,
+    tables: Tuple[str, ...] = TABLES,
+    stratification: str = "both",
+    min_abundance: float = 0.0,
+    min_prevalence: float = 0.0,
+    top_features: Optional[int] = None,
+    as_biom: bool = False,
+    working_dir: Optional[str] = None,
+    **options,
+) -> ProfileRun:
+    """
+    Profile samples with humann3 and yield their merged tables one by one.
+
+    The samples are profiled when the first table is asked for, and folded
+    into the merged tables as each finishes, renormalized and pruned like
+    the tables of ``run``. Nothing is yielded until every sample has
+    finished. Each table is then assembled and yielded before the next one
+    is assembled. The failed samples and the metrics of the run are kept
+    on the returned ``ProfileRun``.
+
+    Parameters
+    ----------
+    samples : str or dict of str to list of str
+        The FASTQ files of every sample ID, forward then reverse reads for
+        paired-end samples, or a demultiplexed sequences directory with a
+        MANIFEST
+    nucleotide_database, protein_database : str
+        Directories of the ChocoPhlAn and UniRef databases
+    pathway_database, pathway_mapping : str
+        The humann3 pathway and reaction mapping files, or directories of
+        single file database artifacts
+    bowtie_database : str
+        Directory of the MetaPhlAn bowtie2 index
+    tables : tuple of str, optional
+        Which of genefamilies, pathcoverage, pathabundance and taxonomy to
+        yield, in this order
+    stratification : str, optional
+        Keep both, only the stratified or only the unstratified rows of the
+        gene family and pathway tables
+    min_abundance : float, optional
+        Relative abundance in its sample below which a gene family or
+        pathway abundance is dropped while merging
+    min_prevalence : float, optional
+        Fraction of the samples a gene family or pathway must be kept in
+    top_features : int, optional
+        How many gene families and pathways to keep, those with the highest
+        total relative abundance, by default all of them
+    as_biom : bool, optional
+        Yield biom tables instead of ``HumannTable``
+    working_dir : str, optional
+        Directory for the per-sample humann3 outputs and the folded values
+        of the merged tables, by default the system temporary directory
+    **options
+        The other parameters of ``run``, such as ``humann3_threads``,
+        ``max_memory``, ``cache_dir`` or ``skip_failed``, except
+        ``keep_alignments``
+
+    Returns
+    -------
+    ProfileRun
+        An iterator of the name and table of each of ``tables``, with the
+        ``failures`` and ``metrics`` of the run
+    """
+    unknown = [name for name in tables if name not in TABLES]
+    if unknown:
+        raise ValueError(
+            "tables must be some of %s, not %s" % (", ".join(TABLES), ", ".join(unknown))
+        )
+    unknown = sorted(set(options) - set(_RUN_OPTIONS))
+    if unknown:
+        raise ValueError(
+            "Unknown options: %s, the options are %s"
+            % (", ".join(unknown), ", ".join(_RUN_OPTIONS))
+        )
+    pruning = _Pruning(min_abundance, min_prevalence, top_features, stratification)
+
+    run = ProfileRun()
+    run._tables = _tables(
+        run,
+        _samples(samples),
+        tables,
+        pruning,
+        as_biom,
+        working_dir,
+        dict(
+            options,
+            nucleotide_database=nucleotide_database,
+            protein_database=protein_database,
+            pathway_database=pathway_database,
+            pathway_mapping=pathway_mapping,
+            bowtie_database=bowtie_database,
+        ),
+    )
+    return run
+
+
+def profile(
+    samples: Union[str, Dict[str, Union[str, List[str]]]],
+    nucleotide_database: str,
+    protein_database: str,
+    pathway_database: str,
+    pathway_mapping: str,
+    bowtie_database: str,
+    **options,
+) -> HumannProfile:
+    """
+    Profile samples with humann3 and return their merged tables.
+
+    Takes the parameters of ``iter_profile``.
+
+    Returns
+    -------
+    HumannProfile
+        Every table, by name, with the failed samples and the metrics of
+        the run
+    """
+    run = iter_profile(
+        samples,
+        nucleotide_database,
+        protein_database,
+        pathway_database,
+        pathway_mapping,
+        bowtie_database,
+        **options,
+    )
+    tables = dict(run)
+    return HumannProfile(tables, run.failures, run.metrics)
@@ -1,16 +1,27 @@
+import importlib
+
 import qiime2.plugin
 from q2_types.feature_table import FeatureTable, Frequency, RelativeFrequency
-from q2_types.per_sample_sequences import SequencesWithQuality
+from q2_types.per_sample_sequences import (PairedEndSequencesWithQuality,
+                                          SequencesWithQuality)
 from q2_types.sample_data import SampleData
-from qiime2.plugin import Bool, Choices, Float, Int, Range, SemanticType, Str
+from qiime2.plugin import (Bool, Choices, Collection, Float, Int, List, Range,
+                           SemanticType, Str, TypeMap)
 
 import q2_humann3
-from q2_humann3._format import (Bowtie2IndexDirFmt2, HumannDbDirFormat,
+from q2_humann3._format import (Bowtie2IndexDirFmt2,
+                                HumannAlignmentFileFormat,
+                                HumannAlignmentsDirFormat, HumannDbDirFormat,
                                 HumannDbFileFormat,
                                 HumannDBSingleFileDirFormat,
-                                HumannDBSingleReferenceFileDirFormat)
-from q2_humann3._types import (HumannDB, Nucleotide, Pathway, PathwayMapping,
-                               Protein, ReferenceNameMapping)
+                                HumannDBSingleReferenceFileDirFormat,
+                                HumannProfileFileFormat,
+                                HumannProfilesDirFormat, HumannReportDirFormat,
+                                HumannReportFormat)
+from q2_humann3._types import (GroupMapping, HumannAlignments, HumannDB,
+                               HumannProfiles,
+                               HumannReport, Nucleotide, Pathway,
+                               PathwayMapping, Protein, ReferenceNameMapping)
 
 plugin = qiime2.plugin.Plugin(
     name="humann3",
@@ -26,7 +37,15 @@ plugin = qiime2.plugin.Plugin(
 )
 
 plugin.register_semantic_types(
-    HumannDB, Nucleotide, Pathway, Protein, ReferenceNameMapping
+    HumannDB,
+    Nucleotide,
+    Pathway,
+    Protein,
+    ReferenceNameMapping,
+    GroupMapping,
+    HumannReport,
+    HumannProfiles,
+    HumannAlignments,
 )
 
 plugin.register_formats(
@@ -35,6 +54,12 @@ plugin.register_formats(
     HumannDBSingleFileDirFormat,
     Bowtie2IndexDirFmt2,
     HumannDBSingleReferenceFileDirFormat,
+    HumannReportFormat,
+    HumannReportDirFormat,
+    HumannProfileFileFormat,
+    HumannProfilesDirFormat,
+    HumannAlignmentFileFormat,
+    HumannAlignmentsDirFormat,
 )
 
 plugin.register_semantic_type_to_format(
@@ -48,7 +73,7 @@ plugin.register_semantic_type_to_format(Bowtie2Index2, Bowtie2IndexDirFmt2)
 # TODO: Add pathways and investigate what the other "databases" look like
 plugin.register_semantic_type_to_format(
     HumannDB[
-        PathwayMapping | Pathway,
+        PathwayMapping | Pathway | GroupMapping,
     ],
     HumannDBSingleFileDirFormat,
 )
@@ -58,106 +83,461 @@ plugin.register_semantic_type_to_format(
     HumannDBSingleReferenceFileDirFormat,
 )
 
+plugin.register_semantic_type_to_format(HumannReport, HumannReportDirFormat)
+plugin.register_semantic_type_to_format(
+    SampleData[HumannProfiles], HumannProfilesDirFormat
+)
+plugin.register_semantic_type_to_format(
+    SampleData[HumannAlignments], HumannAlignmentsDirFormat
+)
+
+_profile_inputs = {
+    "demultiplexed_seqs": SampleData[
+        SequencesWithQuality | PairedEndSequencesWithQuality  # type: ignore
+    ],
+    "nucleotide_database": HumannDB[Nucleotide],
+    "protein_database": HumannDB[Protein],
+    "pathway_database": HumannDB[Pathway],
+    "pathway_mapping": HumannDB[PathwayMapping],
+    "bowtie_database": Bowtie2Index2,
+    "taxonomic_profiles": FeatureTable[RelativeFrequency],
+}
+
+_profile_parameters = {
+    "n_parallel_samples": Int,
+    "humann3_threads": Int,
+    "memory_use": Str % Choices({"minimum", "maximum"}),
+    "metaphlan_stat_q": Float % Range(0, 1, inclusive_end=True),
+    "cache_dir": Str,
+    "cache_max_size": Float % Range(0, None),
+    "max_memory": Float % Range(0, None, inclusive_start=False),
+    "max_cpus": Int % Range(1, None),
+    "adaptive_threads": Bool,
+    "retries": Int % Range(0, None),
+    "sample_timeout": Float % Range(0, None, inclusive_start=False),
+    "skip_failed": Bool,
+    "staging_dir": Str,
+    "prewarm_databases": Bool,
+    "working_dir": Str,
+}
+
+_keep_alignments_description = (
+    "Keep the gzipped custom nucleotide database, bowtie2 and diamond"
+    " alignments and MetaPhlAn profile of every sample, so"
+    " resume_from_alignments can recompute the later stages with a new"
+    " protein or pathway database without aligning again. Samples are then"
+    " always run, never taken from cache_dir. They can take as much space as"
+    " the compressed reads"
+)
+
+_profile_input_descriptions = {
+    "demultiplexed_seqs": (
+        "sequence files that you wish to profile,"
+        " in fastq (or fastq.gz) format. The forward and"
+        " reverse reads of paired-end samples are"
+        " concatenated and profiled together, as humann3"
+        " does not use pairing information."
+    ),
+    "nucleotide_database": "directory containing the nucleotide database",
+    "protein_database": "directory containing the protein database",
+    "pathway_database": "directory providing a tab-delimited mapping",
+    "pathway_mapping": "directory providing the pathways mapping",
+    "bowtie_database": "directory containing the bowtie2 database reference files",
+    "taxonomic_profiles": (
+        "MetaPhlAn profiles of some or all of the samples, such as the taxonomy"
+        " output of an earlier run, with the full clade lineage as feature ID."
+        " These samples skip the MetaPhlAn prescreen and keep the given profile"
+        " in the taxonomy output. The profiles must come from the MetaPhlAn"
+        " database given as bowtie_database"
+    ),
+}
+
+_working_dir_description = (
+    "Directory for the per-sample humann3 outputs while they are merged and"
+    " for the merged values, e.g. scratch storage when the system temporary"
+    " directory is small. Each sample's humann3 temporary files are deleted"
+    " as soon as it finishes. Defaults to the system temporary directory"
+)
+
+_profile_parameter_descriptions = {
+    "n_parallel_samples": (
+        "Humann3 runs explicitly on a per-sample basis however q2-humann3 runs on a table of samples, i.e. "
+        "multiple samples. The sample-thread specifies how many samples should be run in parallel, this should "
+        "be a maximuim of n-1 processors. It is important to note that the memory required will scale "
+        "with threads. If 8GB of ram is expected for a single sample and 4 threads are selected you will need a "
+        "minimum of 32GB of ram. Memory use is highly dataset dependent and will change based on reference "
+        "databases, however, as a general run Humann3 will consume ~16GB of ram per sample. Use with caution"
+    ),
+    "humann3_threads": (
+        " The number of threads humann3 will use when processing a single sample. This will"
+        " for example call metaphlan with the number of threads specified where metaphlan will"
+        " implement its own multithreading. This should not be used in conjunction with the"
+        " sample_threads parameter. One or both of these paramers should be 1 unless you"
+        " are absolutely certain you have enough processors available. You should expect"
+        "  the number of processors required to be the number of"
+        " sample_threads * humann3_threads + 1, and the required memory to be a large multiple"
+        " of that, though it is highly dependent on your data set"
+    ),
+    "memory_use": "the amount of memory to use",
+    "metaphlan_stat_q": "Quantile value for the robust average",
+    "cache_dir": (
+        "Directory in which the per-sample humann3 outputs are cached. Samples"
+        " whose sequences, databases and options match a cached entry are not"
+        " profiled again, so failed or extended runs only compute new samples."
+        " MetaPhlAn profiles are also cached on their own and reused when only"
+        " the humann3 databases or memory use changed. Nothing is cached when"
+        " omitted"
+    ),
+    "cache_max_size": (
+        "Maximum size of the cache in GB. The least recently used samples are"
+        " evicted once a run finishes. The cache is unbounded when omitted"
+    ),
+    "max_memory": (
+        "Memory in GB that the samples running at once may use together. Each"
+        " sample's memory is estimated from the size of its FASTQ, samples are"
+        " started largest first and CPUs left idle by the memory limit are"
+        " given to the running samples as extra humann3 threads. When this or"
+        " max_cpus is set, n_parallel_samples is ignored and humann3_threads is"
+        " the fewest threads a sample is started with"
+    ),
+    "max_cpus": (
+        "CPUs that the samples running at once may use together. Defaults to"
+        " all CPUs when only max_memory or adaptive_threads is set, and to"
+        " n_parallel_samples * humann3_threads otherwise"
+    ),
+    "adaptive_threads": (
+        "Start each sample with threads in proportion to its share of the"
+        " reads not yet profiled, instead of splitting the CPUs evenly, so"
+        " large samples get more threads than small ones. CPUs that no"
+        " queued sample can use, at the end of the run or when max_memory"
+        " limits the samples running at once, go to the samples starting"
+        " then. MetaPhlAn and humann3 run with the same threads. Ignores"
+        " n_parallel_samples, humann3_threads is the fewest threads a sample"
+        " gets"
+    ),
+    "retries": "How many times a failed sample is run again before giving up",
+    "sample_timeout": (
+        "Hours a single sample may run before humann3 and its children are"
+        " killed and the attempt counts as failed. Unlimited when omitted"
+    ),
+    "skip_failed": (
+        "Return tables covering only the samples that succeeded instead of"
+        " failing the whole run. Failed samples are listed in failures"
+    ),
+    "staging_dir": (
+        "Node-local directory, e.g. on scratch storage, that the nucleotide,"
+        " protein and bowtie2 databases are copied to once before any sample"
+        " runs, so parallel samples do not all read them from network storage."
+        " Staged copies are kept and reused by later runs with the same"
+        " database artifacts, and never replaced while other runs may read"
+        " them: remove copies no longer used yourself"
+    ),
+    "prewarm_databases": (
+        "Read the staged databases once before running so they are in the page"
+        " cache. Only used with staging_dir"
+    ),
+    "working_dir": _working_dir_description,
+}
+
+_alignments_output_description = {
+    "alignments": (
+        "The alignment intermediates of every sample, for"
+        " resume_from_alignments. Empty unless keep_alignments is set"
+    ),
+}
+
+_stratification = Str % Choices({"both", "stratified", "unstratified"})  # type: ignore
+_stratification_description = (
+    "Return the community totals and the per-taxon FEATURE|taxon rows"
+    " of the gene family and pathway tables (both), or only the"
+    " stratified or unstratified rows"
+)
+
+_pruning_parameters = {
+    "min_abundance": Float % Range(0, 1, inclusive_end=True),
+    "min_prevalence": Float % Range(0, 1, inclusive_end=True),
+    "top_features": Int % Range(1, None),
+}
+_pruning_parameter_descriptions = {
+    "min_abundance": (
+        "Relative abundance in its sample below which a gene family or pathway"
+        " abundance is dropped while the samples are merged. Stratified rows"
+        " are judged on their own. UNMAPPED, UNGROUPED and UNINTEGRATED are"
+        " always kept"
+    ),
+    "min_prevalence": (
+        "Fraction of the samples a gene family or pathway must be kept in,"
+        " after min_abundance. Stratified rows are kept with their community"
+        " total"
+    ),
+    "top_features": (
+        "How many gene families and pathways to keep, those with the highest"
+        " relative abundance summed over all samples. By default all of them"
+    ),
+}
+
+_table_outputs = [
+    ("genefamilies", FeatureTable[Frequency]),  # type: ignore
+    ("pathcoverage", FeatureTable[Frequency]),  # type: ignore
+    ("pathabundance", FeatureTable[RelativeFrequency]),  # type: ignore
+    ("taxonomy", FeatureTable[RelativeFrequency]),  # type: ignore
+]
+
+_table_output_descriptions = {
+    "genefamilies": (
+        "This file details the abundance of each gene family in the community,"
+        " as relative abundance in each sample."
+    ),
+    "pathcoverage": (
+        "Pathway coverage provides an alternative description"
+        " of the presence (1) and absence (0) of pathways in"
+        " a community, independent of their quantitative"
+        " abundance."
+    ),
+    "pathabundance": (
+        "This file details the abundance of each pathway in"
+        " the community as a function of the abundances of"
+        " the pathway's component reactions, with each"
+        " reaction's abundance computed as the sum over"
+        " abundances of genes catalyzing the reaction, as relative abundance in"
+        " each sample."
+    ),
+    "taxonomy": (
+        "Taxonomic profile of microbial community of samples,"
+        " generated using clade-specific marker genes."
+    ),
+}
+
+_report_output_descriptions = {
+    "failures": (
+        "The samples that failed every attempt, with the number of attempts"
+        " and the reason of the last failure. Empty when all samples succeeded."
+    ),
+    "metrics": (
+        "Wall time and CPU time in seconds, peak memory of the process tree and"
+        " bytes read and written for every sample's humann3 run, the stages"
+        " humann3 logged (prescreen, nucleotide and translated alignment, ...)"
+        " and the fold of every sample and merge of every table, by"
+        " <sample>/<stage> with #2, #3, ... added for the later attempts of a"
+        " retried sample. Useful to size n_parallel_samples, max_memory and"
+        " memory_use."
+    ),
+}
+
 plugin.methods.register_function(
     function=q2_humann3.run,
-    inputs={
-        "demultiplexed_seqs": SampleData[SequencesWithQuality],
-        "nucleotide_database": HumannDB[Nucleotide],
-        "protein_database": HumannDB[Protein],
-        "pathway_database": HumannDB[Pathway],
-        "pathway_mapping": HumannDB[PathwayMapping],
-        "bowtie_database": Bowtie2Index2,
+    inputs=_profile_inputs,
+    parameters={
+        **_profile_parameters,
+        "keep_alignments": Bool,
+        "stratification": _stratification,
+        **_pruning_parameters,
     },
+    outputs=_table_outputs
+    + [
+        ("failures", HumannReport),  # type: ignore
+        ("metrics", HumannReport),  # type: ignore
+        ("alignments", SampleData[HumannAlignments]),  # type: ignore
+    ],
+    input_descriptions=_profile_input_descriptions,
+    parameter_descriptions={
+        **_profile_parameter_descriptions,
+        "keep_alignments": _keep_alignments_description,
+        "stratification": _stratification_description,
+        **_pruning_parameter_descriptions,
+    },
+    output_descriptions={
+        **_table_output_descriptions,
+        **_report_output_descriptions,
+        **_alignments_output_description,
+    },
+    name="Characterize samples using HUMAnN3",
+    description="Execute the HUMAnN3",
+)
+
+plugin.methods.register_function(
+    function=q2_humann3.profile_shard,
+    inputs=_profile_inputs,
     parameters={
-        "n_parallel_samples": Int,
-        "humann3_threads": Int,
-        "memory_use": Str % Choices({"minimum", "maximum"}),
-        "metaphlan_stat_q": Float % Range(0, 1, inclusive_end=True),
+        **_profile_parameters,
+        "sample_ids": List[Str],
+        "n_shards": Int % Range(1, None),
+        "shard_index": Int % Range(0, None),
+        "keep_alignments": Bool,
     },
     outputs=[
-        ("genefamilies", FeatureTable[Frequency]),  # type: ignore
-        ("pathcoverage", FeatureTable[Frequency]),  # type: ignore
-        ("pathabundance", FeatureTable[RelativeFrequency]),  # type: ignore
-        ("taxonomy", FeatureTable[RelativeFrequency]),  # type: ignore
+        ("profiles", SampleData[HumannProfiles]),  # type: ignore
+        ("failures", HumannReport),  # type: ignore
+        ("metrics", HumannReport),  # type: ignore
+        ("alignments", SampleData[HumannAlignments]),  # type: ignore
     ],
+    input_descriptions=_profile_input_descriptions,
+    parameter_descriptions={
+        **_profile_parameter_descriptions,
+        "sample_ids": (
+            "Samples this shard runs, as in the sequences manifest. By default"
+            " all samples"
+        ),
+        "n_shards": (
+            "Number of shards the samples are split into by a hash of their"
+            " sample ID, so independent jobs can each run one"
+        ),
+        "shard_index": "Which of the n_shards hash partitions this shard runs",
+        "keep_alignments": _keep_alignments_description,
+    },
+    output_descriptions={
+        "profiles": (
+            "The humann3 gene family and pathway tables and MetaPhlAn profile"
+            " of every sample of the shard, to be merged with finalize"
+        ),
+        **_report_output_descriptions,
+        **_alignments_output_description,
+    },
+    name="Characterize one shard of the samples using HUMAnN3",
+    description=(
+        "Run humann3 on a subset of the samples without merging them, so a"
+        " large run can be split into jobs on different nodes"
+    ),
+)
+
+plugin.methods.register_function(
+    function=q2_humann3.finalize,
+    inputs={"profiles": List[SampleData[HumannProfiles]]},
+    parameters={
+        "stratification": _stratification,
+        **_pruning_parameters,
+        "working_dir": Str,
+    },
+    outputs=_table_outputs,
     input_descriptions={
-        "demultiplexed_seqs": (
-            "sequence files that you wish to profile,"
-            " in fastq (or fastq.gz) format. Multiple"
-            " sequence files per sample need to first be"
-            " concatenated into 1 file."
-        ),
-        "nucleotide_database": "directory containing the nucleotide database",
-        "protein_database": "directory containing the protein database",
-        "pathway_database": "directory providing a tab-delimited mapping",
-        "pathway_mapping": "directory providing the pathways mapping",
-        "bowtie_database": "directory containing the bowtie2 database reference files",
+        "profiles": "The profiles of every shard, each sample in only one shard",
     },
     parameter_descriptions={
-        "n_parallel_samples": (
-            "Humann3 runs explicitly on a per-sample basis however q2-humann3 runs on a table of samples, i.e. "
-            "multiple samples. The sample-thread specifies how many samples should be run in parallel, this should "
-            "be a maximuim of n-1 processors. It is important to note that the memory required will scale "
-            "with threads. If 8GB of ram is expected for a single sample and 4 threads are selected you will need a "
-            "minimum of 32GB of ram. Memory use is highly dataset dependent and will change based on reference "
-            "databases, however, as a general run Humann3 will consume ~16GB of ram per sample. Use with caution"
-        ),
-        "humann3_threads": (
-            " The number of threads humann3 will use when processing a single sample. This will"
-            " for example call metaphlan with the number of threads specified where metaphlan will"
-            " implement its own multithreading. This should not be used in conjunction with the"
-            " sample_threads parameter. One or both of these paramers should be 1 unless you"
-            " are absolutely certain you have enough processors available. You should expect"
-            "  the number of processors required to be the number of"
-            " sample_threads * humann3_threads + 1, and the required memory to be a large multiple"
-            " of that, though it is highly dependent on your data set"
-        ),
-        "memory_use": "the amount of memory to use",
-        "metaphlan_stat_q": "Quantile value for the robust average",
+        "stratification": _stratification_description,
+        **_pruning_parameter_descriptions,
+        "working_dir": _working_dir_description,
     },
-    output_descriptions={
-        "genefamilies": (
-            "This file details the abundance of each gene family" " in the community."
+    output_descriptions=_table_output_descriptions,
+    name="Merge the shards of a HUMAnN3 run",
+    description=(
+        "Join, renormalize and merge the taxonomic profiles of the shards"
+        " profile_shard produced, giving the same tables as run"
+    ),
+)
+
+_resume_ignored = ("cache_dir", "cache_max_size")
+
+plugin.methods.register_function(
+    function=q2_humann3.resume_from_alignments,
+    inputs={
+        **{k: v for k, v in _profile_inputs.items() if k != "taxonomic_profiles"},
+        "alignments": SampleData[HumannAlignments],  # type: ignore
+    },
+    parameters={
+        **{k: v for k, v in _profile_parameters.items() if k not in _resume_ignored},
+        "stage": Str % Choices({"translated", "pathways"}),
+        "stratification": _stratification,
+        **_pruning_parameters,
+    },
+    outputs=_table_outputs
+    + [
+        ("failures", HumannReport),  # type: ignore
+        ("metrics", HumannReport),  # type: ignore
+    ],
+    input_descriptions={
+        **{
+            k: v
+            for k, v in _profile_input_descriptions.items()
+            if k != "taxonomic_profiles"
+        },
+        "alignments": (
+            "The alignment intermediates run or profile_shard kept with"
+            " keep_alignments. The nucleotide and bowtie2 databases must be"
+            " the ones they were made with. Samples without intermediates are"
+            " profiled from their reads"
+        ),
+    },
+    parameter_descriptions={
+        **{
+            k: v
+            for k, v in _profile_parameter_descriptions.items()
+            if k not in _resume_ignored
+        },
+        "stage": (
+            "The first humann3 stage to recompute: translated runs the diamond"
+            " search against protein_database again, pathways only recomputes"
+            " the gene families and pathways, e.g. for a new pathway_database"
+            " or pathway_mapping"
         ),
-        "pathcoverage": (
-            "Pathway coverage provides an alternative description"
-            " of the presence (1) and absence (0) of pathways in"
-            " a community, independent of their quantitative"
-            " abundance."
+        "stratification": _stratification_description,
+        **_pruning_parameter_descriptions,
+    },
+    output_descriptions={**_table_output_descriptions, **_report_output_descriptions},
+    name="Rerun the later HUMAnN3 stages from kept alignments",
+    description=(
+        "Resume humann3 from the alignment intermediates of a previous run,"
+        " skipping the MetaPhlAn prescreen and the nucleotide alignment, and"
+        " the translated search too unless stage is translated"
+    ),
+)
+
+plugin.methods.register_function(
+    function=q2_humann3.renorm_table,
+    inputs={
+        "table": FeatureTable[Frequency | RelativeFrequency],  # type: ignore
+    },
+    parameters={
+        "units": Str % Choices({"relab", "cpm"}),  # type: ignore
+        "mode": Str % Choices({"community", "levelwise"}),  # type: ignore
+        "special": Bool,
+    },
+    outputs=[
+        ("renorm_table", FeatureTable[RelativeFrequency]),  # type: ignore
+    ],
+    input_descriptions={
+        "table": "A joined humann3 table, such as the output of run",
+    },
+    parameter_descriptions={
+        "units": (
+            "Normalization scheme: copies per million (cpm) or relative"
+            " abundance (relab)"
         ),
-        "pathabundance": (
-            "This file details the abundance of each pathway in"
-            " the community as a function of the abundances of"
-            " the pathway's component reactions, with each"
-            " reaction's abundance computed as the sum over"
-            " abundances of genes catalyzing the reaction."
+        "mode": (
+            "Normalize all stratification levels by the community total"
+            " (community) or each level by its own total (levelwise)"
         ),
-        "taxonomy": (
-            "Taxonomic profile of microbial community of samples,"
-            " generated using clade-specific marker genes."
+        "special": (
+            "Include the special features UNMAPPED, UNINTEGRATED and UNGROUPED"
         ),
     },
-    name="Characterize samples using HUMAnN3",
-    description="Execute the HUMAnN3",
+    output_descriptions={
+        "renorm_table": "The renormalized table",
+    },
+    name="Renormalize a HUMAnN3 table",
+    description=(
+        "Renormalize an already produced table, respecting its stratified"
+        " FEATURE|taxon rows, without running humann3 again"
+    ),
+)
+
+_rename_names = Str % Choices(  # type: ignore
+    {
+        "kegg-orthology",
+        "kegg-pathway",
+        "kegg-module",
+        "ec",
+        "metacyc-rxn",
+        "metacyc-pwy",
+        "pfam",
+        "eggnog",
+        "go",
+        "infogo1000",
+    }
 )
 
 _rename_params = {
     "parameters": {
-        "name": Str  # type: ignore
-        % Choices(
-            {
-                "kegg-orthology",
-                "kegg-pathway",
-                "kegg-module",
-                "ec",
-                "metacyc-rxn",
-                "metacyc-pwy",
-                "pfam",
-                "eggnog",
-                "go",
-                "infogo1000",
-            }
-        ),
+        "name": _rename_names,
         "simplify": Bool,
     },
     "description": "Rename the feature table IDs",
@@ -208,3 +588,140 @@ plugin.methods.register_function(
     ],
     **_rename_params
 )
+
+_T_table_in, _T_table_out = TypeMap(
+    {
+        Frequency: Frequency,
+        RelativeFrequency: RelativeFrequency,
+    }
+)
+
+plugin.methods.register_function(
+    function=q2_humann3.rename_tables,
+    inputs={
+        "tables": Collection[FeatureTable[_T_table_in]],
+        "reference_mappings": List[HumannDB[ReferenceNameMapping]],
+    },
+    parameters={
+        "names": List[_rename_names],
+        "simplify": Bool,
+    },
+    outputs=[
+        ("renamed_tables", Collection[FeatureTable[_T_table_out]]),  # type: ignore
+    ],
+    input_descriptions={
+        "tables": (
+            "Tables to rename, all gene families or all pathway abundances"
+            " and coverages"
+        ),
+        "reference_mappings": (
+            "Explicit databases to rename every table with, in addition to"
+            " the names"
+        ),
+    },
+    parameter_descriptions={
+        "names": "Names of the reference databases to rename every table with",
+        "simplify": "Remove non-alphanumeric characters from names",
+    },
+    output_descriptions={
+        "renamed_tables": (
+            "Every table renamed with every reference, keyed <table>-<name>"
+            " or <table>-reference-<n> for the nth reference mapping"
+        ),
+    },
+    name="Rename many tables",
+    description=(
+        "Rename a collection of tables against several references, loading"
+        " each reference once"
+    ),
+)
+
+plugin.methods.register_function(
+    function=q2_humann3.regroup_gene_families,
+    inputs={
+        "table": FeatureTable[Frequency],
+        "group_mapping": HumannDB[GroupMapping],
+    },
+    parameters={
+        "groups": Str  # type: ignore
+        % Choices(
+            {
+                "uniref50_rxn",
+                "uniref90_rxn",
+                "uniref50_go",
+                "uniref90_go",
+                "uniref50_infogo1000",
+                "uniref90_infogo1000",
+                "uniref50_ko",
+                "uniref90_ko",
+                "uniref50_level4ec",
+                "uniref90_level4ec",
+                "uniref50_pfam",
+                "uniref90_pfam",
+                "uniref50_eggnog",
+                "uniref90_eggnog",
+            }
+        ),
+        "features_first": Bool,
+        "function": Str % Choices({"sum", "mean"}),  # type: ignore
+        "ungrouped": Bool,
+        "protected": Bool,
+    },
+    outputs=[
+        ("regrouped_table", FeatureTable[Frequency]),  # type: ignore
+    ],
+    input_descriptions={
+        "table": "Gene families table, such as the genefamilies output of run",
+        "group_mapping": (
+            "Explicit mapping of groups to their gene families, one group per"
+            " line followed by its tab separated features. Use if the groups"
+            " option is not available."
+        ),
+    },
+    parameter_descriptions={
+        "groups": (
+            "Built-in humann grouping. The rxn groupings ship with humann, the"
+            " others need the utility mapping database downloaded with"
+            " humann_databases."
+        ),
+        "features_first": (
+            "The group mapping lists the groups of each feature instead of the"
+            " features of each group"
+        ),
+        "function": "How the values of the features of a group are combined",
+        "ungrouped": "Collect features without a group in an UNGROUPED group",
+        "protected": "Carry UNMAPPED and UNINTEGRATED through",
+    },
+    output_descriptions={
+        "regrouped_table": "Table of group values, stratified as the input",
+    },
+    name="Regroup gene families",
+    description=(
+        "Regroup gene families into functional groups such as KEGG orthologs,"
+        " EC numbers, GO terms or Pfam domains, like humann_regroup_table"
+    ),
+)
+
+plugin.methods.register_function(
+    function=q2_humann3.split_stratified,
+    inputs={"table": FeatureTable[_T_table_in]},
+    parameters={},
+    outputs=[
+        ("stratified_table", FeatureTable[_T_table_out]),  # type: ignore
+        ("unstratified_table", FeatureTable[_T_table_out]),  # type: ignore
+    ],
+    input_descriptions={
+        "table": "A gene family or pathway table, such as the outputs of run",
+    },
+    output_descriptions={
+        "stratified_table": "The per-taxon FEATURE|taxon rows",
+        "unstratified_table": "The community total rows",
+    },
+    name="Split stratified and unstratified rows",
+    description=(
+        "Split a table into its stratified and unstratified rows, like"
+        " humann_split_stratified_table"
+    ),
+)
+
+importlib.import_module("q2_humann3._transformer")
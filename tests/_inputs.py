@@ -0,0 +1,76 @@
+"""
+Synthetic inputs for the tests, profiled by the humann3 stand-in of the
+benchmarks so that neither HUMAnN3 nor its databases are needed.
+"""
+import contextlib
+import os
+import pkgutil
+import sys
+from typing import Iterable
+from unittest import mock
+
+BENCHMARKS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"
+)
+sys.path.insert(0, BENCHMARKS)
+
+import import_time  # noqa: E402, F401
+from synthetic import write_databases  # noqa: E402
+from synthetic import write_demultiplexed_seqs  # noqa: E402
+from synthetic import write_fastq  # noqa: E402, F401
+from synthetic import write_sample_outputs  # noqa: E402, F401
+
+
+def synthetic_inputs(root: str, n_samples: int):
+    """The demultiplexed sequences and database inputs of ``run``"""
+    from q2_types.per_sample_sequences import \
+        SingleLanePerSampleSingleEndFastqDirFmt
+
+    from q2_humann3._format import (Bowtie2IndexDirFmt2, HumannDbDirFormat,
+                                    HumannDBSingleFileDirFormat)
+
+    seqs = os.path.join(root, "seqs")
+    write_demultiplexed_seqs(seqs, n_samples)
+    formats = {
+        "nucleotide_database": HumannDbDirFormat,
+        "protein_database": HumannDbDirFormat,
+        "pathway_database": HumannDBSingleFileDirFormat,
+        "pathway_mapping": HumannDBSingleFileDirFormat,
+        "bowtie_database": Bowtie2IndexDirFmt2,
+    }
+    databases = write_databases(os.path.join(root, "databases"))
+    return (
+        SingleLanePerSampleSingleEndFastqDirFmt(seqs, mode="r"),
+        {name: fmt(databases[name], mode="r") for name, fmt in formats.items()},
+    )
+
+
+@contextlib.contextmanager
+def stand_in_humann3(n_features: int = 200, failing: Iterable[str] = ()):
+    """Put the humann3 stand-in first on the PATH, ``failing`` samples fail"""
+    path = os.path.join(BENCHMARKS, "bin") + os.pathsep + os.environ["PATH"]
+    with mock.patch.dict(
+        os.environ,
+        {
+            "PATH": path,
+            "Q2_HUMANN3_BENCH_FEATURES": str(n_features),
+            "Q2_HUMANN3_BENCH_FAIL": ",".join(failing),
+        },
+    ):
+        yield
+
+
+@contextlib.contextmanager
+def fail_first_call(target: str):
+    """Patch the function ``target`` to raise OSError the first time it is called"""
+    original = pkgutil.resolve_name(target)
+    calls = []
+
+    def fail_once(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise OSError("synthetic failure")
+        return original(*args, **kwargs)
+
+    with mock.patch(target, side_effect=fail_once):
+        yield calls
@@ -0,0 +1,58 @@
+"""
+Run the humann table tools, which q2-humann3 reimplements in process, on
+biom tables written as the TSV files they read.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import biom
+import numpy as np
+
+requires_humann = unittest.skipUnless(
+    shutil.which("humann_join_tables"), "the humann table tools are not installed"
+)
+
+
+def write_humann_table(table: biom.Table, path: str) -> None:
+    """Write ``table`` the way humann3 writes its TSV tables"""
+    matrix = table.matrix_data.toarray()
+    with open(path, "w") as fh:
+        fh.write("\t".join(["# Gene Family"] + list(table.ids())) + "\n")
+        for feature_id, values in zip(table.ids(axis="observation"), matrix):
+            fh.write("\t".join([feature_id] + [repr(float(v)) for v in values]) + "\n")
+
+
+def read_humann_table(path: str) -> biom.Table:
+    """A TSV table written by a humann tool, in its row and column order"""
+    with open(path) as fh:
+        header = fh.readline().rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in fh if not line.startswith("#")]
+    values = np.array([[float(v) for v in row[1:]] for row in rows]).reshape(
+        len(rows), len(header) - 1
+    )
+    return biom.Table(values, [row[0] for row in rows], header[1:])
+
+
+def humann_tool(tool: str, tables, *arguments: str) -> biom.Table:
+    """
+    Run ``humann_<tool>`` on ``tables``, one table or a list of them to
+    join, and read the table it writes.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if isinstance(tables, biom.Table):
+            tables = [tables]
+        inputs = os.path.join(temp_dir, "inputs")
+        os.makedirs(inputs)
+        for i, table in enumerate(tables):
+            write_humann_table(table, os.path.join(inputs, "table%05d.tsv" % i))
+        source = inputs if tool == "join_tables" else os.path.join(inputs, "table00000.tsv")
+        output = os.path.join(temp_dir, "output.tsv")
+        subprocess.run(
+            ["humann_" + tool, "-i", source, "-o", output] + list(arguments),
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        return read_humann_table(output)
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from q2_humann3.api import TABLES, HumannTable, iter_profile, profile
+from tests._inputs import stand_in_humann3, write_databases, write_fastq
+
+
+class ApiTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        root = self.temp_dir.name
+        self.samples = {}
+        for name in ("good", "other", "bad"):
+            self.samples[name] = os.path.join(root, "%s.fastq.gz" % name)
+            write_fastq(self.samples[name])
+        self.databases = write_databases(os.path.join(root, "databases"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_failures_and_metrics(self):
+        with stand_in_humann3(failing=["bad"]):
+            result = profile(self.samples, **self.databases, skip_failed=True)
+
+        self.assertEqual(list(result.failures.index), ["bad"])
+        self.assertEqual(set(result.tables), set(TABLES))
+        for table in result.tables.values():
+            self.assertEqual(list(table.sample_ids), ["good", "other"])
+        self.assertIn("good", set(result.metrics["sample"]))
+
+    def test_iter_profile(self):
+        with stand_in_humann3(failing=["bad"]):
+            run = iter_profile(
+                self.samples, **self.databases, tables=("pathabundance",), skip_failed=True
+            )
+            self.assertIsNone(run.failures)
+            name, table = next(run)
+            # every sample has been profiled before the first table
+            self.assertEqual(list(run.failures.index), ["bad"])
+            self.assertIsNone(run.metrics)
+            self.assertEqual(name, "pathabundance")
+            self.assertIsInstance(table, HumannTable)
+            self.assertEqual(list(run), [])
+            self.assertIsNotNone(run.metrics)
+
+    def test_arguments_checked_on_call(self):
+        with self.assertRaisesRegex(ValueError, "tables must be"):
+            iter_profile(self.samples, **self.databases, tables=("nope",))
+        with self.assertRaisesRegex(ValueError, "stratification must be"):
+            iter_profile(self.samples, **self.databases, stratification="nope")
+        # run's keep_alignments returns an artifact, which the API does not
+        for options in ({"keep_alignments": True}, {"alignments": "kept"}):
+            with self.subTest(**options):
+                with self.assertRaisesRegex(ValueError, "Unknown options: %s" % list(options)[0]):
+                    profile(self.samples, **self.databases, **options)
+
+    def test_failed_samples_raise(self):
+        with stand_in_humann3(failing=["bad"]):
+            with self.assertRaisesRegex(RuntimeError, "bad"):
+                profile(self.samples, **self.databases)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+from q2_humann3 import run
+from q2_humann3._cache import _hash_file
+from q2_humann3._validation import _write_checksums
+from tests._inputs import fail_first_call, stand_in_humann3, synthetic_inputs
+
+
+class RunTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.seqs, self.databases = synthetic_inputs(self.temp_dir.name, 2)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_checksummed_bowtie_index(self):
+        # as import_database writes them, and staging copies them along
+        index = str(self.databases["bowtie_database"])
+        _write_checksums(
+            index, {name: _hash_file(os.path.join(index, name)) for name in os.listdir(index)}
+        )
+        staging_dir = os.path.join(self.temp_dir.name, "staging")
+
+        for options in ({}, {"staging_dir": staging_dir}):
+            with self.subTest(**options), stand_in_humann3():
+                genefamilies = run(self.seqs, **self.databases, **options)[0]
+                self.assertEqual(list(genefamilies.ids()), ["sample0", "sample1"])
+
+    def test_kept_alignments_retried(self):
+        # the first sample fails after its alignments were kept
+        with stand_in_humann3(), fail_first_call("q2_humann3._humann._remove_humann_temp"):
+            outputs = run(self.seqs, **self.databases, keep_alignments=True, retries=1)
+        failures, alignments = outputs[4], outputs[6]
+
+        self.assertTrue(failures.empty)
+        self.assertEqual(sorted(os.listdir(str(alignments))), ["sample0", "sample1"])
+        for sample in ("sample0", "sample1"):
+            self.assertEqual(
+                os.listdir(os.path.join(str(alignments), sample)),
+                ["%s_metaphlan_bugs_list.tsv.gz" % sample],
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
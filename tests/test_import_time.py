@@ -0,0 +1,21 @@
+import unittest
+
+from tests._inputs import import_time
+
+
+class ImportTimeTests(unittest.TestCase):
+    def test_plugin_import(self):
+        measurements = [import_time._measure() for _ in range(3)]
+
+        for measurement in measurements:
+            modules = set(measurement["modules"])
+            self.assertIn("q2_humann3.plugin_setup", modules)
+            self.assertEqual(import_time._loaded(modules), [])
+            for name in ("_merge", "_scheduler", "_metrics", "_rename", "_regroup"):
+                self.assertNotIn("q2_humann3." + name, modules)
+            self.assertFalse({name.split(".")[0] for name in modules} & {"asyncio", "scipy"})
+        self.assertLess(min(m["import_time"] for m in measurements), import_time.BUDGET)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+
+import biom
+import numpy as np
+
+from q2_humann3._merge import HUMANN_TABLES, _SampleAggregator, _TableAccumulator
+from tests._inputs import write_sample_outputs
+from tests._tools import humann_tool, requires_humann
+
+SAMPLES = ("s2", "s0", "s10", "s1")
+
+
+@requires_humann
+class JoinTests(unittest.TestCase):
+    """The merged tables are the tables humann_join_tables writes"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.outputs = [os.path.join(self.temp_dir.name, name) for name in SAMPLES]
+        for output, name in zip(self.outputs, SAMPLES):
+            write_sample_outputs(output, name, 300)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def sample_tables(self, name):
+        return [
+            biom.load_table(os.path.join(output, "%s_%s.biom" % (sample, name)))
+            for output, sample in zip(self.outputs, SAMPLES)
+        ]
+
+    def assertTablesEqual(self, expected, observed, rtol=1e-12):
+        self.assertEqual(
+            list(expected.ids(axis="observation")), list(observed.ids(axis="observation"))
+        )
+        self.assertEqual(list(expected.ids()), list(observed.ids()))
+        np.testing.assert_allclose(
+            expected.matrix_data.toarray(), observed.matrix_data.toarray(), rtol=rtol
+        )
+
+    def test_accumulator(self):
+        for name in HUMANN_TABLES:
+            with self.subTest(table=name):
+                tables = self.sample_tables(name)
+                accumulator = _TableAccumulator()
+                for table in tables:
+                    accumulator.add_table(table)
+
+                self.assertTablesEqual(
+                    humann_tool("join_tables", sorted(tables, key=lambda t: t.ids()[0])),
+                    accumulator.to_table(),
+                )
+
+    def test_aggregator(self):
+        aggregator = _SampleAggregator()
+        for output in self.outputs:
+            aggregator.add(output)
+
+        for name in HUMANN_TABLES:
+            with self.subTest(table=name):
+                expected = humann_tool(
+                    "join_tables", sorted(self.sample_tables(name), key=lambda t: t.ids()[0])
+                )
+                rtol = 1e-12
+                if name != "pathcoverage":
+                    expected = humann_tool("renorm_table", expected, "--units", "relab")
+                    # humann_renorm_table writes six significant digits
+                    rtol = 1e-5
+                self.assertTablesEqual(expected, aggregator.table(name), rtol)
+
+    def test_feature_order(self):
+        tables = [
+            biom.Table(np.array([[1.0], [2.0], [3.0], [4.0]]),
+                       ["AB", "A|g__x.s__y", "UNINTEGRATED|g__x.s__y", "A"], ["s0"]),
+            biom.Table(np.array([[5.0], [6.0], [7.0], [8.0]]),
+                       ["A|unclassified", "UNMAPPED", "A_1", "UNINTEGRATED"], ["s1"]),
+        ]
+        accumulator = _TableAccumulator()
+        for table in tables:
+            accumulator.add_table(table)
+
+        self.assertTablesEqual(humann_tool("join_tables", tables), accumulator.to_table())
+
+
+if __name__ == "__main__":
+    unittest.main()
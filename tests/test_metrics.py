@@ -0,0 +1,26 @@
+import unittest
+
+from q2_humann3._metrics import _RunMetrics
+
+
+class RunMetricsTests(unittest.TestCase):
+    def test_retried_stages_numbered(self):
+        metrics = _RunMetrics()
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                with metrics.measure("s1", "fold"):
+                    raise ValueError("fold failed")
+        with metrics.measure("s1", "fold"):
+            pass
+        metrics.record("s2", "fold", wall_time=1.0)
+        metrics.record("", "merge genefamilies", wall_time=1.0)
+
+        observed = metrics.to_dataframe()
+        self.assertEqual(
+            list(observed.index),
+            ["s1/fold", "s1/fold #2", "s1/fold #3", "s2/fold", "run/merge genefamilies"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
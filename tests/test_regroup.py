@@ -0,0 +1,87 @@
+import gzip
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import biom
+import numpy as np
+
+from q2_humann3._regroup import _humann_group_file, _open_text, _regroup_table
+from tests._tools import humann_tool, requires_humann
+
+
+@requires_humann
+class RegroupTests(unittest.TestCase):
+    """The regrouped tables are the ones humann_regroup_table writes"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch(
+            "q2_humann3._rename._INDEX_DIR", os.path.join(self.temp_dir.name, "cache")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # gene families of the built-in reactions, and some in no group
+        path, _, _ = _humann_group_file("uniref90_rxn")
+        families = []
+        with _open_text(path) as fh:
+            for line in fh:
+                families += [f for f in line.rstrip("\n").split("\t")[2:]
+                             if f.startswith("UniRef90")][:2]
+                if len(families) > 20:
+                    break
+        self.families = families
+        features = ["UNMAPPED", "UNINTEGRATED", "UNINTEGRATED|g__A.s__B"]
+        for family in families + ["UniRef90_NONE", "UniRef90_NONE2"]:
+            features += [family, family + "|g__A.s__B", family + "|unclassified"]
+        features = list(dict.fromkeys(features))
+        values = np.random.default_rng(0).random((len(features), 3))
+        values[values < 0.3] = 0
+        self.table = biom.Table(values, features, ["s1", "s2", "s3"])
+
+        self.mapping = os.path.join(self.temp_dir.name, "mapping")
+        os.makedirs(self.mapping)
+        self.mapping_file = os.path.join(self.mapping, "mapping.gz")
+        with gzip.open(self.mapping_file, "wt") as fh:
+            fh.write("G1\t%s\t%s\nG2\t%s\nG1\t%s\nG3\t%s\t%s\n" % (
+                families[0], families[1], families[1], families[2], families[3], families[0]
+            ))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def assertRegroupedLike(self, expected, observed):
+        self.assertEqual(
+            list(expected.ids(axis="observation")), list(observed.ids(axis="observation"))
+        )
+        self.assertEqual(list(expected.ids()), list(observed.ids()))
+        np.testing.assert_allclose(
+            expected.matrix_data.toarray(), observed.matrix_data.toarray(), rtol=1e-12
+        )
+
+    def test_humann_groups(self):
+        # humann_regroup_table reads all of the built-in groups on every run,
+        # the functions are compared on the custom mapping
+        self.assertRegroupedLike(
+            humann_tool("regroup_table", self.table, "--groups", "uniref90_rxn"),
+            _regroup_table(self.table.copy(), groups="uniref90_rxn"),
+        )
+
+    def test_group_mapping(self):
+        for function in ("sum", "mean"):
+            for kept in (True, False):
+                with self.subTest(function=function, ungrouped_and_protected=kept):
+                    flag = "Y" if kept else "N"
+                    self.assertRegroupedLike(
+                        humann_tool("regroup_table", self.table, "--custom", self.mapping_file,
+                                    "--function", function, "--ungrouped", flag,
+                                    "--protected", flag),
+                        _regroup_table(self.table.copy(), group_mapping=self.mapping,
+                                       function=function, ungrouped=kept, protected=kept),
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import bz2
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import biom
+import numpy as np
+
+from q2_humann3._rename import _rename_table, _rename_tables
+from tests._tools import humann_tool, requires_humann
+
+FEATURES = [
+    "UNMAPPED", "K1", "K1|g__A.s__B", "K2", "K2|unclassified", "K3", "K5",
+    "UNINTEGRATED|g__X", "K4", "1.1.1.1", "1.1.1.1|g__Y", "1.1.1.100", "9.9.9.9",
+]
+
+REFERENCE = (
+    "K1\tname one\nK2\tname/two (x)\nK2\tname/two (x)\nK2\tother\nK3\t\n"
+    "K4\ta\tb\n1.1.1.1\tcustom dehydrogenase\n"
+)
+
+
+@requires_humann
+class RenameTests(unittest.TestCase):
+    """The renamed features are the ones humann_rename_table writes"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.reference = os.path.join(self.temp_dir.name, "reference")
+        os.makedirs(self.reference)
+        self.reference_file = os.path.join(self.reference, "reference.txt.bz2")
+        with bz2.open(self.reference_file, "wt") as fh:
+            fh.write(REFERENCE)
+        # keep the name indexes out of the user's cache
+        patcher = mock.patch(
+            "q2_humann3._rename._INDEX_DIR", os.path.join(self.temp_dir.name, "cache")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def table(self):
+        values = np.arange(len(FEATURES) * 2, dtype=np.float64).reshape(-1, 2) + 1
+        return biom.Table(values, FEATURES, ["s1", "s2"])
+
+    def assertRenamedLike(self, expected, observed):
+        self.assertEqual(
+            list(expected.ids(axis="observation")), list(observed.ids(axis="observation"))
+        )
+        self.assertEqual(list(expected.ids()), list(observed.ids()))
+        np.testing.assert_array_equal(
+            expected.matrix_data.toarray(), observed.matrix_data.toarray()
+        )
+
+    def test_reference_mapping(self):
+        for simplify in (False, True):
+            with self.subTest(simplify=simplify):
+                arguments = ["--custom", self.reference_file] + ["--simplify"] * simplify
+                self.assertRenamedLike(
+                    humann_tool("rename_table", self.table(), *arguments),
+                    _rename_table(self.table(), reference_mapping=self.reference,
+                                  simplify=simplify),
+                )
+
+    def test_humann_names(self):
+        self.assertRenamedLike(
+            humann_tool("rename_table", self.table(), "--names", "ec"),
+            _rename_table(self.table(), name="ec"),
+        )
+
+    def test_many_tables(self):
+        tables = {
+            "both": self.table(),
+            "first": self.table().filter(["s1"], inplace=False),
+        }
+        # features the other table does not have
+        tables["first"].update_ids(
+            {"K5": "K6", "9.9.9.9": "1.1.1.10"}, axis="observation", strict=False, inplace=True
+        )
+        renamed = _rename_tables(
+            tables, names=["ec"], reference_mappings=[self.reference], simplify=True
+        )
+
+        self.assertEqual(
+            sorted(renamed),
+            ["both-ec", "both-reference-1", "first-ec", "first-reference-1"],
+        )
+        for key, table in tables.items():
+            for label, arguments in [
+                ("ec", ["--names", "ec"]),
+                ("reference-1", ["--custom", self.reference_file]),
+            ]:
+                with self.subTest(table=key, reference=label):
+                    self.assertRenamedLike(
+                        humann_tool("rename_table", table, *arguments, "--simplify"),
+                        renamed["%s-%s" % (key, label)],
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()
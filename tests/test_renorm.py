@@ -0,0 +1,51 @@
+import unittest
+
+import biom
+import numpy as np
+
+from q2_humann3._renorm import _renorm_table
+from tests._tools import humann_tool, requires_humann
+
+FEATURES = [
+    "UNMAPPED", "UNINTEGRATED", "UNINTEGRATED|g__A.s__B", "A", "A|g__A.s__B",
+    "A|unclassified", "B", "B|g__C.s__D", "C", "C|g__A.s__B",
+]
+
+
+@requires_humann
+class RenormTests(unittest.TestCase):
+    """The renormalized tables are the ones humann_renorm_table writes"""
+
+    def setUp(self):
+        values = np.random.default_rng(0).random((len(FEATURES), 3)) * 100
+        values[values < 30] = 0
+        # a sample without community rows is left at zero
+        values[3:, 2] = 0
+        values[[4, 7], 2] = 5
+        self.table = biom.Table(values, FEATURES, ["s1", "s2", "s3"])
+
+    def test_renorm(self):
+        for units in ("relab", "cpm"):
+            for mode in ("community", "levelwise"):
+                for special in (True, False):
+                    with self.subTest(units=units, mode=mode, special=special):
+                        expected = humann_tool(
+                            "renorm_table", self.table, "--units", units, "--mode", mode,
+                            "--special", "y" if special else "n",
+                        )
+                        observed = _renorm_table(self.table.copy(), units, mode, special)
+
+                        self.assertEqual(
+                            list(expected.ids(axis="observation")),
+                            list(observed.ids(axis="observation")),
+                        )
+                        self.assertEqual(list(expected.ids()), list(observed.ids()))
+                        # humann_renorm_table writes six significant digits
+                        np.testing.assert_allclose(
+                            expected.matrix_data.toarray(), observed.matrix_data.toarray(),
+                            rtol=1e-5,
+                        )
+
+
+if __name__ == "__main__":
+    unittest.main()
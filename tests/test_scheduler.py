@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+
+from q2_humann3._scheduler import _SampleScheduler
+
+
+class SchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.samples = {}
+        for i in range(2):
+            path = os.path.join(self.temp_dir.name, "sample%d.fastq.gz" % i)
+            with open(path, "wb") as fh:
+                fh.write(b"x" * 100 * (i + 1))
+            self.samples["sample%d" % i] = [path]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_samples(self, sizes):
+        self.samples = {}
+        for sample, size in sizes.items():
+            path = os.path.join(self.temp_dir.name, "%s.fastq.gz" % sample)
+            with open(path, "wb") as fh:
+                fh.write(b"x" * size)
+            self.samples[sample] = [path]
+
+    def admit(self, scheduler):
+        return {job.sample: threads for job, threads in scheduler.admit()}
+
+    def threads(self, *args, **kwargs):
+        return self.admit(_SampleScheduler(self.samples, "minimum", *args, **kwargs))
+
+    def test_fixed_layout(self):
+        # fewer samples than slots, each still runs with humann3_threads
+        threads = self.threads(None, 4 * 3, min_threads=3, max_threads=3)
+        self.assertEqual(threads, {"sample1": 3, "sample0": 3})
+
+    def test_free_cpus_split(self):
+        self.assertEqual(self.threads(None, 12, min_threads=3), {"sample1": 6, "sample0": 6})
+
+    def test_memory_limited(self):
+        # one sample fits the memory budget, it gets every CPU
+        self.assertEqual(self.threads(10.0, 12, min_threads=3, max_threads=3), {"sample1": 3})
+        self.assertEqual(self.threads(10.0, 12, min_threads=3), {"sample1": 12})
+
+    def test_adaptive_share_by_size(self):
+        self.write_samples({"a": 600, "b": 200, "c": 100, "d": 100})
+        scheduler = _SampleScheduler(
+            self.samples, "minimum", None, 8, min_threads=2, adaptive=True
+        )
+        # each sample's share of the 8 CPUs is its share of the reads, and
+        # at least min_threads; d waits as no CPUs are left
+        self.assertEqual(self.admit(scheduler), {"a": 4, "b": 2, "c": 2})
+
+    def test_adaptive_spare_threads_redistributed(self):
+        self.write_samples({"a": 600, "b": 200, "c": 100, "d": 100})
+        scheduler = _SampleScheduler(
+            self.samples, "minimum", None, 8, min_threads=2, adaptive=True
+        )
+        jobs = {job.sample: (job, threads) for job, threads in scheduler.admit()}
+        scheduler.release(*jobs["a"])
+
+        # d's share of the unfinished reads is 2 threads, but nothing is
+        # queued behind it so it gets every free CPU
+        self.assertEqual(self.admit(scheduler), {"d": 4})
+        self.assertEqual(scheduler.admit(), [])
+
+    def test_adaptive_memory_limited(self):
+        self.write_samples({"a": 300, "b": 100, "c": 100})
+        # room for two samples of about 8 GB each
+        scheduler = _SampleScheduler(
+            self.samples, "minimum", 17.0, 8, min_threads=1, adaptive=True
+        )
+        # the CPUs the third sample cannot use are split by size
+        jobs = {job.sample: (job, threads) for job, threads in scheduler.admit()}
+        self.assertEqual({sample: threads for sample, (_, threads) in jobs.items()},
+                         {"a": 6, "b": 2})
+        self.assertEqual(scheduler.admit(), [])
+
+        scheduler.release(*jobs["b"])
+        self.assertEqual(self.admit(scheduler), {"c": 2})
+        self.assertFalse(scheduler.done)
+
+
+if __name__ == "__main__":
+    unittest.main()
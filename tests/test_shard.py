@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from q2_humann3 import finalize, profile_shard, run
+from q2_humann3._shard import _shard_of
+from tests._inputs import fail_first_call, stand_in_humann3, synthetic_inputs
+
+
+class ShardTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.seqs, self.databases = synthetic_inputs(self.temp_dir.name, 4)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def assertTablesEqual(self, expected, observed):
+        self.assertEqual(list(expected.ids()), list(observed.ids()))
+        self.assertEqual(
+            list(expected.ids(axis="observation")), list(observed.ids(axis="observation"))
+        )
+        np.testing.assert_array_equal(
+            expected.matrix_data.toarray(), observed.matrix_data.toarray()
+        )
+
+    def test_finalize_equals_run(self):
+        # more shards than samples, so some shards are empty
+        n_shards = 5
+        self.assertLess(len({_shard_of("sample%d" % i, n_shards) for i in range(4)}), n_shards)
+
+        with stand_in_humann3():
+            expected = run(self.seqs, **self.databases)[:4]
+            shards = []
+            for shard_index in range(n_shards):
+                profiles, failures, _, _ = profile_shard(
+                    self.seqs, **self.databases, n_shards=n_shards, shard_index=shard_index
+                )
+                self.assertTrue(failures.empty)
+                shards.append(profiles)
+
+        self.assertTrue(any(not os.listdir(str(shard)) for shard in shards))
+        for expected_table, observed_table in zip(expected, finalize(shards)):
+            self.assertTablesEqual(expected_table, observed_table)
+
+    def test_finalize_same_with_pruning(self):
+        pruning = dict(min_abundance=1e-3, min_prevalence=0.5, stratification="unstratified")
+        with stand_in_humann3():
+            expected = run(self.seqs, **self.databases, **pruning)[:4]
+            shards = [
+                profile_shard(self.seqs, **self.databases, n_shards=2, shard_index=i)[0]
+                for i in range(2)
+            ]
+        for expected_table, observed_table in zip(expected, finalize(shards, **pruning)):
+            self.assertTablesEqual(expected_table, observed_table)
+
+    def test_finalize_without_samples(self):
+        with stand_in_humann3():
+            profiles = profile_shard(self.seqs, **self.databases, sample_ids=["sample0"])[0]
+            empty = profile_shard(
+                self.seqs,
+                **self.databases,
+                sample_ids=["sample0"],
+                n_shards=2,
+                shard_index=1 - _shard_of("sample0", 2),
+            )[0]
+        self.assertEqual(os.listdir(str(empty)), [])
+        self.assertEqual(finalize([profiles, empty])[0].ids().tolist(), ["sample0"])
+        with self.assertRaisesRegex(ValueError, "None of the 1 shards"):
+            finalize([empty])
+
+    def test_profiles_retried(self):
+        # the first sample fails while its outputs are moved into the shard
+        with stand_in_humann3():
+            expected = profile_shard(self.seqs, **self.databases)[0]
+            with fail_first_call("q2_humann3._shard._sample_outputs") as calls:
+                profiles, failures, _, _ = profile_shard(self.seqs, **self.databases, retries=1)
+
+        self.assertEqual(len(calls), 5)
+        self.assertTrue(failures.empty)
+        self.assertEqual(sorted(os.listdir(str(profiles))), sorted(os.listdir(str(expected))))
+        for expected_table, observed_table in zip(finalize([expected]), finalize([profiles])):
+            self.assertTablesEqual(expected_table, observed_table)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from q2_humann3._staging import _list_files, _stage_database
+
+
+class StageDatabaseTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        root = self.temp_dir.name
+        # named like an artifact's data directory, so staged by its UUID
+        self.database = os.path.join(
+            root, "cache", "0b1e8f0c-5bd3-4d44-a8a4-1e9cbd3c0d1f", "data"
+        )
+        os.makedirs(self.database)
+        self.write("genes.ffn.bz2", b"ACGT" * 100)
+        self.staging_dir = os.path.join(root, "staging")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.database, name), "wb") as fh:
+            fh.write(content)
+
+    def test_reused(self):
+        staged = _stage_database(self.database, self.staging_dir)
+        self.assertEqual(_list_files(staged), _list_files(self.database))
+        self.assertEqual(_stage_database(self.database, self.staging_dir), staged)
+        self.assertEqual(os.listdir(self.staging_dir), [os.path.basename(staged)])
+
+    def test_changed_database_staged_beside(self):
+        staged = _stage_database(self.database, self.staging_dir)
+        before = _list_files(staged)
+        self.write("more.ffn.bz2", b"TTTT")
+
+        restaged = _stage_database(self.database, self.staging_dir)
+        self.assertNotEqual(restaged, staged)
+        self.assertEqual(_list_files(restaged), _list_files(self.database))
+        # a run still reading the first copy keeps it
+        self.assertEqual(_list_files(staged), before)
+
+    def test_changed_staged_copy(self):
+        staged = _stage_database(self.database, self.staging_dir)
+        os.remove(os.path.join(staged, "genes.ffn.bz2"))
+        with self.assertRaisesRegex(ValueError, "remove it"):
+            _stage_database(self.database, self.staging_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
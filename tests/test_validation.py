@@ -0,0 +1,56 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from q2_humann3._validation import _check_bowtie2_index
+
+
+class Bowtie2IndexTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, fmt, *values):
+        with open(os.path.join(self.path, name), "wb") as fh:
+            fh.write(struct.pack(fmt, *values) + b"\0" * 64)
+
+    def write_index(self, extension, forward, reverse, endian="<", versions=(-1, -1)):
+        length = "Q" if extension == "bt2l" else "I"
+        header = endian + "Ii" + length
+        self.write("mpa.1." + extension, header, 1, versions[0], forward)
+        self.write("mpa.rev.1." + extension, header, 1, versions[1], reverse)
+        self.write("mpa.3." + extension, endian + "I", 1)
+
+    def test_lengths_compared(self):
+        for extension in ("bt2", "bt2l"):
+            for endian in "<>":
+                with self.subTest(extension=extension, endian=endian):
+                    self.write_index(extension, 123456, 123456, endian, (-2, -3))
+                    _check_bowtie2_index(self.path)
+
+                    self.write_index(extension, 123456, 123457, endian)
+                    with self.assertRaisesRegex(ValueError, "different references"):
+                        _check_bowtie2_index(self.path)
+                    for name in os.listdir(self.path):
+                        os.remove(os.path.join(self.path, name))
+
+    def test_bad_sentinel(self):
+        self.write_index("bt2l", 5, 5)
+        self.write("mpa.3.bt2l", "<I", 7)
+        with self.assertRaisesRegex(ValueError, "mpa.3.bt2l is not a bowtie2 index"):
+            _check_bowtie2_index(self.path)
+
+    def test_truncated_header(self):
+        self.write_index("bt2l", 5, 5)
+        with open(os.path.join(self.path, "mpa.1.bt2l"), "wb") as fh:
+            fh.write(struct.pack("<Ii", 1, -1))
+        with self.assertRaisesRegex(ValueError, "too short"):
+            _check_bowtie2_index(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()